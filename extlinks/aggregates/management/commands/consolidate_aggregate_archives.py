@@ -0,0 +1,157 @@
+import datetime
+import logging
+import os
+import re
+import tempfile
+
+from collections import defaultdict
+from typing import Callable, List
+
+from django.core.management.base import CommandError
+
+from extlinks.aggregates import storage
+from extlinks.common import swift
+from extlinks.common.management.commands import BaseCommand
+
+logger = logging.getLogger("django")
+
+PREFIXES = [
+    "aggregates_linkaggregate",
+    "aggregates_useraggregate",
+    "aggregates_pageprojectaggregate",
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Converts the aggregate archives in object storage that were written per "
+        "date and user list into one consolidated archive per collection and month"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--container",
+            type=str,
+            help="The Swift container holding the aggregate archives.",
+        )
+        parser.add_argument(
+            "--delete",
+            action="store_true",
+            help="Delete the converted archives once their consolidated archive has been uploaded.",
+        )
+        parser.add_argument(
+            "--columnar",
+            action="store_true",
+            help="Write the consolidated archives with the compact columnar encoding. These archives keep their .json.gz names but are not plain JSON.",
+        )
+
+    def _handle(self, *args, **options):
+        container = options["container"] or os.environ.get(
+            "SWIFT_CONTAINER_AGGREGATES", "archive-aggregates"
+        )
+
+        try:
+            conn = swift.swift_connection()
+        except RuntimeError:
+            raise CommandError("Swift credentials not provided")
+
+        encode = (
+            storage.encode_columnar_archive
+            if options["columnar"]
+            else storage.encode_consolidated_archive
+        )
+        for prefix in PREFIXES:
+            self._consolidate(conn, container, prefix, encode, options["delete"])
+            storage.invalidate_archive_catalog(prefix)
+
+    def _consolidate(
+        self, conn, container: str, prefix: str, encode: Callable, delete: bool
+    ):
+        """
+        Consolidates every month of a kind of aggregate archive that hasn't
+        been consolidated yet.
+        """
+        pattern = re.compile(
+            rf"^{prefix}_([0-9]+)_([0-9]+)_([0-9]+-[0-9]{{2}})-[0-9]{{2}}_([01])\.json\.gz$"
+        )
+
+        names = {
+            archive["name"]
+            for archive in swift.get_object_list(conn, container, f"{prefix}_")
+        }
+        months = defaultdict(list)
+        for name in names:
+            details = pattern.search(name)
+            if details:
+                months[
+                    (
+                        int(details.group(1)),
+                        int(details.group(2)),
+                        datetime.datetime.strptime(details.group(3), "%Y-%m").date(),
+                    )
+                ].append(name)
+
+        consolidated_count = 0
+        for (organisation_id, collection_id, month), archives in sorted(
+            months.items()
+        ):
+            consolidated_name = storage.consolidated_archive_name(
+                prefix, organisation_id, collection_id, month
+            )
+            if consolidated_name not in names:
+                self._upload_consolidated(
+                    conn,
+                    container,
+                    consolidated_name,
+                    encode(
+                        organisation_id,
+                        collection_id,
+                        month,
+                        self._download_records(conn, container, archives),
+                    ),
+                )
+                consolidated_count += 1
+
+            if delete:
+                for name in archives:
+                    conn.delete_object(container, name)
+
+        logger.info("Consolidated %d months of %s archives", consolidated_count, prefix)
+
+    def _download_records(self, conn, container: str, archives: List[str]):
+        """
+        Downloads the records of a collection's month from the archives
+        written per date and user list.
+        """
+        # The archives for all users also contain the records of the archives
+        # for users on the user list.
+        all_users_archives = [name for name in archives if name.endswith("_0.json.gz")]
+        contents = swift.batch_download_files(conn, container, all_users_archives)
+        if len(contents) != len(all_users_archives):
+            raise CommandError(
+                f"Failed to download {len(all_users_archives) - len(contents)} archives"
+            )
+
+        records = {}
+        for archive in contents.values():
+            for record in storage.decode_archive(archive):
+                records[record["pk"]] = record
+
+        return sorted(records.values(), key=lambda record: record["pk"])
+
+    def _upload_consolidated(
+        self, conn, container: str, consolidated_name: str, contents: bytes
+    ):
+        """
+        Uploads a consolidated archive.
+        """
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, consolidated_name)
+            with open(path, "wb") as consolidated_archive:
+                consolidated_archive.write(contents)
+
+            _, failed = swift.batch_upload_files(conn, container, [path])
+            if failed:
+                raise CommandError(f"Failed to upload {consolidated_name}")
+
+        logger.info("Uploaded %s", consolidated_name)
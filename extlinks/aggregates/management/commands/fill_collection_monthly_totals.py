@@ -0,0 +1,95 @@
+import logging
+from datetime import date, timedelta
+
+from django.core.management.base import CommandError
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+
+from extlinks.aggregates.models import CollectionMonthlyTotal, LinkAggregate
+from extlinks.aggregates.storage import calculate_totals, download_aggregates
+from extlinks.common.management.commands import BaseCommand
+from extlinks.organisations.models import Collection
+
+logger = logging.getLogger("django")
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the monthly totals behind the organisation charts from "
+        "LinkAggregates and their archives"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--collections",
+            nargs="+",
+            type=int,
+            help="A list of collection IDs that will be processed instead of every collection",
+        )
+
+    def _handle(self, *args, **options):
+        collections = Collection.objects.exclude(organisation__isnull=True)
+        if options["collections"]:
+            collections = collections.filter(pk__in=options["collections"])
+            missing = set(options["collections"]) - {
+                collection.pk for collection in collections
+            }
+            if missing:
+                raise CommandError(
+                    f"Collection '{sorted(missing)[0]}' does not exist"
+                )
+
+        for collection in collections:
+            self._fill(collection)
+
+        close_old_connections()
+
+    def _fill(self, collection: Collection):
+        """
+        Replaces a collection's monthly totals with those of its
+        LinkAggregates, and of its archived LinkAggregates for the months
+        before them.
+        """
+        months = list(
+            LinkAggregate.objects.filter(collection=collection).dates(
+                "full_date", "month"
+            )
+        )
+
+        # Archives are only needed for months that are no longer in the
+        # database.
+        to_date = months[0] - timedelta(days=1) if months else None
+        archived_totals = calculate_totals(
+            download_aggregates(
+                prefix="aggregates_linkaggregate",
+                queryset_filter=Q(collection=collection),
+                to_date=to_date,
+            ),
+            group_by=lambda record: (
+                record["year"],
+                record["month"],
+                record["on_user_list"],
+            ),
+        )
+
+        with transaction.atomic():
+            CollectionMonthlyTotal.objects.filter(collection=collection).delete()
+            CollectionMonthlyTotal.objects.bulk_upsert(
+                CollectionMonthlyTotal(
+                    organisation_id=collection.organisation_id,
+                    collection=collection,
+                    on_user_list=total["on_user_list"],
+                    full_date=date(total["year"], total["month"], 1),
+                    total_links_added=total["total_links_added"],
+                    total_links_removed=total["total_links_removed"],
+                )
+                for total in archived_totals
+            )
+            CollectionMonthlyTotal.objects.refresh([collection.pk], months)
+
+        logger.info(
+            "Filled monthly totals for collection %d from %d archived and %d stored months",
+            collection.pk,
+            len({(total["year"], total["month"]) for total in archived_totals}),
+            len(months),
+        )
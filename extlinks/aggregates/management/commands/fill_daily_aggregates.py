@@ -0,0 +1,8 @@
+from extlinks.aggregates.management.helpers import DailyAggregateCommand
+
+
+class Command(DailyAggregateCommand):
+    help = (
+        "Adds aggregated data into the LinkAggregate, UserAggregate and "
+        "PageProjectAggregate tables from a single scan of LinkEvents"
+    )
@@ -126,14 +126,19 @@ class Command(BaseCommand):
             with transaction.atomic():
                 total_aggregations += len(batch)
                 logger.info(f"Processing batch {batch_index} (size: {len(batch)})")
-                for monthly_aggregation in batch:
-                    self._verify_and_save_aggregation(monthly_aggregation)
+                UserAggregate.objects.bulk_upsert(
+                    [
+                        self._verify_aggregation(monthly_aggregation)
+                        for monthly_aggregation in batch
+                    ],
+                    increment=True,
+                )
 
         logger.info(f"Processed a total of {total_aggregations} monthly aggregations")
 
-    def _verify_and_save_aggregation(self, monthly_aggregation):
+    def _verify_aggregation(self, monthly_aggregation):
         """
-        Saves the monthly aggregation and delete the daily ones.
+        Deletes the daily aggregations that make up a monthly aggregation.
         It also verifies if expected deletion count and actual deleted
         daily aggregations count match.
 
@@ -144,7 +149,9 @@ class Command(BaseCommand):
 
         Returns
         -------
-        None
+        UserAggregate
+            The unsaved monthly aggregation, to be added to any existing
+            monthly aggregation for the same month
         """
         expected_delete_count = monthly_aggregation["count"]
         deleted_count, _ = (
@@ -168,42 +175,18 @@ class Command(BaseCommand):
                 f"year={monthly_aggregation['year']}, month={monthly_aggregation['month']}",
             )
 
-        existing_monthly_aggregate = UserAggregate.objects.filter(
+        last_day_of_month = (
+            date(monthly_aggregation["year"], monthly_aggregation["month"], 1)
+            + relativedelta(months=1)
+            - timedelta(days=1)
+        )
+        return UserAggregate(
             organisation_id=monthly_aggregation["organisation_id"],
             collection_id=monthly_aggregation["collection_id"],
             username=monthly_aggregation["username"],
             on_user_list=monthly_aggregation["on_user_list"],
-            year=monthly_aggregation["year"],
-            month=monthly_aggregation["month"],
+            full_date=last_day_of_month,
             day=0,
-        )[:1]
-        existing_monthly_aggregate = (
-            existing_monthly_aggregate[0]
-            if len(existing_monthly_aggregate) > 0
-            else None
+            total_links_added=monthly_aggregation["monthly_total_links_added"],
+            total_links_removed=monthly_aggregation["monthly_total_links_removed"],
         )
-
-        if existing_monthly_aggregate:
-            existing_monthly_aggregate.total_links_added += monthly_aggregation[
-                "monthly_total_links_added"
-            ]
-            existing_monthly_aggregate.total_links_removed += monthly_aggregation[
-                "monthly_total_links_removed"
-            ]
-            existing_monthly_aggregate.save()
-        else:
-            last_day_of_month = (
-                date(monthly_aggregation["year"], monthly_aggregation["month"], 1)
-                + relativedelta(months=1)
-                - timedelta(days=1)
-            )
-            UserAggregate.objects.create(
-                organisation_id=monthly_aggregation["organisation_id"],
-                collection_id=monthly_aggregation["collection_id"],
-                username=monthly_aggregation["username"],
-                on_user_list=monthly_aggregation["on_user_list"],
-                full_date=last_day_of_month,
-                day=0,
-                total_links_added=monthly_aggregation["monthly_total_links_added"],
-                total_links_removed=monthly_aggregation["monthly_total_links_removed"],
-            )
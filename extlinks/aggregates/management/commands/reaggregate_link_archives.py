@@ -7,6 +7,7 @@ from datetime import datetime, timedelta, date
 from django.db import transaction
 
 from extlinks.aggregates.models import (
+    CollectionMonthlyTotal,
     LinkAggregate,
     PageProjectAggregate,
     UserAggregate,
@@ -98,7 +99,10 @@ class Command(BaseCommand):
                 )
                 return
             # otherwise, attempt re-aggregation
-            with transaction.atomic():
+            # The monthly totals keep the totals of the month's archived days.
+            with transaction.atomic(), CollectionMonthlyTotal.objects.refreshing(
+                [collection.pk for collection in collections], [last_day_of_month]
+            ):
                 self._process_monthly_aggregates(
                     directory, month_to_fix, organisation, url_patterns, last_day_of_month
                 )
@@ -113,7 +117,10 @@ class Command(BaseCommand):
                 )
                 return
             # otherwise, attempt re-aggregation
-            with transaction.atomic():
+            with transaction.atomic(), CollectionMonthlyTotal.objects.refreshing(
+                [collection.pk for collection in collections],
+                [datetime.fromisoformat(day_to_fix).date()],
+            ):
                 self._process_daily_aggregates(
                     collections, day_to_fix, directory, url_patterns
                 )
@@ -181,15 +188,17 @@ class Command(BaseCommand):
         -------
         bool: whether there are existing aggregates for a given day in object storage
         """
-        day_to_fix_formatted = (
-            datetime.fromisoformat(day_to_fix).date().strftime("%Y-%m-%d")
-        )
+        day = datetime.fromisoformat(day_to_fix).date()
+        day_to_fix_formatted = day.strftime("%Y-%m-%d")
+        # Consolidated archives hold every day of their month, and are named
+        # {prefix}_{organisation}_{collection}_{year}-{month}.json.gz
+        consolidated_suffix = f"_{day.strftime('%Y-%m')}.json.gz"
         return (
             len(
                 [
                     i
                     for i in existing_link_aggregates_in_object_storage
-                    if day_to_fix_formatted in i
+                    if day_to_fix_formatted in i or i.endswith(consolidated_suffix)
                 ]
             )
             > 0
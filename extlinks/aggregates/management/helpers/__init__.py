@@ -14,6 +14,10 @@ from extlinks.aggregates.models import (
 from extlinks.aggregates.management.helpers.aggregate_archive_command import (
     AggregateArchiveCommand,
 )
+from extlinks.aggregates.management.helpers.daily_aggregate_command import (
+    DailyAggregateCommand,
+    DailyAggregator,
+)
 
 
 def decode_archive(filename: str):
@@ -2,6 +2,7 @@ import datetime
 import gzip
 import logging
 import os
+import re
 
 from abc import ABC, abstractmethod
 from collections import defaultdict
@@ -11,15 +12,22 @@ from typing import List, Optional, Type, cast
 from django.core import serializers
 from django.core.management import call_command
 from django.core.management.base import CommandError, CommandParser
-from django.db import models, close_old_connections
+from django.db import models, close_old_connections, transaction
 
+from extlinks.aggregates import storage
 from extlinks.common import swift
+from extlinks.common.helpers import delete_in_batches
 from extlinks.common.management.commands import BaseCommand
 
 logger = logging.getLogger("django")
 
 CHUNK_SIZE = 10_000
 
+# {prefix}_{organisation}_{collection}_{year}-{month}.json.gz
+CONSOLIDATED_ARCHIVE_PATTERN = (
+    r"^aggregates_[a-z]+_[0-9]+_[0-9]+_[0-9]+-[0-9]{2}\.json\.gz$"
+)
+
 
 class AggregateArchiveCommand(ABC, BaseCommand):
     """
@@ -108,6 +116,28 @@ class AggregateArchiveCommand(ABC, BaseCommand):
             action="store_true",
             help="If enabled, archives will only be stored in Swift and deleted from local storage after upload.",
         )
+        dump_parser.add_argument(
+            "--consolidate",
+            action="store_true",
+            help="If enabled, a single archive is written per collection and month instead of one per date and user list.",
+        )
+        dump_parser.add_argument(
+            "--columnar",
+            action="store_true",
+            help="If enabled, consolidated archives are written with the compact columnar encoding. Implies --consolidate. These archives keep their .json.gz names but are not plain JSON.",
+        )
+        dump_parser.add_argument(
+            "--delete-batch-size",
+            type=int,
+            default=CHUNK_SIZE,
+            help=f"The number of archived {self.name} records deleted from the database at a time.",
+        )
+        dump_parser.add_argument(
+            "--delete-throttle",
+            type=float,
+            default=0.0,
+            help=f"The number of seconds to pause between batches of deleted {self.name} records.",
+        )
 
         load_parser = subparsers.add_parser(
             "load",
@@ -148,6 +178,10 @@ class AggregateArchiveCommand(ABC, BaseCommand):
                 output=options["output"],
                 container=options["container"],
                 object_storage_only=options["object_storage_only"],
+                consolidate=options["consolidate"] or options["columnar"],
+                columnar=options["columnar"],
+                delete_batch_size=options["delete_batch_size"],
+                delete_throttle=options["delete_throttle"],
             )
         elif subcommand == "load":
             self.load(filenames=options["filenames"])
@@ -163,6 +197,10 @@ class AggregateArchiveCommand(ABC, BaseCommand):
         output: Optional[str] = None,
         container: Optional[str] = None,
         object_storage_only=False,
+        consolidate=False,
+        columnar=False,
+        delete_batch_size=CHUNK_SIZE,
+        delete_throttle=0.0,
     ):
         """
         Dump aggregate data to gzipped JSON files that are grouped by month,
@@ -185,6 +223,19 @@ class AggregateArchiveCommand(ABC, BaseCommand):
         object_storage_only : bool, optional
             If enabled, archives will only be stored in Swift and deleted from
             local storage after upload.
+
+        consolidate : bool, optional
+            If enabled, one consolidated archive is written per collection and
+            month.
+
+        columnar : bool, optional
+            If enabled, consolidated archives use the columnar encoding.
+
+        delete_batch_size : int, optional
+            The number of archived records deleted from the database at a time.
+
+        delete_throttle : float, optional
+            The number of seconds to pause between batches of deleted records.
         """
 
         # Pick the earliest possible date if one is not provided on the CLI.
@@ -213,7 +264,9 @@ class AggregateArchiveCommand(ABC, BaseCommand):
             cursor = start
 
             while cursor <= end:
-                archives = self.archive(cursor, output=output)
+                archives = self.archive(
+                    cursor, output=output, consolidate=consolidate, columnar=columnar
+                )
                 cursor += relativedelta(months=1)
 
                 # Upload archives to object storage if a container was specified.
@@ -223,7 +276,9 @@ class AggregateArchiveCommand(ABC, BaseCommand):
                     if object_storage_only:
                         self._remove_archives(archives)
         else:
-            archives = self.archive(start, output=output)
+            archives = self.archive(
+                start, output=output, consolidate=consolidate, columnar=columnar
+            )
 
             # Upload archives to object storage if a container was specified.
             if container and len(archives) > 0:
@@ -239,10 +294,10 @@ class AggregateArchiveCommand(ABC, BaseCommand):
             cursor = start
 
             while cursor <= end:
-                self.delete(cursor)
+                self.delete(cursor, delete_batch_size, delete_throttle)
                 cursor += relativedelta(months=1)
         else:
-            self.delete(start)
+            self.delete(start, delete_batch_size, delete_throttle)
 
     def load(self, filenames: List[str]):
         """
@@ -261,8 +316,29 @@ class AggregateArchiveCommand(ABC, BaseCommand):
         for filename in sorted(filenames):
             self.log_msg("Loading %s...", filename)
 
-            # loaddata supports gzipped fixtures and handles relationships properly.
-            call_command("loaddata", filename)
+            if re.match(CONSOLIDATED_ARCHIVE_PATTERN, os.path.basename(filename)):
+                self._load_consolidated(filename)
+            else:
+                # loaddata supports gzipped fixtures and handles relationships
+                # properly.
+                call_command("loaddata", filename)
+
+    def _load_consolidated(self, filename: str):
+        """
+        Import data from a consolidated archive, which loaddata can't read.
+
+        Parameters
+        ----------
+        filename : str
+            The consolidated archive to load into the database.
+        """
+
+        with open(filename, "rb") as archive:
+            records = storage.decode_archive(archive.read())
+
+        with transaction.atomic():
+            for deserialized in serializers.deserialize("python", records):
+                deserialized.save()
 
     def upload(self, container: str, filenames: List[str]):
         """
@@ -302,6 +378,20 @@ class AggregateArchiveCommand(ABC, BaseCommand):
 
             successful, failed = swift.batch_upload_files(conn, container, filenames)
 
+            # Make the new archives visible to the organisation pages. The
+            # prefixes come from the filenames, as upload_all_archived_aggregates
+            # uploads every kind of archive through one command.
+            prefixes = {
+                match.group(1)
+                for match in (
+                    re.match(r"^(aggregates_[a-z]+)_", os.path.basename(filename))
+                    for filename in successful
+                )
+                if match
+            }
+            for prefix in sorted(prefixes):
+                storage.invalidate_archive_catalog(prefix)
+
             self.log_msg(
                 "Uploaded %d/%d archives to object storage",
                 len(successful),
@@ -320,6 +410,8 @@ class AggregateArchiveCommand(ABC, BaseCommand):
         self,
         date: datetime.date,
         output: Optional[str] = None,
+        consolidate=False,
+        columnar=False,
     ) -> List[str]:
         """
         Archives a month's worth of data defined by 'date' and returns a list
@@ -333,6 +425,13 @@ class AggregateArchiveCommand(ABC, BaseCommand):
         output : str, optional
             The directory to output the archives to. If not provided, the
             archives will be output to $HOST_BACKUP_DIR.
+
+        consolidate : bool, optional
+            If enabled, one consolidated archive is written per collection
+            instead of one per date and user list.
+
+        columnar : bool, optional
+            If enabled, consolidated archives use the columnar encoding.
         """
 
         AggregateModel = self.get_model()
@@ -353,6 +452,9 @@ class AggregateArchiveCommand(ABC, BaseCommand):
             )
             return archives
 
+        if consolidate:
+            return self._archive_consolidated(date, results, output_dir, columnar)
+
         # Split by: organisation, collection, full_date, on_user_list (limit only)
         splits = defaultdict(list)
 
@@ -394,7 +496,63 @@ class AggregateArchiveCommand(ABC, BaseCommand):
 
         return archives
 
-    def delete(self, date: datetime.date):
+    def _archive_consolidated(
+        self,
+        date: datetime.date,
+        results: List[models.Model],
+        output_dir: str,
+        columnar=False,
+    ) -> List[str]:
+        """
+        Writes one consolidated archive per collection for a month's worth of
+        aggregates and returns the archives that were generated.
+        """
+
+        encode = (
+            storage.encode_columnar_archive
+            if columnar
+            else storage.encode_consolidated_archive
+        )
+
+        archives: List[str] = []
+
+        # Split by: organisation, collection
+        splits = defaultdict(list)
+        for record in results:
+            splits[(record.organisation_id, record.collection_id)].append(record)
+
+        for (organisation_id, collection_id), records in splits.items():
+            filename = os.path.join(
+                output_dir,
+                storage.consolidated_archive_name(
+                    f"aggregates_{self.name.lower()}",
+                    organisation_id,
+                    collection_id,
+                    date,
+                ),
+            )
+            self.log_msg(
+                "Dumping %d %s records into %s",
+                len(records),
+                self.name,
+                filename,
+            )
+            with open(filename, "wb") as archive:
+                archive.write(
+                    encode(
+                        organisation_id,
+                        collection_id,
+                        date,
+                        serializers.serialize("python", records),
+                    )
+                )
+            archives.append(filename)
+
+        return archives
+
+    def delete(
+        self, date: datetime.date, batch_size=CHUNK_SIZE, throttle: float = 0.0
+    ):
         """
         Deletes the given month's aggregates.
 
@@ -402,6 +560,12 @@ class AggregateArchiveCommand(ABC, BaseCommand):
         ----------
         date : datetime.date
             The date of the month to delete aggregates for in the database.
+
+        batch_size : int, optional
+            The number of aggregates deleted at a time.
+
+        throttle : float, optional
+            The number of seconds to pause between batches.
         """
 
         AggregateModel = self.get_model()
@@ -416,9 +580,7 @@ class AggregateArchiveCommand(ABC, BaseCommand):
                 date.strftime("%Y-%m"),
             )
 
-        while query_set.exists():
-            delete_query_set = query_set[:CHUNK_SIZE].values_list("id", flat=True)
-            AggregateModel.objects.filter(pk__in=list(delete_query_set)).delete()
+        delete_in_batches(query_set, batch_size=batch_size, throttle=throttle)
 
     @abstractmethod
     def get_model(self) -> Type[models.Model]:
@@ -0,0 +1,525 @@
+import logging
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple, Type
+
+import django
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import CommandError
+from django.db import close_old_connections, connections, transaction
+from django.db.models import Max, Q
+from django.db.models.fields import DateField
+from django.db.models.functions import Cast
+from django.utils.timezone import now
+
+from extlinks.common.management.commands import BaseCommand
+from extlinks.aggregates.models import (
+    AggregateWatermark,
+    CollectionMonthlyTotal,
+    LinkAggregate,
+    PageProjectAggregate,
+    UserAggregate,
+)
+from extlinks.links.models import LinkEvent, URLPattern
+from extlinks.organisations.models import Collection
+
+logger = logging.getLogger("django")
+
+BATCH_SIZE = 1000
+
+# The fields that, along with organisation, collection, full_date and
+# on_user_list, identify a daily row of each aggregate model. Changing these
+# should also impact the monthly aggregation commands.
+AGGREGATE_KEY_FIELDS = {
+    LinkAggregate: (),
+    UserAggregate: ("username",),
+    PageProjectAggregate: ("project_name", "page_name"),
+}
+
+
+def get_last_link_event_id() -> Optional[int]:
+    return LinkEvent.objects.aggregate(last=Max("id"))["last"]
+
+
+def aggregate_collections(
+    aggregate_models: Iterable[Type],
+    collection_ids: List[int],
+    last_link_event_id: int,
+) -> List[int]:
+    """
+    Aggregates a share of the collections in a worker process.
+
+    If aggregating them together fails, each collection is retried on its
+    own so that one failing collection doesn't hold back the others. The
+    watermarks make it safe to retry collections that were partly written.
+
+    Only the events of the share's collections are read, so that the workers
+    split the scan between them rather than each scanning every new event.
+
+    Returns
+    -------
+    List[int]
+        The ids of the collections that couldn't be aggregated.
+    """
+    aggregator = DailyAggregator(aggregate_models)
+    failed = []
+    try:
+        collections = list(
+            Collection.objects.filter(pk__in=collection_ids).order_by("pk")
+        )
+        try:
+            aggregator.run(collections, last_link_event_id, restrict=True)
+        except Exception:
+            logger.exception("Aggregating collections %s failed", collection_ids)
+            for collection in collections:
+                try:
+                    aggregator.run(
+                        [collection], last_link_event_id, restrict=True
+                    )
+                except Exception:
+                    logger.exception(
+                        "Aggregating collection %d failed", collection.pk
+                    )
+                    failed.append(collection.pk)
+    finally:
+        connections.close_all()
+
+    return failed
+
+
+def _init_worker():
+    # Workers that aren't forked from the command need Django set up, and
+    # those that are must not reuse the command's database connections.
+    django.setup()
+    connections.close_all()
+
+
+class DailyAggregator:
+    """
+    Fills the daily LinkAggregate, UserAggregate and PageProjectAggregate
+    rows incrementally.
+
+    Each collection has a watermark per aggregate type: the id of the last
+    LinkEvent counted into those aggregates. A run only counts the events
+    after it, up to the newest event when the run started, adds them into
+    the existing rows and moves the watermark on in the same transaction.
+    Collections that share a watermark, which is normally all of them, are
+    counted from a single scan of LinkEvents.
+
+    A collection that has no watermark yet is recounted from the latest day
+    it has daily aggregates for, replacing those days' rows.
+    """
+
+    def __init__(self, aggregate_models: Iterable[Type] = tuple(AGGREGATE_KEY_FIELDS)):
+        self.aggregate_models = list(aggregate_models)
+
+    def run(
+        self,
+        collections: Optional[List[Collection]] = None,
+        last_link_event_id: Optional[int] = None,
+        restrict: bool = False,
+    ):
+        """
+        Aggregates every new LinkEvent for the given collections.
+
+        Parameters
+        ----------
+        collections : List[Collection]|None
+            The collections to aggregate, which must all have an
+            organisation. Every collection with an organisation if None.
+
+        last_link_event_id : int|None
+            Count events up to this id. The newest event's if None.
+
+        restrict : bool
+            Only read the events of the given collections, rather than every
+            new event, even when they all start from the same place.
+        """
+        if collections is None:
+            collections = list(Collection.objects.exclude(organisation__isnull=True))
+        if not collections:
+            return
+
+        if last_link_event_id is None:
+            last_link_event_id = get_last_link_event_id()
+        if last_link_event_id is None:
+            return
+
+        starts = self._get_starts(collections)
+        for start, model_collections in starts.items():
+            self._aggregate(
+                start,
+                model_collections,
+                last_link_event_id,
+                # Only scan the URL patterns of collections that are behind.
+                restrict=restrict or len(starts) > 1,
+            )
+
+    def _get_starts(
+        self, collections: List[Collection]
+    ) -> Dict[Tuple, Dict[Type, List[Collection]]]:
+        """
+        Groups the collections to aggregate into each model by where
+        counting should start for them.
+
+        Returns
+        -------
+        dict
+            Maps ("id", last LinkEvent id counted) or ("date", first day to
+            recount, or None for every day) to the collections to count into
+            each aggregate model from there.
+        """
+        aggregate_types = [model.__name__ for model in self.aggregate_models]
+        watermarks = {
+            (collection_id, aggregate_type): last_link_event_id
+            for collection_id, aggregate_type, last_link_event_id in AggregateWatermark.objects.filter(
+                collection__in=collections, aggregate_type__in=aggregate_types
+            ).values_list(
+                "collection_id", "aggregate_type", "last_link_event_id"
+            )
+        }
+
+        starts = defaultdict(lambda: defaultdict(list))
+        for model in self.aggregate_models:
+            untracked = [
+                collection
+                for collection in collections
+                if (collection.pk, model.__name__) not in watermarks
+            ]
+            first_dates = self._get_first_dates(model, untracked) if untracked else {}
+
+            for collection in collections:
+                last_link_event_id = watermarks.get((collection.pk, model.__name__))
+                if last_link_event_id is None:
+                    start = ("date", first_dates.get(collection.pk))
+                else:
+                    start = ("id", last_link_event_id)
+                starts[start][model].append(collection)
+
+        return starts
+
+    def _get_first_dates(
+        self, model: Type, collections: List[Collection]
+    ) -> Dict[int, date]:
+        """
+        Finds the first day to recount for collections that were aggregated
+        before watermarks were recorded: their latest daily aggregate, or the
+        day after their latest monthly one.
+        """
+        daily = dict(
+            model.objects.filter(collection__in=collections)
+            .exclude(day=0)
+            .values("collection_id")
+            .annotate(latest=Max("full_date"))
+            .values_list("collection_id", "latest")
+        )
+        monthly = dict(
+            model.objects.filter(collection__in=collections, day=0)
+            .values("collection_id")
+            .annotate(latest=Max("full_date"))
+            .values_list("collection_id", "latest")
+        )
+
+        first_dates = {}
+        for collection in collections:
+            if collection.pk in daily:
+                first_dates[collection.pk] = daily[collection.pk]
+            elif collection.pk in monthly:
+                first_dates[collection.pk] = monthly[collection.pk] + timedelta(days=1)
+        return first_dates
+
+    def _aggregate(
+        self,
+        start: Tuple,
+        model_collections: Dict[Type, List[Collection]],
+        last_link_event_id: int,
+        restrict: bool = False,
+    ):
+        """
+        Counts the events from start up to last_link_event_id into each
+        model's collections, and moves their watermarks to
+        last_link_event_id.
+        """
+        kind, value = start
+
+        collections = {}
+        collection_models = defaultdict(list)
+        for model, model_collection_list in model_collections.items():
+            for collection in model_collection_list:
+                collections[collection.pk] = collection
+                collection_models[collection.pk].append(model)
+
+        link_event_filter = Q(id__lte=last_link_event_id)
+        if kind == "id":
+            link_event_filter &= Q(id__gt=value)
+        elif value is not None:
+            link_event_filter &= Q(
+                timestamp__gte=datetime(value.year, value.month, value.day, 0, 0, 0)
+            )
+
+        url_pattern_collections = self._get_url_pattern_collections(
+            list(collections.values())
+        )
+        if restrict:
+            link_event_filter &= LinkEvent.objects.collections_filter(
+                collections, url_pattern_collections
+            )
+
+        if url_pattern_collections:
+            totals = self._count(
+                link_event_filter, url_pattern_collections, collection_models
+            )
+        else:
+            totals = defaultdict(dict)
+
+        for model, model_collection_list in model_collections.items():
+            with transaction.atomic():
+                # Recounted days replace what was there, new events are
+                # added to it.
+                self._write(model, totals[model], increment=kind == "id")
+                self._save_watermarks(
+                    model,
+                    model_collection_list,
+                    last_link_event_id,
+                    exists=kind == "id",
+                )
+
+    def _get_url_pattern_collections(
+        self, collections: List[Collection]
+    ) -> Dict[int, List[Tuple[int, int]]]:
+        """
+        Maps each URL pattern id to the (collection id, organisation id) of
+        each collection it belongs to.
+        """
+        organisations = {
+            collection.pk: collection.organisation_id for collection in collections
+        }
+
+        url_pattern_collections = defaultdict(list)
+        for url_pattern_id, collection_id in URLPattern.collections.through.objects.filter(
+            collection_id__in=organisations
+        ).values_list("urlpattern_id", "collection_id"):
+            url_pattern_collections[url_pattern_id].append(
+                (collection_id, organisations[collection_id])
+            )
+
+        # Collections that haven't been moved to the collections relationship
+        # yet still use the legacy collection field.
+        linked_collections = {
+            collection_id
+            for links in url_pattern_collections.values()
+            for collection_id, _ in links
+        }
+        for url_pattern_id, collection_id in URLPattern.objects.filter(
+            collection_id__in=set(organisations) - linked_collections
+        ).values_list("pk", "collection_id"):
+            url_pattern_collections[url_pattern_id].append(
+                (collection_id, organisations[collection_id])
+            )
+
+        return url_pattern_collections
+
+    def _count(
+        self,
+        link_event_filter: Q,
+        url_pattern_collections: Dict[int, List[Tuple[int, int]]],
+        collection_models: Dict[int, List[Type]],
+    ) -> Dict[Type, Dict[Tuple, List[int]]]:
+        totals = {model: defaultdict(lambda: [0, 0]) for model in self.aggregate_models}
+
+        link_events = (
+            LinkEvent.objects.filter(
+                link_event_filter,
+                content_type=ContentType.objects.get_for_model(URLPattern),
+            )
+            .annotate(timestamp_date=Cast("timestamp", DateField()))
+            .values_list(
+                "object_id",
+                "timestamp_date",
+                "on_user_list",
+                "change",
+                "username__username",
+                "domain",
+                "page_title",
+            )
+        )
+
+        for (
+            url_pattern_id,
+            full_date,
+            on_user_list,
+            change,
+            username,
+            domain,
+            page_title,
+        ) in link_events.iterator(chunk_size=BATCH_SIZE):
+            links = url_pattern_collections.get(url_pattern_id)
+            if not links or full_date is None:
+                continue
+            column = 0 if change == LinkEvent.ADDED else 1
+
+            for collection_id, organisation_id in links:
+                key = (organisation_id, collection_id, full_date, on_user_list)
+                for model in collection_models[collection_id]:
+                    if model is UserAggregate:
+                        if username is None:
+                            continue
+                        totals[model][key + (username,)][column] += 1
+                    elif model is PageProjectAggregate:
+                        totals[model][key + (domain, page_title)][column] += 1
+                    else:
+                        totals[model][key][column] += 1
+
+        return totals
+
+    def _write(self, model, totals: Dict[Tuple, List[int]], increment: bool):
+        """
+        Creates a daily row of the given aggregate model for each of the
+        counted totals, or adds them to (if increment) or replaces those of
+        the existing row.
+        """
+        key_fields = (
+            "organisation_id",
+            "collection_id",
+            "full_date",
+            "on_user_list",
+        ) + AGGREGATE_KEY_FIELDS[model]
+
+        # The monthly totals keep the totals of the month's archived days.
+        if model is LinkAggregate:
+            refreshing = CollectionMonthlyTotal.objects.refreshing(
+                {key[1] for key in totals}, {key[2] for key in totals}
+            )
+        else:
+            refreshing = nullcontext()
+
+        with refreshing:
+            written = model.objects.bulk_upsert(
+                (
+                    model(
+                        total_links_added=links_added,
+                        total_links_removed=links_removed,
+                        **dict(zip(key_fields, key)),
+                    )
+                    for key, (links_added, links_removed) in totals.items()
+                ),
+                increment=increment,
+                batch_size=BATCH_SIZE,
+            )
+
+        logger.info("Wrote %d %s rows", written, model.__name__)
+
+    def _save_watermarks(
+        self,
+        model,
+        collections: List[Collection],
+        last_link_event_id: int,
+        exists: bool,
+    ):
+        aggregate_type = model.__name__
+        if exists:
+            AggregateWatermark.objects.filter(
+                collection__in=collections, aggregate_type=aggregate_type
+            ).update(last_link_event_id=last_link_event_id, updated_at=now())
+        else:
+            AggregateWatermark.objects.bulk_create(
+                [
+                    AggregateWatermark(
+                        collection=collection,
+                        aggregate_type=aggregate_type,
+                        last_link_event_id=last_link_event_id,
+                    )
+                    for collection in collections
+                ]
+            )
+
+
+class DailyAggregateCommand(BaseCommand):
+    """
+    DailyAggregateCommand is a helper class for the commands that fill daily
+    aggregate tables. Subclasses set 'aggregate_models' to the models they
+    fill, and all of them are filled from a single scan of new LinkEvents.
+    """
+
+    help = "Adds aggregated data into the daily aggregate tables"
+    aggregate_models = tuple(AGGREGATE_KEY_FIELDS)
+
+    def add_arguments(self, parser):
+        # Named (optional) arguments
+        parser.add_argument(
+            "--collections",
+            nargs="+",
+            type=int,
+            help="A list of collection IDs that will be processed instead of every collection",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Split the collections across this many worker processes",
+        )
+
+    def _handle(self, *args, **options):
+        collections = None
+        if options["collections"]:
+            collections = []
+            for col_id in options["collections"]:
+                collection = Collection.objects.filter(
+                    pk=col_id, organisation__isnull=False
+                ).first()
+                if collection is None:
+                    raise CommandError(f"Collection '{col_id}' does not exist")
+                collections.append(collection)
+
+        if options["workers"] > 1:
+            self._run_workers(collections, options["workers"])
+        else:
+            DailyAggregator(self.aggregate_models).run(collections)
+
+        close_old_connections()
+
+    def _run_workers(self, collections: Optional[List[Collection]], workers: int):
+        """
+        Aggregates the collections in a pool of worker processes, each with
+        its own database connection.
+
+        Collections are dealt out to the workers in id order and every
+        worker counts up to the same LinkEvent, so the result doesn't depend
+        on how the workers are scheduled.
+        """
+        if collections is None:
+            collections = Collection.objects.exclude(organisation__isnull=True)
+        collection_ids = sorted(collection.pk for collection in collections)
+        last_link_event_id = get_last_link_event_id()
+        if not collection_ids or last_link_event_id is None:
+            return
+
+        shards = [
+            collection_ids[i::workers]
+            for i in range(min(workers, len(collection_ids)))
+        ]
+
+        # Don't share our connections with forked workers.
+        connections.close_all()
+        failed = []
+        with ProcessPoolExecutor(
+            max_workers=len(shards), initializer=_init_worker
+        ) as executor:
+            futures = [
+                executor.submit(
+                    aggregate_collections,
+                    self.aggregate_models,
+                    shard,
+                    last_link_event_id,
+                )
+                for shard in shards
+            ]
+            for future in futures:
+                failed.extend(future.result())
+
+        if failed:
+            raise CommandError(
+                f"Failed to aggregate collections {', '.join(map(str, sorted(failed)))}"
+            )
@@ -0,0 +1,75 @@
+# Generated by Django 4.2.30 on 2026-10-17 04:16
+
+from django.db import migrations, models
+from django.db.models import Count
+
+AGGREGATE_KEYS = {
+    "LinkAggregate": [
+        "organisation",
+        "collection",
+        "full_date",
+        "on_user_list",
+        "day",
+    ],
+    "UserAggregate": [
+        "organisation",
+        "collection",
+        "username",
+        "full_date",
+        "on_user_list",
+        "day",
+    ],
+    "PageProjectAggregate": [
+        "organisation",
+        "collection",
+        "project_name",
+        "page_name",
+        "full_date",
+        "on_user_list",
+        "day",
+    ],
+}
+
+
+def merge_duplicate_aggregates(apps, schema_editor):
+    """
+    Uniqueness used to be checked before each save, so concurrent jobs could
+    still create duplicate rows, each counting the same events. Keep the most
+    recently updated row of each set of duplicates and delete the others, as
+    summing them would double count those events.
+    """
+    for model_name, key in AGGREGATE_KEYS.items():
+        model = apps.get_model("aggregates", model_name)
+        duplicates = (
+            model.objects.values(*key)
+            .annotate(count=Count("id"))
+            .filter(count__gt=1)
+            .order_by()
+        )
+        for duplicate in list(duplicates):
+            rows = model.objects.filter(**{field: duplicate[field] for field in key})
+            newest = rows.order_by("-updated_at", "-id").first()
+            rows.exclude(id=newest.id).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aggregates', '0012_programtopuserstotal_programtopprojectstotal_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_aggregates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='linkaggregate',
+            constraint=models.UniqueConstraint(fields=('organisation', 'collection', 'full_date', 'on_user_list', 'day'), name='unique_linkaggregate'),
+        ),
+        migrations.AddConstraint(
+            model_name='pageprojectaggregate',
+            constraint=models.UniqueConstraint(fields=('organisation', 'collection', 'project_name', 'page_name', 'full_date', 'on_user_list', 'day'), name='unique_pageprojectaggregate'),
+        ),
+        migrations.AddConstraint(
+            model_name='useraggregate',
+            constraint=models.UniqueConstraint(fields=('organisation', 'collection', 'username', 'full_date', 'on_user_list', 'day'), name='unique_useraggregate'),
+        ),
+    ]
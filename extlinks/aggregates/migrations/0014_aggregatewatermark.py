@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-17 04:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('organisations', '0009_organisation_username_list_updated'),
+        ('aggregates', '0013_aggregate_unique_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AggregateWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('aggregate_type', models.CharField(max_length=32)),
+                ('last_link_event_id', models.PositiveBigIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('collection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='organisations.collection')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='aggregatewatermark',
+            constraint=models.UniqueConstraint(fields=('collection', 'aggregate_type'), name='unique_aggregatewatermark'),
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 4.2.30 on 2026-10-17 04:25
+
+import datetime
+
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+
+def fill_collection_monthly_totals(apps, schema_editor):
+    """
+    Fills the monthly totals from the LinkAggregates in the database. Months
+    that have been archived are added by fill_collection_monthly_totals.
+    """
+    LinkAggregate = apps.get_model("aggregates", "LinkAggregate")
+    CollectionMonthlyTotal = apps.get_model("aggregates", "CollectionMonthlyTotal")
+
+    totals = (
+        LinkAggregate.objects.values(
+            "organisation_id", "collection_id", "on_user_list", "year", "month"
+        )
+        .annotate(
+            links_added=Sum("total_links_added"),
+            links_removed=Sum("total_links_removed"),
+        )
+        .order_by()
+    )
+    CollectionMonthlyTotal.objects.bulk_create(
+        (
+            CollectionMonthlyTotal(
+                organisation_id=total["organisation_id"],
+                collection_id=total["collection_id"],
+                on_user_list=total["on_user_list"],
+                full_date=datetime.date(total["year"], total["month"], 1),
+                total_links_added=total["links_added"],
+                total_links_removed=total["links_removed"],
+            )
+            for total in totals.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('organisations', '0009_organisation_username_list_updated'),
+        ('aggregates', '0014_aggregatewatermark'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CollectionMonthlyTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('full_date', models.DateField()),
+                ('on_user_list', models.BooleanField(default=False)),
+                ('total_links_added', models.PositiveIntegerField()),
+                ('total_links_removed', models.PositiveIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('collection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='organisations.collection')),
+                ('organisation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='organisations.organisation')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='collectionmonthlytotal',
+            constraint=models.UniqueConstraint(fields=('collection', 'full_date', 'on_user_list'), name='unique_collectionmonthlytotal'),
+        ),
+        migrations.RunPython(fill_collection_monthly_totals, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,152 @@
-from django.db import models
-from django.core.exceptions import ValidationError
+from contextlib import contextmanager
+from datetime import date
+from typing import Dict, Iterable, Tuple
+
+from django.db import connections, models
+from django.db.models import Q, Sum
 
 from extlinks.organisations.models import Collection, Organisation, User
 from extlinks.programs.models import Program
 
+BULK_UPSERT_BATCH_SIZE = 1000
+
+
+class AggregateManager(models.Manager):
+    def bulk_upsert(
+        self,
+        aggregates: Iterable[models.Model],
+        increment: bool = False,
+        batch_size: int = BULK_UPSERT_BATCH_SIZE,
+    ) -> int:
+        """
+        Inserts aggregates in bulk, updating the totals of any row that
+        already exists with the same key instead.
+
+        Parameters
+        ----------
+        aggregates : Iterable[LinkAggregate|UserAggregate|PageProjectAggregate]
+            Unsaved aggregates. Those with day=0 are monthly aggregates.
+
+        increment : bool
+            Add the totals to those of existing rows rather than replacing
+            them, e.g. when rolling daily rows up into monthly ones.
+
+        batch_size : int
+            How many rows to send in each INSERT.
+
+        Returns
+        -------
+        int
+            The number of distinct rows inserted or updated.
+        """
+        key_fields = [
+            self.model._meta.get_field(name).attname
+            for name in self._unique_constraint().fields
+        ]
+
+        # A statement can't touch the same row twice, so merge aggregates
+        # that share a key first.
+        rows = {}
+        for aggregate in aggregates:
+            self._set_dates(aggregate)
+
+            key = tuple(getattr(aggregate, field) for field in key_fields)
+            existing = rows.get(key)
+            if increment and existing is not None:
+                existing.total_links_added += aggregate.total_links_added
+                existing.total_links_removed += aggregate.total_links_removed
+            else:
+                rows[key] = aggregate
+
+        rows = list(rows.values())
+        for i in range(0, len(rows), batch_size):
+            if increment:
+                self._increment(rows[i : i + batch_size])
+            else:
+                self._replace(rows[i : i + batch_size])
+
+        return len(rows)
+
+    def _set_dates(self, aggregate: models.Model):
+        # Like save(), but keeping day=0 for monthly aggregates.
+        if aggregate.day is None or aggregate.day != 0:
+            aggregate.day = aggregate.full_date.day
+        aggregate.month = aggregate.full_date.month
+        aggregate.year = aggregate.full_date.year
+
+    def _unique_constraint(self) -> models.UniqueConstraint:
+        for constraint in self.model._meta.constraints:
+            if isinstance(constraint, models.UniqueConstraint):
+                return constraint
+        raise TypeError(f"{self.model.__name__} has no unique constraint")
+
+    def _replace(self, rows):
+        connection = connections[self.db]
+        unique_fields = None
+        # MySQL's ON DUPLICATE KEY UPDATE doesn't take a conflict target.
+        if connection.features.supports_update_conflicts_with_target:
+            unique_fields = self._unique_constraint().fields
+
+        self.bulk_create(
+            rows,
+            update_conflicts=True,
+            update_fields=["total_links_added", "total_links_removed", "updated_at"],
+            unique_fields=unique_fields,
+        )
+
+    def _increment(self, rows):
+        # The ORM can only overwrite conflicting rows' values, so build the
+        # INSERT ourselves to add to them instead.
+        connection = connections[self.db]
+        meta = self.model._meta
+        quote = connection.ops.quote_name
+        fields = [field for field in meta.concrete_fields if not field.primary_key]
+        table = quote(meta.db_table)
+
+        params = []
+        for aggregate in rows:
+            for field in fields:
+                params.append(
+                    field.get_db_prep_save(
+                        field.pre_save(aggregate, add=True), connection
+                    )
+                )
+
+        columns = ", ".join(quote(field.column) for field in fields)
+        placeholders = ", ".join(
+            ["(" + ", ".join(["%s"] * len(fields)) + ")"] * len(rows)
+        )
+        added = quote("total_links_added")
+        removed = quote("total_links_removed")
+        updated_at = quote("updated_at")
+
+        if connection.vendor == "mysql":
+            # We run on MariaDB, which still supports VALUES() here and has no
+            # MySQL 8.0.19+ "INSERT ... AS new" row alias to replace it with.
+            on_conflict = (
+                f"ON DUPLICATE KEY UPDATE "
+                f"{added} = {added} + VALUES({added}), "
+                f"{removed} = {removed} + VALUES({removed}), "
+                f"{updated_at} = VALUES({updated_at})"
+            )
+        else:
+            key_columns = ", ".join(
+                quote(meta.get_field(name).column)
+                for name in self._unique_constraint().fields
+            )
+            on_conflict = (
+                f"ON CONFLICT ({key_columns}) DO UPDATE SET "
+                f"{added} = {table}.{added} + EXCLUDED.{added}, "
+                f"{removed} = {table}.{removed} + EXCLUDED.{removed}, "
+                f"{updated_at} = EXCLUDED.{updated_at}"
+            )
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} ({columns}) VALUES {placeholders} {on_conflict}",
+                params,
+            )
+
 
 class LinkAggregate(models.Model):
     class Meta:
@@ -22,6 +165,22 @@ class LinkAggregate(models.Model):
                 ]
             ),
         ]
+        constraints = [
+            # day is 0 for monthly aggregates, which can share a full_date
+            # with the last daily aggregate of the month.
+            models.UniqueConstraint(
+                fields=[
+                    "organisation",
+                    "collection",
+                    "full_date",
+                    "on_user_list",
+                    "day",
+                ],
+                name="unique_linkaggregate",
+            ),
+        ]
+
+    objects = AggregateManager()
 
     organisation = models.ForeignKey(Organisation, on_delete=models.CASCADE)
     collection = models.ForeignKey(
@@ -46,21 +205,6 @@ class LinkAggregate(models.Model):
             self.full_clean(validate_unique=True)
         super().save(*args, **kwargs)
 
-    def validate_unique(self, *args, **kwargs):
-        super(LinkAggregate, self).validate_unique(*args, **kwargs)
-
-        if self.__class__.objects.filter(
-            organisation=self.organisation,
-            collection=self.collection,
-            full_date=self.full_date,
-            on_user_list=self.on_user_list,
-            day=self.day,  # day can be 0 if the aggregation is a monthly one
-        ).exists():
-            raise ValidationError(
-                message="LinkAggregate with this combination (organisation, collection, full_date, on_user_list) already exists.",
-                code="unique_together",
-            )
-
 
 class UserAggregate(models.Model):
     class Meta:
@@ -82,6 +226,23 @@ class UserAggregate(models.Model):
             models.Index(fields=["organisation", "username"]),
             models.Index(fields=["collection", "username"]),
         ]
+        constraints = [
+            # day is 0 for monthly aggregates, which can share a full_date
+            # with the last daily aggregate of the month.
+            models.UniqueConstraint(
+                fields=[
+                    "organisation",
+                    "collection",
+                    "username",
+                    "full_date",
+                    "on_user_list",
+                    "day",
+                ],
+                name="unique_useraggregate",
+            ),
+        ]
+
+    objects = AggregateManager()
 
     organisation = models.ForeignKey(Organisation, on_delete=models.CASCADE)
     collection = models.ForeignKey(
@@ -107,22 +268,6 @@ class UserAggregate(models.Model):
             self.full_clean(validate_unique=True)
         super().save(*args, **kwargs)
 
-    def validate_unique(self, *args, **kwargs):
-        super().validate_unique(*args, **kwargs)
-
-        if self.__class__.objects.filter(
-            organisation=self.organisation,
-            collection=self.collection,
-            username=self.username,
-            full_date=self.full_date,
-            on_user_list=self.on_user_list,
-            day=self.day,  # day can be 0 if the aggregation is a monthly one
-        ).exists():
-            raise ValidationError(
-                message="UserAggregate with this combination (organisation, collection, username, full_date, on_user_list) already exists.",
-                code="unique_together",
-            )
-
 
 class PageProjectAggregate(models.Model):
     class Meta:
@@ -148,6 +293,24 @@ class PageProjectAggregate(models.Model):
             models.Index(fields=["organisation", "project_name"]),
             models.Index(fields=["collection", "project_name", "page_name"]),
         ]
+        constraints = [
+            # day is 0 for monthly aggregates, which can share a full_date
+            # with the last daily aggregate of the month.
+            models.UniqueConstraint(
+                fields=[
+                    "organisation",
+                    "collection",
+                    "project_name",
+                    "page_name",
+                    "full_date",
+                    "on_user_list",
+                    "day",
+                ],
+                name="unique_pageprojectaggregate",
+            ),
+        ]
+
+    objects = AggregateManager()
 
     organisation = models.ForeignKey(Organisation, on_delete=models.CASCADE)
     collection = models.ForeignKey(
@@ -174,22 +337,188 @@ class PageProjectAggregate(models.Model):
             self.full_clean(validate_unique=True)
         super().save(*args, **kwargs)
 
-    def validate_unique(self, *args, **kwargs):
-        super().validate_unique(*args, **kwargs)
-
-        if self.__class__.objects.filter(
-            organisation=self.organisation,
-            collection=self.collection,
-            project_name=self.project_name,
-            page_name=self.page_name,
-            full_date=self.full_date,
-            on_user_list=self.on_user_list,
-            day=self.day,  # day can be 0 if the aggregation is a monthly one
-        ).exists():
-            raise ValidationError(
-                message="PageProjectAggregate with this combination (organisation, collection, project_name, page_name, full_date, on_user_list) already exists.",
-                code="unique_together",
+
+class CollectionMonthlyTotalManager(AggregateManager):
+    def refresh(self, collection_ids: Iterable[int], months: Iterable[date]):
+        """
+        Recalculates the given collections' totals for the months of the
+        given dates from their LinkAggregates.
+
+        This replaces the totals of any archived days, so it's only right for
+        months that are entirely in the database. Use refreshing when
+        LinkAggregates are written for a month that may be partly archived.
+        """
+        self._write_totals(self._link_aggregate_totals(collection_ids, months))
+
+    @contextmanager
+    def refreshing(self, collection_ids: Iterable[int], months: Iterable[date]):
+        """
+        Adds the changes made to the given collections' LinkAggregates in
+        the months of the given dates, within the block, to their totals.
+
+        Unlike refresh, the totals of days that have already been archived
+        and deleted from the database are kept.
+        """
+        collection_ids = set(collection_ids)
+        months = set(months)
+        before = self._link_aggregate_totals(collection_ids, months)
+
+        yield
+
+        after = self._link_aggregate_totals(collection_ids, months)
+        changes = {}
+        for key in before.keys() | after.keys():
+            if before.get(key) != after.get(key):
+                organisation_id = (after.get(key) or before[key])[0]
+                _, added_after, removed_after = after.get(key, (None, 0, 0))
+                _, added_before, removed_before = before.get(key, (None, 0, 0))
+                changes[key] = (
+                    organisation_id,
+                    added_after - added_before,
+                    removed_after - removed_before,
+                )
+        if not changes:
+            return
+
+        totals = {
+            key: (organisation_id, 0, 0)
+            for key, (organisation_id, _, _) in changes.items()
+        }
+        for monthly_total in self.filter(
+            collection_id__in={key[0] for key in changes},
+            full_date__in={key[1] for key in changes},
+        ):
+            key = (
+                monthly_total.collection_id,
+                monthly_total.full_date,
+                monthly_total.on_user_list,
+            )
+            if key in totals:
+                totals[key] = (
+                    totals[key][0],
+                    monthly_total.total_links_added,
+                    monthly_total.total_links_removed,
+                )
+
+        self._write_totals(
+            {
+                key: (
+                    organisation_id,
+                    links_added + changes[key][1],
+                    links_removed + changes[key][2],
+                )
+                for key, (organisation_id, links_added, links_removed) in totals.items()
+            }
+        )
+
+    def _link_aggregate_totals(
+        self, collection_ids: Iterable[int], months: Iterable[date]
+    ) -> Dict[Tuple[int, date, bool], Tuple[int, int, int]]:
+        """
+        Returns the (organisation id, links added, links removed) of the
+        given collections' LinkAggregates, by (collection id, first day of
+        the month, on_user_list).
+        """
+        collection_ids = set(collection_ids)
+        month_filter = Q()
+        for month in {month.replace(day=1) for month in months}:
+            month_filter |= Q(year=month.year, month=month.month)
+        if not collection_ids or not month_filter:
+            return {}
+
+        return {
+            (
+                total["collection_id"],
+                date(total["year"], total["month"], 1),
+                total["on_user_list"],
+            ): (
+                total["organisation_id"],
+                total["links_added"],
+                total["links_removed"],
             )
+            for total in LinkAggregate.objects.filter(
+                month_filter, collection_id__in=collection_ids
+            )
+            .values("organisation_id", "collection_id", "on_user_list", "year", "month")
+            .annotate(
+                links_added=Sum("total_links_added"),
+                links_removed=Sum("total_links_removed"),
+            )
+            .order_by()
+        }
+
+    def _write_totals(self, totals: Dict[Tuple[int, date, bool], Tuple[int, int, int]]):
+        self.bulk_upsert(
+            CollectionMonthlyTotal(
+                organisation_id=organisation_id,
+                collection_id=collection_id,
+                on_user_list=on_user_list,
+                full_date=full_date,
+                total_links_added=max(links_added, 0),
+                total_links_removed=max(links_removed, 0),
+            )
+            for (collection_id, full_date, on_user_list), (
+                organisation_id,
+                links_added,
+                links_removed,
+            ) in totals.items()
+        )
+
+    def _set_dates(self, aggregate: models.Model):
+        aggregate.full_date = aggregate.full_date.replace(day=1)
+
+
+class CollectionMonthlyTotal(models.Model):
+    """
+    A collection's LinkAggregate totals for a month, including months that
+    have since been archived, for the organisation charts.
+    """
+
+    class Meta:
+        app_label = "aggregates"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["collection", "full_date", "on_user_list"],
+                name="unique_collectionmonthlytotal",
+            ),
+        ]
+
+    objects = CollectionMonthlyTotalManager()
+
+    organisation = models.ForeignKey(Organisation, on_delete=models.CASCADE)
+    collection = models.ForeignKey(Collection, on_delete=models.CASCADE)
+    # The first day of the month
+    full_date = models.DateField()
+    on_user_list = models.BooleanField(default=False)
+    total_links_added = models.PositiveIntegerField()
+    total_links_removed = models.PositiveIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class AggregateWatermark(models.Model):
+    """
+    The id of the last LinkEvent counted into a collection's daily
+    aggregates of one type, so that the next run only has to count newer
+    events.
+    """
+
+    class Meta:
+        app_label = "aggregates"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["collection", "aggregate_type"],
+                name="unique_aggregatewatermark",
+            ),
+        ]
+
+    collection = models.ForeignKey(Collection, on_delete=models.CASCADE)
+    # The aggregate model's name, e.g. "LinkAggregate"
+    aggregate_type = models.CharField(max_length=32)
+    last_link_event_id = models.PositiveBigIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.collection} {self.aggregate_type}: {self.last_link_event_id}"
 
 
 class ProgramTopOrganisationsTotal(models.Model):
@@ -1,14 +1,36 @@
+import array
+import bisect
 import datetime
 import gzip
+import hashlib
+import heapq
 import itertools
 import json
 import logging
+import math
 import os
 import re
-
-from typing import Callable, Dict, Hashable, Iterable, List, Optional, Set
+import struct
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import Q
 
 from extlinks.common.helpers import extract_queryset_filter
@@ -22,6 +44,234 @@ logger = logging.getLogger("django")
 
 DEFAULT_EXPIRATION_SECS = 60 * 60
 
+# Decoded archives are kept in process memory for a short while so that the
+# AJAX requests made by a single page load share the work of decoding them.
+MERGED_ARCHIVE_CACHE_MAX_ENTRIES = 256
+MERGED_ARCHIVE_CACHE_EXPIRATION_SECS = 5 * 60
+
+# Fields that are dropped from cached records so that rows from the same month
+# can be summed together. None of the archive consumers read them.
+MERGED_ARCHIVE_DROPPED_FIELDS = {"day", "full_date", "created_at", "updated_at"}
+MERGED_ARCHIVE_TOTAL_FIELDS = ("total_links_added", "total_links_removed")
+
+CONSOLIDATED_ARCHIVE_FORMAT = "consolidated"
+CONSOLIDATED_ARCHIVE_VERSION = 1
+
+# Columnar archives start with this marker once decompressed, followed by the
+# length of their JSON header and the header itself.
+COLUMNAR_ARCHIVE_MAGIC = b"EXTLINKS-COLUMNAR\n"
+COLUMNAR_ARCHIVE_VERSION = 1
+COLUMNAR_HEADER_LENGTH = struct.Struct("<I")
+
+# Distinct values are counted exactly up to this many values, after which
+# count_unique switches to an estimate to keep memory use bounded.
+DISTINCT_COUNT_EXACT_LIMIT = 100_000
+HYPERLOGLOG_PRECISION = 14
+
+
+class MergedArchiveCache:
+    """
+    A thread safe LRU cache of merged archive records with a time to live.
+
+    Records are stored compactly as a tuple of field names plus one tuple of
+    values per record, and are expanded into new dictionaries on every read
+    so that callers are free to modify what they get back.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = MERGED_ARCHIVE_CACHE_MAX_ENTRIES,
+        expiration: int = MERGED_ARCHIVE_CACHE_EXPIRATION_SECS,
+    ):
+        self.max_entries = max_entries
+        self.expiration = expiration
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[List[Dict]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, fields, rows = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+
+        return [dict(zip(fields, row)) for row in rows]
+
+    def set(self, key: Hashable, records: Iterable[Dict]):
+        self.set_merged(key, *merge_records(records))
+
+    def set_merged(self, key: Hashable, fields: Tuple[str, ...], rows: List[Tuple]):
+        """
+        Stores records that were already merged by merge_records or
+        merge_columns.
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.expiration, fields, rows)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+merged_archive_cache = MergedArchiveCache()
+
+
+class ArchiveCatalog:
+    """
+    An index of the archives in object storage for each prefix.
+
+    Archive names are grouped by collection and user list, and sorted by
+    date so that the archives for a date range can be found with a binary
+    search. Each process rebuilds its index from the archive list when it
+    expires, or as soon as invalidate_archive_catalog is called for the
+    prefix by any process.
+    """
+
+    def __init__(self, expiration: int = DEFAULT_EXPIRATION_SECS):
+        self.expiration = expiration
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def find(
+        self,
+        prefix: str,
+        collection_id: int,
+        on_user_list: bool,
+        from_date: Optional[datetime.date] = None,
+        to_date: Optional[datetime.date] = None,
+    ) -> List[str]:
+        """
+        Returns the names of the matching archives, ordered by date.
+        """
+
+        dates, names = self._get_index(prefix).get(
+            (collection_id, on_user_list), ([], [])
+        )
+        # Consolidated archives are indexed by the first day of their month
+        # and need to be found for any date in it. Their records are filtered
+        # by date once downloaded.
+        start = (
+            bisect.bisect_left(dates, from_date.replace(day=1)) if from_date else 0
+        )
+        end = bisect.bisect_right(dates, to_date) if to_date else len(dates)
+
+        return names[start:end]
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+
+    def _get_index(self, prefix: str) -> Dict[Tuple[int, bool], Tuple[List, List]]:
+        version = cache.get(f"{prefix}_archive_catalog_version")
+
+        with self._lock:
+            entry = self._indexes.get(prefix)
+            if entry is not None:
+                expires_at, index_version, index = entry
+                if expires_at > time.monotonic() and index_version == version:
+                    return index
+
+        index = self._build_index(prefix, get_archive_list(prefix))
+
+        # An empty list is also returned when Swift isn't set up, so only keep
+        # indexes that have something in them.
+        if index:
+            with self._lock:
+                self._indexes[prefix] = (
+                    time.monotonic() + self.expiration,
+                    version,
+                    index,
+                )
+
+        return index
+
+    @staticmethod
+    def _build_index(
+        prefix: str, archives: Iterable[Dict]
+    ) -> Dict[Tuple[int, bool], Tuple[List, List]]:
+        # Archives written per date use the following naming convention:
+        #
+        # {prefix}_{organisation}_{collection}_{full_date}_{on_user_list}.json.gz
+        #
+        # while consolidated archives cover a whole month and both user list
+        # options:
+        #
+        # {prefix}_{organisation}_{collection}_{year}-{month}.json.gz
+        pattern = re.compile(
+            rf"^{prefix}_([0-9]+)_([0-9]+)_([0-9]+-[0-9]{{2}}-[0-9]{{2}})_([01])\.json\.gz$"
+        )
+        consolidated_pattern = re.compile(
+            rf"^{prefix}_([0-9]+)_([0-9]+)_([0-9]+-[0-9]{{2}})\.json\.gz$"
+        )
+
+        archives_by_key = {}
+        consolidated_months = set()
+        for archive in archives:
+            details = consolidated_pattern.search(archive["name"])
+            if details:
+                collection_id = int(details.group(2))
+                archive_date = datetime.datetime.strptime(
+                    details.group(3), "%Y-%m"
+                ).date()
+                consolidated_months.add((collection_id, archive_date))
+                for on_user_list in (False, True):
+                    key = (collection_id, on_user_list)
+                    archives_by_key.setdefault(key, []).append(
+                        (archive_date, archive["name"], True)
+                    )
+                continue
+
+            details = pattern.search(archive["name"])
+            if not details:
+                continue
+
+            key = (int(details.group(2)), bool(int(details.group(4))))
+            archive_date = datetime.datetime.strptime(
+                details.group(3), "%Y-%m-%d"
+            ).date()
+            archives_by_key.setdefault(key, []).append(
+                (archive_date, archive["name"], False)
+            )
+
+        index = {}
+        for key, dated_archives in archives_by_key.items():
+            # Consolidated archives replace the archives of every date in
+            # their month, which may not have been deleted yet.
+            dated_archives = sorted(
+                (archive_date, name)
+                for archive_date, name, consolidated in dated_archives
+                if consolidated
+                or (key[0], archive_date.replace(day=1)) not in consolidated_months
+            )
+            index[key] = (
+                [archive_date for archive_date, _ in dated_archives],
+                [name for _, name in dated_archives],
+            )
+
+        return index
+
+
+archive_catalog = ArchiveCatalog()
+
+
+def invalidate_archive_catalog(prefix: str):
+    """
+    Makes every process rebuild its archive catalog for the given prefix from
+    a fresh archive list, e.g. after new archives have been uploaded.
+    """
+
+    cache.delete(f"{prefix}_archive_list")
+    cache.set(f"{prefix}_archive_catalog_version", time.time_ns(), None)
+
 
 def get_archive_list(prefix: str, expiration=DEFAULT_EXPIRATION_SECS) -> List[Dict]:
     """
@@ -79,15 +329,249 @@ def get_archives(
 def decode_archive(archive: bytes) -> List[Dict]:
     """
     Decodes a gzipped archive into a list of dictionaries (row records).
+
+    The serialized fixtures written per date and user list, and the
+    consolidated monthly archives in either encoding, are all decoded into
+    the same fixture records.
     """
     if archive is None or not isinstance(archive, (bytes, bytearray)):
         return []
 
     decompressed_archive = gzip.decompress(archive)
-    if decompressed_archive is None or not isinstance(decompressed_archive, str):
+    if decompressed_archive is None or not isinstance(
+        decompressed_archive, (bytes, str)
+    ):
         return []
 
-    return json.loads(decompressed_archive)
+    if decompressed_archive.startswith(COLUMNAR_ARCHIVE_MAGIC):
+        header, columns = _decode_columnar_archive(decompressed_archive)
+        names = [column["name"] for column in header["columns"]][1:]
+        return [
+            {
+                "model": header["model"],
+                "pk": row[0],
+                "fields": dict(zip(names, row[1:])),
+            }
+            for row in zip(*columns.values())
+        ]
+
+    records = json.loads(decompressed_archive)
+    if (
+        isinstance(records, dict)
+        and records.get("format") == CONSOLIDATED_ARCHIVE_FORMAT
+    ):
+        return expand_consolidated_archive(records)
+
+    return records
+
+
+def decode_archive_columns(archive: bytes) -> Dict[str, Sequence]:
+    """
+    Decodes a gzipped archive into its columns of values, keyed by field
+    name, plus a "pk" column.
+
+    Columnar archives are decoded without building a record per row, other
+    archives are decoded with decode_archive and split into columns.
+    """
+    if archive is None or not isinstance(archive, (bytes, bytearray)):
+        return {}
+
+    decompressed_archive = gzip.decompress(archive)
+    if decompressed_archive.startswith(COLUMNAR_ARCHIVE_MAGIC):
+        _, columns = _decode_columnar_archive(decompressed_archive)
+        return columns
+
+    records = decode_archive(archive)
+    if not records:
+        return {}
+
+    columns = {"pk": [record["pk"] for record in records]}
+    for name in records[0]["fields"]:
+        columns[name] = [record["fields"][name] for record in records]
+
+    return columns
+
+
+def encode_columnar_archive(
+    organisation_id: int,
+    collection_id: int,
+    month: datetime.date,
+    records: Iterable[Dict],
+) -> bytes:
+    """
+    Encodes serialized aggregate records from one collection and month into
+    a columnar archive.
+
+    This is a compact alternative to encode_consolidated_archive. After the
+    header, each field is stored as one column: integers as int64 arrays,
+    booleans as int8 arrays and everything else, such as names and dates, as
+    an array of uint32 codes into a dictionary of distinct values kept in
+    the header. Arrays are little endian.
+    """
+
+    records = list(records)
+    names = ["pk"] + (sorted(records[0]["fields"]) if records else [])
+    values = {
+        "pk": [record["pk"] for record in records],
+        **{
+            name: [record["fields"][name] for record in records]
+            for name in names[1:]
+        },
+    }
+
+    columns = []
+    buffers = []
+    for name in names:
+        column = {"name": name}
+        if values[name] and all(type(value) is bool for value in values[name]):
+            column["typecode"] = "b"
+            data = array.array("b", values[name])
+        elif values[name] and all(type(value) is int for value in values[name]):
+            column["typecode"] = "q"
+            data = array.array("q", values[name])
+        else:
+            dictionary = {}
+            data = array.array(
+                "I",
+                (
+                    dictionary.setdefault(value, len(dictionary))
+                    for value in values[name]
+                ),
+            )
+            column["typecode"] = "I"
+            column["dictionary"] = list(dictionary)
+
+        if sys.byteorder == "big":
+            data.byteswap()
+        columns.append(column)
+        buffers.append(data.tobytes())
+
+    header = json.dumps(
+        {
+            "version": COLUMNAR_ARCHIVE_VERSION,
+            "model": records[0]["model"] if records else None,
+            "organisation": organisation_id,
+            "collection": collection_id,
+            "month": month.strftime("%Y-%m"),
+            "rows": len(records),
+            "columns": columns,
+        },
+        cls=DjangoJSONEncoder,
+    ).encode("utf-8")
+
+    return gzip.compress(
+        COLUMNAR_ARCHIVE_MAGIC
+        + COLUMNAR_HEADER_LENGTH.pack(len(header))
+        + header
+        + b"".join(buffers)
+    )
+
+
+def _decode_columnar_archive(
+    decompressed_archive: bytes,
+) -> Tuple[Dict, Dict[str, Sequence]]:
+    offset = len(COLUMNAR_ARCHIVE_MAGIC)
+    (header_length,) = COLUMNAR_HEADER_LENGTH.unpack_from(decompressed_archive, offset)
+    offset += COLUMNAR_HEADER_LENGTH.size
+    header = json.loads(decompressed_archive[offset : offset + header_length])
+    offset += header_length
+
+    columns = {}
+    for column in header["columns"]:
+        data = array.array(column["typecode"])
+        length = data.itemsize * header["rows"]
+        data.frombytes(decompressed_archive[offset : offset + length])
+        offset += length
+        if sys.byteorder == "big":
+            data.byteswap()
+
+        if "dictionary" in column:
+            columns[column["name"]] = list(map(column["dictionary"].__getitem__, data))
+        elif column["typecode"] == "b":
+            columns[column["name"]] = list(map(bool, data))
+        else:
+            columns[column["name"]] = data
+
+    return header, columns
+
+
+def consolidated_archive_name(
+    prefix: str, organisation_id: int, collection_id: int, month: datetime.date
+) -> str:
+    """
+    Returns the name of the consolidated archive for a collection and month.
+    """
+
+    return (
+        f"{prefix}_{organisation_id}_{collection_id}_{month.strftime('%Y-%m')}.json.gz"
+    )
+
+
+def encode_consolidated_archive(
+    organisation_id: int,
+    collection_id: int,
+    month: datetime.date,
+    records: Iterable[Dict],
+) -> bytes:
+    """
+    Encodes serialized aggregate records from one collection and month into
+    a consolidated archive.
+
+    The archive starts with a header describing its contents and the fields
+    of its rows, followed by one block of rows per date. Rows are lists of
+    values in the order of the header's fields, starting with the primary
+    key. Unlike the archives written per date, rows on the user list are
+    only stored once and readers filter them by their on_user_list field.
+    """
+
+    model = None
+    fields = None
+    blocks = {}
+
+    for record in records:
+        if fields is None:
+            model = record["model"]
+            fields = sorted(record["fields"])
+
+        full_date = str(record["fields"]["full_date"])
+        blocks.setdefault(full_date, []).append(
+            [record["pk"]] + [record["fields"][field] for field in fields]
+        )
+
+    archive = {
+        "format": CONSOLIDATED_ARCHIVE_FORMAT,
+        "version": CONSOLIDATED_ARCHIVE_VERSION,
+        "model": model,
+        "organisation": organisation_id,
+        "collection": collection_id,
+        "month": month.strftime("%Y-%m"),
+        "fields": ["pk"] + (fields or []),
+        "blocks": [
+            {"full_date": full_date, "count": len(rows), "rows": rows}
+            for full_date, rows in sorted(blocks.items())
+        ],
+    }
+
+    return gzip.compress(json.dumps(archive, cls=DjangoJSONEncoder).encode("utf-8"))
+
+
+def expand_consolidated_archive(archive: Dict) -> List[Dict]:
+    """
+    Expands the rows of a decoded consolidated archive into serialized
+    aggregate records.
+    """
+
+    fields = archive["fields"][1:]
+
+    return [
+        {
+            "model": archive["model"],
+            "pk": row[0],
+            "fields": dict(zip(fields, row[1:])),
+        }
+        for block in archive["blocks"]
+        for row in block["rows"]
+    ]
 
 
 def download_aggregates(
@@ -102,6 +586,11 @@ def download_aggregates(
     This function tries its best to apply the passed in Django queryset to the
     records it returns. This function supports filtering by collection, user
     list, and date ranges.
+
+    The merged records for each combination of filters are kept in an in
+    process cache, see MergedArchiveCache. Cached records are summed by month
+    and therefore do not include the day, full_date, created_at or updated_at
+    fields.
     """
 
     extracted_filters = extract_queryset_filter(queryset_filter)
@@ -118,50 +607,139 @@ def download_aggregates(
         if isinstance(to_date, str):
             to_date = datetime.datetime.strptime(to_date, "%Y-%m-%d").date()
 
-    # We're only returning objects that match the following pattern. The
-    # archive filenames use the following naming convention:
-    #
-    # {prefix}_{organisation}_{collection}_{full_date}_{on_user_list}.json.gz
-    pattern = (
-        rf"^{prefix}_([0-9]+)_([0-9]+)_([0-9]+-[0-9]{{2}}-[0-9]{{2}})_([01])\.json\.gz$"
-    )
-
     # Identify archives that need to be downloaded from object storage
     # because they are not available in the database.
-    archives = []
-    for archive in get_archive_list(prefix):
-        details = re.search(pattern, archive["name"])
-        if not details:
-            continue
-
-        archive_collection_id = int(details.group(2))
-        archive_date = datetime.datetime.strptime(details.group(3), "%Y-%m-%d").date()
-        archive_on_user_list = bool(int(details.group(4)))
-
-        # Filter out archives that don't match the queryset filter.
-        if (
-            (archive_collection_id != collection_id)
-            or (on_user_list != archive_on_user_list)
-            or (to_date and archive_date > to_date)
-            or (from_date and archive_date < from_date)
-        ):
-            continue
-
-        archives.append(archive)
+    archive_names = archive_catalog.find(
+        prefix, collection_id, on_user_list, from_date=from_date, to_date=to_date
+    )
 
     # Bail out if there's nothing to download.
-    if len(archives) == 0:
+    if len(archive_names) == 0:
         return []
 
-    # Download and decompress the archives from object storage.
-    unflattened_records = (
-        (record["fields"] for record in decode_archive(contents))
-        for contents in get_archives(archive["name"] for archive in archives).values()
+    # The archive names are part of the key so that newly uploaded archives
+    # are picked up as soon as the archive catalog is refreshed.
+    archive_names = tuple(archive_names)
+    key = (prefix, collection_id, from_date, to_date, on_user_list, archive_names)
+    records = merged_archive_cache.get(key)
+    if records is not None:
+        return records
+
+    # Download and decompress the archives from object storage, and merge
+    # the records from all of them together.
+    merged_archive_cache.set_merged(
+        key,
+        *merge_columns(
+            (
+                decode_archive_columns(contents)
+                for contents in get_archives(archive_names).values()
+            ),
+            on_user_list=on_user_list,
+            from_date=from_date,
+            to_date=to_date,
+        ),
     )
 
-    # Each archive has its own records and are grouped together in a
-    # two-dimensional array. Merge them all together.
-    return list(itertools.chain(*unflattened_records))
+    return merged_archive_cache.get(key) or []
+
+
+def merge_records(records: Iterable[Dict]) -> Tuple[Tuple[str, ...], List[Tuple]]:
+    """
+    Sums archive records that only differ by day into a compact form.
+
+    Returns a tuple of field names and a list of value tuples, one per merged
+    record, with the totals as the last values.
+    """
+
+    fields = None
+    totals = {}
+
+    for record in records:
+        if fields is None:
+            fields = tuple(
+                sorted(
+                    field
+                    for field in record
+                    if field not in MERGED_ARCHIVE_DROPPED_FIELDS
+                    and field not in MERGED_ARCHIVE_TOTAL_FIELDS
+                )
+            )
+
+        key = tuple(record.get(field) for field in fields)
+        added, removed = totals.get(key, (0, 0))
+        totals[key] = (
+            added + record["total_links_added"],
+            removed + record["total_links_removed"],
+        )
+
+    if fields is None:
+        return (), []
+
+    return (
+        fields + MERGED_ARCHIVE_TOTAL_FIELDS,
+        [key + total for key, total in totals.items()],
+    )
+
+
+def merge_columns(
+    archives: Iterable[Dict[str, Sequence]],
+    on_user_list: bool = False,
+    from_date: Optional[datetime.date] = None,
+    to_date: Optional[datetime.date] = None,
+) -> Tuple[Tuple[str, ...], List[Tuple]]:
+    """
+    Sums the decoded columns of archives like merge_records, keeping only
+    rows on the user list if requested and rows within the date range.
+
+    Consolidated archives cover every date of their month and both user list
+    options, which is why their rows need to be filtered here.
+    """
+
+    from_date = from_date.isoformat() if from_date else None
+    to_date = to_date.isoformat() if to_date else None
+    fields = None
+    totals = {}
+
+    for columns in archives:
+        if not columns:
+            continue
+
+        if fields is None:
+            fields = tuple(
+                sorted(
+                    name
+                    for name in columns
+                    if name != "pk"
+                    and name not in MERGED_ARCHIVE_DROPPED_FIELDS
+                    and name not in MERGED_ARCHIVE_TOTAL_FIELDS
+                )
+            )
+
+        rows = zip(
+            zip(*(columns[name] for name in fields)),
+            columns["total_links_added"],
+            columns["total_links_removed"],
+            columns["on_user_list"],
+            map(str, columns["full_date"]),
+        )
+        for key, links_added, links_removed, user_listed, full_date in rows:
+            if (
+                (on_user_list and not user_listed)
+                or (from_date and full_date < from_date)
+                or (to_date and full_date > to_date)
+            ):
+                continue
+
+            added, removed = totals.get(key, (0, 0))
+            totals[key] = (added + links_added, removed + links_removed)
+
+    if fields is None:
+        return (), []
+
+    return (
+        fields + MERGED_ARCHIVE_TOTAL_FIELDS,
+        [key + total for key, total in totals.items()],
+    )
 
 
 def calculate_totals(
@@ -206,3 +784,84 @@ def find_unique(
         values.add(group_by(record))
 
     return values
+
+
+def find_top(
+    records: Iterable[Dict],
+    key: Callable[[Dict], Any],
+    count: int = 5,
+) -> List[Dict]:
+    """
+    Find the records with the largest keys, largest first.
+
+    Only the current top records are kept in memory while the records are
+    consumed, and ties are returned in the order they were seen.
+    """
+
+    return heapq.nlargest(count, records, key=key)
+
+
+class HyperLogLog:
+    """
+    Estimates the number of distinct values added to it in fixed memory.
+
+    With the default precision the estimate uses 16KiB and is usually within
+    1% of the real count.
+    """
+
+    def __init__(self, precision: int = HYPERLOGLOG_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value: Hashable):
+        digest = hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest()
+        hashed = int.from_bytes(digest, "big")
+
+        # The first bits pick a register and the position of the first set bit
+        # in the rest is recorded in it.
+        remaining_bits = 64 - self.precision
+        register = hashed >> remaining_bits
+        rest = hashed & ((1 << remaining_bits) - 1)
+        rank = remaining_bits - rest.bit_length() + 1
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    def count(self) -> int:
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size**2 / sum(2.0**-rank for rank in self.registers)
+
+        # Use linear counting for small sets, where it is more accurate.
+        empty_registers = self.registers.count(0)
+        if estimate <= 2.5 * size and empty_registers:
+            estimate = size * math.log(size / empty_registers)
+
+        return round(estimate)
+
+
+def count_unique(
+    values: Iterable[Hashable],
+    max_exact: int = DISTINCT_COUNT_EXACT_LIMIT,
+) -> int:
+    """
+    Count the distinct values in the given iterable.
+
+    The count is exact until more than max_exact distinct values have been
+    seen, after which it is estimated with a HyperLogLog.
+    """
+
+    values = iter(values)
+    seen = set()
+
+    for value in values:
+        seen.add(value)
+        if len(seen) > max_exact:
+            break
+    else:
+        return len(seen)
+
+    estimator = HyperLogLog()
+    for value in itertools.chain(seen, values):
+        estimator.add(value)
+
+    return estimator.count()
@@ -7,26 +7,41 @@ import gzip
 import json
 import swiftclient
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta, timezone
 from dateutil.relativedelta import relativedelta
 from unittest import mock
 
 from django.contrib.contenttypes.models import ContentType
+from django.core import serializers
 from django.core.management import call_command, CommandError
+from django.db import IntegrityError
+from django.db.models import Q
 from django.test import TransactionTestCase
 
+from extlinks.aggregates import storage
 from extlinks.aggregates.management.helpers import (
+    DailyAggregator,
     validate_link_aggregate_archive,
     validate_pageproject_aggregate_archive,
     validate_user_aggregate_archive,
 )
+from extlinks.aggregates.management.helpers.daily_aggregate_command import (
+    aggregate_collections,
+)
 
 from .factories import (
     LinkAggregateFactory,
     UserAggregateFactory,
     PageProjectAggregateFactory,
 )
-from .models import LinkAggregate, UserAggregate, PageProjectAggregate
+from .models import (
+    AggregateWatermark,
+    CollectionMonthlyTotal,
+    LinkAggregate,
+    PageProjectAggregate,
+    UserAggregate,
+)
 from extlinks.links.factories import LinkEventFactory, URLPatternFactory
 from extlinks.organisations.factories import (
     CollectionFactory,
@@ -117,7 +132,13 @@ class LinkAggregateCommandTest(BaseTransactionTest):
         LinkAggregateFactory(full_date=date(2020, 2, 15))
         LinkAggregateFactory(full_date=date(2020, 9, 10))
         LinkAggregateFactory(full_date=date(2020, 9, 30))
-        LinkAggregateFactory(full_date=date(2020, 9, 30))
+        # This collection was last aggregated before it had a watermark, so
+        # it's recounted from its latest aggregate
+        LinkAggregateFactory(
+            full_date=date(2020, 9, 30),
+            organisation=self.organisation,
+            collection=self.collection,
+        )
 
         self.assertEqual(LinkAggregate.objects.count(), 6)
 
@@ -344,7 +365,13 @@ class UserAggregateCommandTest(BaseTransactionTest):
         UserAggregateFactory(full_date=date(2020, 2, 15))
         UserAggregateFactory(full_date=date(2020, 9, 10))
         UserAggregateFactory(full_date=date(2020, 9, 30))
-        UserAggregateFactory(full_date=date(2020, 9, 30))
+        # This collection was last aggregated before it had a watermark, so
+        # it's recounted from its latest aggregate
+        UserAggregateFactory(
+            full_date=date(2020, 9, 30),
+            organisation=self.organisation,
+            collection=self.collection,
+        )
 
         self.assertEqual(UserAggregate.objects.count(), 6)
 
@@ -601,7 +628,13 @@ class PageProjectAggregateCommandTest(BaseTransactionTest):
         PageProjectAggregateFactory(full_date=date(2020, 2, 15))
         PageProjectAggregateFactory(full_date=date(2020, 9, 10))
         PageProjectAggregateFactory(full_date=date(2020, 9, 30))
-        PageProjectAggregateFactory(full_date=date(2020, 9, 30))
+        # This collection was last aggregated before it had a watermark, so
+        # it's recounted from its latest aggregate
+        PageProjectAggregateFactory(
+            full_date=date(2020, 9, 30),
+            organisation=self.organisation,
+            collection=self.collection,
+        )
 
         self.assertEqual(PageProjectAggregate.objects.count(), 6)
 
@@ -753,6 +786,885 @@ class PageProjectAggregateCommandTest(BaseTransactionTest):
             call_command("fill_pageproject_aggregates", collections=[new_collection.pk])
 
 
+class DailyAggregatesCommandTest(BaseTransactionTest):
+    def setUp(self):
+        self.organisation = OrganisationFactory(name="ACME Org")
+        self.collection = CollectionFactory(name="ACME", organisation=self.organisation)
+        self.url = URLPatternFactory(url="www.google.com")
+        self.url.collections.add(self.collection)
+        self.url2 = URLPatternFactory(url="www.bing.com")
+        self.url2.collections.add(self.collection)
+        self.user = UserFactory(username="juannieve")
+
+        for url, timestamp, change in [
+            (self.url, datetime(2020, 1, 1, 15, 30, 35, tzinfo=timezone.utc), LinkEvent.ADDED),
+            (self.url2, datetime(2020, 1, 1, 17, 40, 55, tzinfo=timezone.utc), LinkEvent.ADDED),
+            (self.url2, datetime(2020, 1, 1, 19, 5, 42, tzinfo=timezone.utc), LinkEvent.REMOVED),
+            (self.url, datetime(2020, 9, 10, 12, 9, 14, tzinfo=timezone.utc), LinkEvent.ADDED),
+        ]:
+            LinkEventFactory(
+                content_object=url,
+                timestamp=timestamp,
+                change=change,
+                username=self.user,
+                domain="en.wikipedia.org",
+                page_title="Page1",
+            )
+
+    def test_fills_every_daily_aggregate(self):
+        call_command("fill_daily_aggregates")
+
+        self.assertEqual(LinkAggregate.objects.count(), 2)
+        self.assertEqual(UserAggregate.objects.count(), 2)
+        self.assertEqual(PageProjectAggregate.objects.count(), 2)
+
+        # Events from every URL pattern in the collection are counted together.
+        for model in (LinkAggregate, UserAggregate, PageProjectAggregate):
+            aggregate = model.objects.get(full_date=date(2020, 1, 1))
+            self.assertEqual(aggregate.total_links_added, 2)
+            self.assertEqual(aggregate.total_links_removed, 1)
+            self.assertEqual(aggregate.organisation, self.organisation)
+            self.assertEqual((aggregate.day, aggregate.month, aggregate.year), (1, 1, 2020))
+
+        user_aggregate = UserAggregate.objects.get(full_date=date(2020, 1, 1))
+        self.assertEqual(user_aggregate.username, "juannieve")
+        pageproject_aggregate = PageProjectAggregate.objects.get(
+            full_date=date(2020, 1, 1)
+        )
+        self.assertEqual(pageproject_aggregate.project_name, "en.wikipedia.org")
+        self.assertEqual(pageproject_aggregate.page_name, "Page1")
+
+    def test_updates_existing_aggregates(self):
+        call_command("fill_daily_aggregates")
+
+        LinkEventFactory(
+            content_object=self.url,
+            timestamp=datetime(2020, 9, 10, 18, 0, 0, tzinfo=timezone.utc),
+            username=self.user,
+            domain="en.wikipedia.org",
+            page_title="Page1",
+        )
+        call_command("fill_daily_aggregates")
+
+        for model in (LinkAggregate, UserAggregate, PageProjectAggregate):
+            self.assertEqual(model.objects.count(), 2)
+            self.assertEqual(
+                model.objects.get(full_date=date(2020, 9, 10)).total_links_added, 2
+            )
+
+    def test_records_watermarks(self):
+        call_command("fill_daily_aggregates")
+
+        last_link_event_id = LinkEvent.objects.latest("id").pk
+        self.assertEqual(
+            sorted(
+                AggregateWatermark.objects.filter(
+                    collection=self.collection
+                ).values_list("aggregate_type", "last_link_event_id")
+            ),
+            [
+                ("LinkAggregate", last_link_event_id),
+                ("PageProjectAggregate", last_link_event_id),
+                ("UserAggregate", last_link_event_id),
+            ],
+        )
+
+        # Running again without new events doesn't count anything twice.
+        call_command("fill_daily_aggregates")
+
+        aggregate = LinkAggregate.objects.get(full_date=date(2020, 1, 1))
+        self.assertEqual(aggregate.total_links_added, 2)
+        self.assertEqual(aggregate.total_links_removed, 1)
+
+    def test_new_collection_is_counted_separately(self):
+        call_command("fill_daily_aggregates")
+
+        new_collection = CollectionFactory(organisation=self.organisation)
+        self.url.collections.add(new_collection)
+        LinkEventFactory(
+            content_object=self.url,
+            timestamp=datetime(2020, 1, 1, 18, 0, 0, tzinfo=timezone.utc),
+            username=self.user,
+        )
+
+        call_command("fill_daily_aggregates")
+
+        # The existing collection only has the new event added...
+        self.assertEqual(
+            LinkAggregate.objects.get(
+                collection=self.collection, full_date=date(2020, 1, 1)
+            ).total_links_added,
+            3,
+        )
+        # ...while the new one has every event of its URL pattern counted.
+        self.assertEqual(
+            LinkAggregate.objects.get(
+                collection=new_collection, full_date=date(2020, 1, 1)
+            ).total_links_added,
+            2,
+        )
+        self.assertEqual(
+            LinkAggregate.objects.get(
+                collection=new_collection, full_date=date(2020, 9, 10)
+            ).total_links_added,
+            1,
+        )
+
+    def test_new_collection_counts_events_given_another_collection(self):
+        call_command("fill_daily_aggregates")
+
+        # Events record the collection they were written for, which can be
+        # another collection of the same URL pattern.
+        LinkEvent.objects.update(
+            collection=self.collection, organisation=self.organisation
+        )
+        new_collection = CollectionFactory(organisation=self.organisation)
+        self.url.collections.add(new_collection)
+
+        call_command("fill_daily_aggregates")
+
+        self.assertEqual(
+            LinkAggregate.objects.get(
+                collection=new_collection, full_date=date(2020, 1, 1)
+            ).total_links_added,
+            1,
+        )
+        self.assertEqual(
+            LinkAggregate.objects.get(
+                collection=self.collection, full_date=date(2020, 1, 1)
+            ).total_links_added,
+            2,
+        )
+
+    def test_query_count_does_not_grow_with_url_patterns(self):
+        for i in range(10):
+            url_pattern = URLPatternFactory(url=f"www.example{i}.com")
+            url_pattern.collections.add(self.collection)
+            LinkEventFactory(
+                content_object=url_pattern,
+                timestamp=datetime(2020, 1, 2, tzinfo=timezone.utc),
+            )
+
+        call_command("fill_daily_aggregates")
+        for i in range(10, 20):
+            url_pattern = URLPatternFactory(url=f"www.example{i}.com")
+            url_pattern.collections.add(self.collection)
+            LinkEventFactory(
+                content_object=url_pattern,
+                timestamp=datetime(2020, 1, 3, tzinfo=timezone.utc),
+                username=self.user,
+            )
+
+        with self.assertNumQueries(21):
+            call_command("fill_daily_aggregates")
+
+
+class SerialExecutor(ThreadPoolExecutor):
+    """
+    Stands in for the worker process pool, since the test database can't be
+    shared with other processes.
+    """
+
+    def __init__(self, max_workers=None, initializer=None):
+        super().__init__(max_workers=1, initializer=initializer)
+
+
+@mock.patch(
+    "extlinks.aggregates.management.helpers.daily_aggregate_command.ProcessPoolExecutor",
+    SerialExecutor,
+)
+class DailyAggregatesWorkersTest(BaseTransactionTest):
+    def setUp(self):
+        self.collections = []
+        for i in range(3):
+            organisation = OrganisationFactory(name=f"Org {i}")
+            collection = CollectionFactory(organisation=organisation)
+            url_pattern = URLPatternFactory(url=f"www.example{i}.com")
+            url_pattern.collections.add(collection)
+            for day in range(1, i + 2):
+                LinkEventFactory(
+                    content_object=url_pattern,
+                    timestamp=datetime(2020, 1, day, tzinfo=timezone.utc),
+                )
+            self.collections.append(collection)
+
+    def test_workers_match_single_process(self):
+        call_command("fill_link_aggregates", workers=2)
+        with_workers = sorted(
+            LinkAggregate.objects.values_list(
+                "collection_id", "full_date", "total_links_added"
+            )
+        )
+
+        LinkAggregate.objects.all().delete()
+        AggregateWatermark.objects.all().delete()
+        call_command("fill_link_aggregates")
+
+        self.assertEqual(len(with_workers), 6)
+        self.assertEqual(
+            with_workers,
+            sorted(
+                LinkAggregate.objects.values_list(
+                    "collection_id", "full_date", "total_links_added"
+                )
+            ),
+        )
+
+    def test_worker_only_reads_its_collections_events(self):
+        count = DailyAggregator._count
+        link_event_filters = []
+
+        def record_filter(aggregator, link_event_filter, *args):
+            link_event_filters.append(link_event_filter)
+            return count(aggregator, link_event_filter, *args)
+
+        with mock.patch.object(DailyAggregator, "_count", record_filter):
+            failed = aggregate_collections(
+                [LinkAggregate],
+                [self.collections[2].pk],
+                LinkEvent.objects.latest("id").pk,
+            )
+
+        self.assertEqual(failed, [])
+        self.assertEqual(len(link_event_filters), 1)
+        self.assertEqual(
+            set(
+                LinkEvent.objects.filter(link_event_filters[0]).values_list(
+                    "object_id", flat=True
+                )
+            ),
+            set(self.collections[2].urlpatterns.values_list("pk", flat=True)),
+        )
+
+    def test_failed_collection_does_not_stop_others(self):
+        failing = self.collections[1]
+        run = DailyAggregator.run
+
+        def fail_for_collection(aggregator, collections, *args, **kwargs):
+            if failing in collections:
+                raise ValueError("Something went wrong")
+            return run(aggregator, collections, *args, **kwargs)
+
+        with mock.patch.object(DailyAggregator, "run", fail_for_collection):
+            with self.assertRaisesMessage(
+                CommandError, f"Failed to aggregate collections {failing.pk}"
+            ):
+                call_command("fill_link_aggregates", workers=3)
+
+        self.assertEqual(
+            set(LinkAggregate.objects.values_list("collection_id", flat=True)),
+            {self.collections[0].pk, self.collections[2].pk},
+        )
+
+
+class AggregateBulkUpsertTest(BaseTransactionTest):
+    def setUp(self):
+        self.organisation = OrganisationFactory(name="ACME Org")
+        self.collection = CollectionFactory(organisation=self.organisation)
+
+    def _aggregate(self, model=LinkAggregate, day=None, **kwargs):
+        return model(
+            organisation=self.organisation,
+            collection=self.collection,
+            full_date=kwargs.pop("full_date", date(2020, 1, 31)),
+            day=day,
+            total_links_added=kwargs.pop("total_links_added", 1),
+            total_links_removed=kwargs.pop("total_links_removed", 0),
+            **kwargs,
+        )
+
+    def test_inserts_and_replaces(self):
+        written = LinkAggregate.objects.bulk_upsert(
+            [
+                self._aggregate(),
+                self._aggregate(full_date=date(2020, 1, 30)),
+            ]
+        )
+        self.assertEqual(written, 2)
+
+        LinkAggregate.objects.bulk_upsert(
+            [self._aggregate(total_links_added=5, total_links_removed=2)]
+        )
+
+        self.assertEqual(LinkAggregate.objects.count(), 2)
+        aggregate = LinkAggregate.objects.get(full_date=date(2020, 1, 31))
+        self.assertEqual(aggregate.total_links_added, 5)
+        self.assertEqual(aggregate.total_links_removed, 2)
+        self.assertEqual((aggregate.day, aggregate.month, aggregate.year), (31, 1, 2020))
+
+    def test_increments(self):
+        UserAggregate.objects.bulk_upsert(
+            [self._aggregate(UserAggregate, day=0, username="Jim")], increment=True
+        )
+        UserAggregate.objects.bulk_upsert(
+            [
+                self._aggregate(UserAggregate, day=0, username="Jim"),
+                self._aggregate(
+                    UserAggregate, day=0, username="Jim", total_links_removed=3
+                ),
+            ],
+            increment=True,
+        )
+
+        aggregate = UserAggregate.objects.get()
+        self.assertEqual(aggregate.day, 0)
+        self.assertEqual(aggregate.total_links_added, 3)
+        self.assertEqual(aggregate.total_links_removed, 3)
+
+    def test_monthly_and_daily_rows_are_distinct(self):
+        PageProjectAggregate.objects.bulk_upsert(
+            [
+                self._aggregate(
+                    PageProjectAggregate,
+                    project_name="en.wikipedia.org",
+                    page_name="Page1",
+                ),
+                self._aggregate(
+                    PageProjectAggregate,
+                    day=0,
+                    project_name="en.wikipedia.org",
+                    page_name="Page1",
+                ),
+            ],
+            increment=True,
+        )
+
+        self.assertEqual(
+            sorted(PageProjectAggregate.objects.values_list("day", flat=True)),
+            [0, 31],
+        )
+
+    def test_unique_constraint(self):
+        LinkAggregate.objects.bulk_create([self._aggregate(day=0, month=1, year=2020)])
+
+        with self.assertRaises(IntegrityError):
+            LinkAggregate.objects.bulk_create(
+                [self._aggregate(day=0, month=1, year=2020)]
+            )
+
+
+class CollectionMonthlyTotalTest(BaseTransactionTest):
+    def setUp(self):
+        self.organisation = OrganisationFactory(name="ACME Org")
+        self.collection = CollectionFactory(organisation=self.organisation)
+        self.url = URLPatternFactory(url="www.google.com")
+        self.url.collections.add(self.collection)
+        for timestamp, change, on_user_list in [
+            (datetime(2020, 1, 1, tzinfo=timezone.utc), LinkEvent.ADDED, False),
+            (datetime(2020, 1, 20, tzinfo=timezone.utc), LinkEvent.ADDED, True),
+            (datetime(2020, 1, 21, tzinfo=timezone.utc), LinkEvent.REMOVED, False),
+            (datetime(2020, 2, 3, tzinfo=timezone.utc), LinkEvent.ADDED, False),
+        ]:
+            LinkEventFactory(
+                content_object=self.url,
+                timestamp=timestamp,
+                change=change,
+                on_user_list=on_user_list,
+            )
+
+    def _totals(self):
+        return sorted(
+            CollectionMonthlyTotal.objects.filter(
+                collection=self.collection
+            ).values_list(
+                "full_date", "on_user_list", "total_links_added", "total_links_removed"
+            )
+        )
+
+    def test_daily_aggregation_fills_monthly_totals(self):
+        call_command("fill_link_aggregates")
+
+        self.assertEqual(
+            self._totals(),
+            [
+                (date(2020, 1, 1), False, 1, 1),
+                (date(2020, 1, 1), True, 1, 0),
+                (date(2020, 2, 1), False, 1, 0),
+            ],
+        )
+
+        LinkEventFactory(
+            content_object=self.url,
+            timestamp=datetime(2020, 2, 5, tzinfo=timezone.utc),
+        )
+        call_command("fill_link_aggregates")
+
+        self.assertIn((date(2020, 2, 1), False, 2, 0), self._totals())
+
+    def test_monthly_aggregation_keeps_monthly_totals(self):
+        call_command("fill_link_aggregates")
+        totals = self._totals()
+
+        call_command("fill_monthly_link_aggregates", year_month="2020-01")
+
+        self.assertEqual(self._totals(), totals)
+
+    def test_daily_aggregation_keeps_archived_days(self):
+        call_command("fill_link_aggregates")
+        # The month has been archived and deleted from the database, leaving
+        # only its monthly totals.
+        LinkAggregate.objects.filter(full_date__month=1).delete()
+        LinkEvent.objects.filter(timestamp__month=1).delete()
+
+        # A late event for the month.
+        LinkEventFactory(
+            content_object=self.url,
+            timestamp=datetime(2020, 1, 21, tzinfo=timezone.utc),
+        )
+        call_command("fill_link_aggregates")
+
+        self.assertEqual(
+            self._totals(),
+            [
+                (date(2020, 1, 1), False, 2, 1),
+                (date(2020, 1, 1), True, 1, 0),
+                (date(2020, 2, 1), False, 1, 0),
+            ],
+        )
+
+    @mock.patch(
+        "extlinks.aggregates.management.commands.fill_collection_monthly_totals.download_aggregates"
+    )
+    def test_fill_folds_in_archives(self, mock_download_aggregates):
+        call_command("fill_link_aggregates")
+        mock_download_aggregates.return_value = [
+            {
+                "organisation": self.organisation.pk,
+                "collection": self.collection.pk,
+                "full_date": "2019-12-01",
+                "day": 1,
+                "month": 12,
+                "year": 2019,
+                "on_user_list": False,
+                "total_links_added": 4,
+                "total_links_removed": 1,
+            },
+            {
+                "organisation": self.organisation.pk,
+                "collection": self.collection.pk,
+                "full_date": "2019-12-02",
+                "day": 2,
+                "month": 12,
+                "year": 2019,
+                "on_user_list": False,
+                "total_links_added": 2,
+                "total_links_removed": 0,
+            },
+        ]
+
+        call_command("fill_collection_monthly_totals")
+
+        # Only months before those in the database are downloaded.
+        self.assertEqual(
+            mock_download_aggregates.call_args.kwargs["to_date"], date(2019, 12, 31)
+        )
+        self.assertEqual(
+            self._totals(),
+            [
+                (date(2019, 12, 1), False, 6, 1),
+                (date(2020, 1, 1), False, 1, 1),
+                (date(2020, 1, 1), True, 1, 0),
+                (date(2020, 2, 1), False, 1, 0),
+            ],
+        )
+
+
+class MergedArchiveCacheTest(BaseTransactionTest):
+    def setUp(self):
+        self.organisation = OrganisationFactory(name="ACME Org")
+        self.collection = CollectionFactory(organisation=self.organisation)
+        self.archives = {
+            f"aggregates_useraggregate_{self.organisation.pk}_{self.collection.pk}_2019-{month}-01_0.json.gz": [
+                {
+                    "model": "aggregates.useraggregate",
+                    "pk": int(month) * 10 + day,
+                    "fields": {
+                        "organisation": self.organisation.pk,
+                        "collection": self.collection.pk,
+                        "username": username,
+                        "full_date": f"2019-{month}-{day:02}",
+                        "day": day,
+                        "month": int(month),
+                        "year": 2019,
+                        "on_user_list": False,
+                        "total_links_added": 2,
+                        "total_links_removed": 1,
+                    }
+                }
+                for day, username in [(1, "alice"), (2, "alice"), (3, "bob")]
+            ]
+            for month in ["01", "02"]
+        }
+        storage.merged_archive_cache.clear()
+        storage.archive_catalog.clear()
+
+    def tearDown(self):
+        storage.merged_archive_cache.clear()
+        storage.archive_catalog.clear()
+
+    def _download(self, **kwargs):
+        with mock.patch(
+            "extlinks.aggregates.storage.get_archive_list",
+            return_value=[{"name": name} for name in self.archives],
+        ), mock.patch(
+            "extlinks.aggregates.storage.get_archives",
+            side_effect=lambda names: {
+                name: gzip.compress(json.dumps(self.archives[name]).encode("utf-8"))
+                for name in names
+            },
+        ), mock.patch(
+            "extlinks.aggregates.storage.decode_archive_columns",
+            wraps=storage.decode_archive_columns,
+        ) as mock_decode_archive_columns:
+            records = storage.download_aggregates(
+                prefix="aggregates_useraggregate",
+                queryset_filter=Q(collection=self.collection),
+                **kwargs,
+            )
+
+        return records, mock_decode_archive_columns.call_count
+
+    def test_records_are_summed_by_month(self):
+        records, _ = self._download()
+
+        self.assertEqual(
+            sorted(
+                (
+                    record["month"],
+                    record["username"],
+                    record["total_links_added"],
+                    record["total_links_removed"],
+                )
+                for record in records
+            ),
+            [
+                (1, "alice", 4, 2),
+                (1, "bob", 2, 1),
+                (2, "alice", 4, 2),
+                (2, "bob", 2, 1),
+            ],
+        )
+        self.assertNotIn("day", records[0])
+
+    def test_archives_are_decoded_once(self):
+        records, decode_count = self._download()
+        self.assertEqual(decode_count, 2)
+
+        # Callers can modify what they get back without affecting the cache.
+        records[0]["total_links_added"] = 100
+
+        cached_records, decode_count = self._download()
+        self.assertEqual(decode_count, 0)
+        self.assertEqual(
+            sum(record["total_links_added"] for record in cached_records), 12
+        )
+
+        # Other date ranges are cached separately.
+        records, decode_count = self._download(to_date=date(2019, 1, 31))
+        self.assertEqual(decode_count, 1)
+        self.assertEqual(len(records), 2)
+
+    def test_entries_are_evicted(self):
+        cache = storage.MergedArchiveCache(max_entries=2, expiration=60)
+        record = {
+            "username": "alice",
+            "total_links_added": 1,
+            "total_links_removed": 0,
+        }
+        cache.set("a", [record])
+        cache.set("b", [record])
+        cache.get("a")
+        cache.set("c", [record])
+
+        # The least recently used entry is evicted first.
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), [record])
+        self.assertEqual(cache.get("c"), [record])
+
+        with mock.patch(
+            "extlinks.aggregates.storage.time.monotonic",
+            return_value=storage.time.monotonic() + 61,
+        ):
+            self.assertIsNone(cache.get("a"))
+
+
+class ArchiveCatalogTest(BaseTransactionTest):
+    def setUp(self):
+        self.archives = [
+            {"name": "aggregates_linkaggregate_1_2_2019-03-01_0.json.gz"},
+            {"name": "aggregates_linkaggregate_1_2_2019-01-01_0.json.gz"},
+            {"name": "aggregates_linkaggregate_1_2_2019-02-01_0.json.gz"},
+            {"name": "aggregates_linkaggregate_1_2_2019-02-01_1.json.gz"},
+            {"name": "aggregates_linkaggregate_1_3_2019-02-01_0.json.gz"},
+            {"name": "aggregates_useraggregate_1_2_2019-02-01_0.json.gz"},
+            {"name": "unrelated.json.gz"},
+        ]
+        storage.archive_catalog.clear()
+
+    def tearDown(self):
+        storage.archive_catalog.clear()
+
+    def test_find(self):
+        with mock.patch(
+            "extlinks.aggregates.storage.get_archive_list",
+            return_value=self.archives,
+        ) as mock_get_archive_list:
+            self.assertEqual(
+                storage.archive_catalog.find("aggregates_linkaggregate", 2, False),
+                [
+                    "aggregates_linkaggregate_1_2_2019-01-01_0.json.gz",
+                    "aggregates_linkaggregate_1_2_2019-02-01_0.json.gz",
+                    "aggregates_linkaggregate_1_2_2019-03-01_0.json.gz",
+                ],
+            )
+            self.assertEqual(
+                storage.archive_catalog.find(
+                    "aggregates_linkaggregate",
+                    2,
+                    False,
+                    from_date=date(2019, 2, 1),
+                    to_date=date(2019, 2, 28),
+                ),
+                ["aggregates_linkaggregate_1_2_2019-02-01_0.json.gz"],
+            )
+            self.assertEqual(
+                storage.archive_catalog.find("aggregates_linkaggregate", 2, True),
+                ["aggregates_linkaggregate_1_2_2019-02-01_1.json.gz"],
+            )
+            self.assertEqual(
+                storage.archive_catalog.find("aggregates_linkaggregate", 4, False),
+                [],
+            )
+
+        # The archive list is only parsed once.
+        mock_get_archive_list.assert_called_once_with("aggregates_linkaggregate")
+
+    def test_invalidate(self):
+        with mock.patch(
+            "extlinks.aggregates.storage.get_archive_list",
+            return_value=self.archives[:1],
+        ):
+            self.assertEqual(
+                len(storage.archive_catalog.find("aggregates_linkaggregate", 2, False)),
+                1,
+            )
+
+        storage.invalidate_archive_catalog("aggregates_linkaggregate")
+
+        with mock.patch(
+            "extlinks.aggregates.storage.get_archive_list",
+            return_value=self.archives,
+        ):
+            self.assertEqual(
+                len(storage.archive_catalog.find("aggregates_linkaggregate", 2, False)),
+                3,
+            )
+
+
+class ConsolidatedArchiveTest(BaseTransactionTest):
+    def setUp(self):
+        self.organisation = OrganisationFactory(name="ACME Org")
+        self.collection = CollectionFactory(organisation=self.organisation)
+        self.records = [
+            {
+                "model": "aggregates.useraggregate",
+                "pk": pk,
+                "fields": {
+                    "organisation": self.organisation.pk,
+                    "collection": self.collection.pk,
+                    "username": username,
+                    "full_date": full_date,
+                    "day": int(full_date[-2:]),
+                    "month": 1,
+                    "year": 2019,
+                    "on_user_list": on_user_list,
+                    "total_links_added": 2,
+                    "total_links_removed": 1,
+                },
+            }
+            for pk, username, full_date, on_user_list in [
+                (1, "alice", "2019-01-01", True),
+                (2, "bob", "2019-01-02", False),
+                (3, "alice", "2019-01-20", True),
+            ]
+        ]
+        self.name = storage.consolidated_archive_name(
+            "aggregates_useraggregate",
+            self.organisation.pk,
+            self.collection.pk,
+            date(2019, 1, 1),
+        )
+        self.archive = storage.encode_consolidated_archive(
+            self.organisation.pk, self.collection.pk, date(2019, 1, 1), self.records
+        )
+        storage.merged_archive_cache.clear()
+        storage.archive_catalog.clear()
+
+    def tearDown(self):
+        storage.merged_archive_cache.clear()
+        storage.archive_catalog.clear()
+
+    def _download(self, archive_names, **kwargs):
+        with mock.patch(
+            "extlinks.aggregates.storage.get_archive_list",
+            return_value=[{"name": name} for name in archive_names],
+        ), mock.patch(
+            "extlinks.aggregates.storage.get_archives",
+            side_effect=lambda names: {name: self.archive for name in names},
+        ) as mock_get_archives:
+            records = storage.download_aggregates(
+                prefix="aggregates_useraggregate", **kwargs
+            )
+
+        return records, mock_get_archives
+
+    def test_decode(self):
+        self.assertEqual(storage.decode_archive(self.archive), self.records)
+
+    def test_download_filters_records(self):
+        records, _ = self._download(
+            [self.name],
+            queryset_filter=Q(collection=self.collection, on_user_list=True),
+            from_date=date(2019, 1, 15),
+        )
+
+        self.assertEqual(
+            [(record["username"], record["total_links_added"]) for record in records],
+            [("alice", 2)],
+        )
+
+    def test_download_prefers_consolidated_archives(self):
+        legacy_name = f"aggregates_useraggregate_{self.organisation.pk}_{self.collection.pk}_2019-01-01_0.json.gz"
+
+        records, mock_get_archives = self._download(
+            [legacy_name, self.name], queryset_filter=Q(collection=self.collection)
+        )
+
+        mock_get_archives.assert_called_once_with((self.name,))
+        self.assertEqual(
+            sorted(
+                (record["username"], record["total_links_added"]) for record in records
+            ),
+            [("alice", 4), ("bob", 2)],
+        )
+
+    def test_columnar_archive(self):
+        archive = storage.encode_columnar_archive(
+            self.organisation.pk, self.collection.pk, date(2019, 1, 1), self.records
+        )
+
+        self.assertEqual(storage.decode_archive(archive), self.records)
+
+        columns = storage.decode_archive_columns(archive)
+        self.assertEqual(list(columns["pk"]), [1, 2, 3])
+        self.assertEqual(columns["username"], ["alice", "bob", "alice"])
+        self.assertEqual(columns["on_user_list"], [True, False, True])
+        self.assertEqual(sum(columns["total_links_added"]), 6)
+
+        self.archive = archive
+        records, _ = self._download(
+            [self.name],
+            queryset_filter=Q(collection=self.collection, on_user_list=True),
+        )
+        self.assertEqual(
+            [(record["username"], record["total_links_added"]) for record in records],
+            [("alice", 4)],
+        )
+
+    @mock.patch("extlinks.common.swift.swift_connection")
+    @mock.patch("extlinks.common.swift.batch_upload_files")
+    @mock.patch("extlinks.common.swift.batch_download_files")
+    @mock.patch("extlinks.common.swift.get_object_list")
+    def test_consolidate_command(
+        self,
+        mock_get_object_list,
+        mock_batch_download_files,
+        mock_batch_upload_files,
+        mock_swift_connection,
+    ):
+        prefix = f"aggregates_useraggregate_{self.organisation.pk}_{self.collection.pk}"
+        legacy_archives = {
+            f"{prefix}_2019-01-01_0.json.gz": self.records[:1],
+            f"{prefix}_2019-01-01_1.json.gz": self.records[:1],
+            f"{prefix}_2019-01-02_0.json.gz": self.records[1:2],
+            f"{prefix}_2019-01-20_0.json.gz": self.records[2:],
+            f"{prefix}_2019-01-20_1.json.gz": self.records[2:],
+        }
+        mock_get_object_list.side_effect = lambda conn, container, prefix: (
+            [{"name": name} for name in legacy_archives]
+            if prefix == "aggregates_useraggregate_"
+            else []
+        )
+        mock_batch_download_files.side_effect = lambda conn, container, names: {
+            name: gzip.compress(json.dumps(legacy_archives[name]).encode("utf-8"))
+            for name in names
+        }
+        uploaded = {}
+
+        def upload(conn, container, paths):
+            for path in paths:
+                with open(path, "rb") as archive:
+                    uploaded[os.path.basename(path)] = archive.read()
+            return paths, []
+
+        mock_batch_upload_files.side_effect = upload
+
+        call_command("consolidate_aggregate_archives", "--delete")
+
+        # The user list archives are not needed as their records are also in
+        # the archives for all users.
+        self.assertEqual(
+            sorted(mock_batch_download_files.call_args.args[2]),
+            [
+                f"{prefix}_2019-01-01_0.json.gz",
+                f"{prefix}_2019-01-02_0.json.gz",
+                f"{prefix}_2019-01-20_0.json.gz",
+            ],
+        )
+        self.assertEqual(list(uploaded), [self.name])
+        self.assertEqual(storage.decode_archive(uploaded[self.name]), self.records)
+        mock_swift_connection.return_value.delete_object.assert_has_calls(
+            [mock.call(mock.ANY, name) for name in legacy_archives], any_order=True
+        )
+
+
+class StorageTotalsTest(BaseTransactionTest):
+    def test_find_top(self):
+        records = [
+            {"username": "alice", "links_diff": 2},
+            {"username": "bob", "links_diff": 5},
+            {"username": "carol", "links_diff": -1},
+            {"username": "dave", "links_diff": 2},
+        ]
+
+        self.assertEqual(
+            storage.find_top(records, key=lambda x: x["links_diff"], count=3),
+            [records[1], records[0], records[3]],
+        )
+        self.assertEqual(
+            storage.find_top(iter(records), key=lambda x: x["links_diff"], count=10),
+            [records[1], records[0], records[3], records[2]],
+        )
+
+    def test_count_unique_is_exact_below_limit(self):
+        self.assertEqual(storage.count_unique(["a", "b", "a", "c"]), 3)
+        self.assertEqual(storage.count_unique([]), 0)
+
+    def test_count_unique_estimates_above_limit(self):
+        values = (f"user-{i % 20000}" for i in range(40000))
+
+        count = storage.count_unique(values, max_exact=1000)
+
+        self.assertAlmostEqual(count, 20000, delta=20000 * 0.03)
+
+    def test_hyperloglog_small_counts(self):
+        estimator = storage.HyperLogLog()
+        for value in ["a", "b", "c", "a"]:
+            estimator.add(value)
+
+        self.assertEqual(estimator.count(), 3)
+
+
 class MonthlyLinkAggregateCommandTest(BaseTransactionTest):
     def setUp(self):
         self.organisation = OrganisationFactory(name="ACME Org")
@@ -1381,6 +2293,121 @@ class ArchiveLinkAggregatesCommandTest(BaseTransactionTest):
 
         self.assertEqual(LinkAggregate.objects.count(), 3)
 
+    @mock.patch("swiftclient.Connection")
+    def test_dump_and_load_consolidated_link_aggregates(
+        self, mock_swift_connection
+    ):
+        mock_conn = mock_swift_connection.return_value
+        mock_conn.get_account.return_value = (
+            {},
+            [{"name": "archive-aggregates-test"}],
+        )
+        mock_conn.put_container.return_value = ({}, [])
+        mock_conn.put_object.return_value = ""
+        self.jan_aggregate.on_user_list = True
+        self.jan_aggregate.save()
+        LinkAggregateFactory(
+            full_date=date(2023, 1, 2),
+            organisation=self.organisation,
+            collection=self.collection,
+        )
+        expected = json.loads(
+            serializers.serialize(
+                "json", LinkAggregate.objects.filter(full_date__month=1).order_by("pk")
+            )
+        )
+
+        call_command(
+            "archive_link_aggregates",
+            "dump",
+            "--from",
+            "2023-01",
+            "--to",
+            "2023-03",
+            "--output",
+            self.output_dir,
+            "--consolidate",
+        )
+
+        # One archive per month, which holds rows on the user list only once.
+        self.assertEqual(
+            sorted(os.listdir(self.output_dir)),
+            [
+                f"aggregates_linkaggregate_{self.organisation.id}_{self.collection.id}_2023-{month}.json.gz"
+                for month in ["01", "02", "03"]
+            ],
+        )
+        with open(
+            os.path.join(
+                self.output_dir,
+                f"aggregates_linkaggregate_{self.organisation.id}_{self.collection.id}_2023-01.json.gz",
+            ),
+            "rb",
+        ) as archive:
+            self.assertEqual(storage.decode_archive(archive.read()), expected)
+        self.assertEqual(LinkAggregate.objects.count(), 0)
+
+        archives = (
+            os.path.join(self.output_dir, filename)
+            for filename in os.listdir(self.output_dir)
+        )
+        call_command(
+            "archive_link_aggregates",
+            "load",
+            *archives,
+        )
+
+        self.assertEqual(LinkAggregate.objects.count(), 4)
+        self.assertEqual(
+            LinkAggregate.objects.get(pk=self.mar_aggregate.pk).total_links_removed,
+            15,
+        )
+
+    @mock.patch("swiftclient.Connection")
+    def test_dump_and_load_columnar_link_aggregates(self, mock_swift_connection):
+        mock_conn = mock_swift_connection.return_value
+        mock_conn.get_account.return_value = (
+            {},
+            [{"name": "archive-aggregates-test"}],
+        )
+        mock_conn.put_container.return_value = ({}, [])
+        mock_conn.put_object.return_value = ""
+        expected = json.loads(
+            serializers.serialize("json", LinkAggregate.objects.order_by("pk"))
+        )
+
+        call_command(
+            "archive_link_aggregates",
+            "dump",
+            "--from",
+            "2023-01",
+            "--to",
+            "2023-03",
+            "--output",
+            self.output_dir,
+            "--columnar",
+        )
+
+        archives = sorted(
+            os.path.join(self.output_dir, filename)
+            for filename in os.listdir(self.output_dir)
+        )
+        self.assertEqual(len(archives), 3)
+        records = []
+        for filename in archives:
+            with open(filename, "rb") as archive:
+                records.extend(storage.decode_archive(archive.read()))
+        self.assertEqual(records, expected)
+        self.assertEqual(LinkAggregate.objects.count(), 0)
+
+        call_command(
+            "archive_link_aggregates",
+            "load",
+            *archives,
+        )
+
+        self.assertEqual(LinkAggregate.objects.count(), 3)
+
     @mock.patch("swiftclient.Connection")
     def test_link_aggregate_upload(self, mock_swift_connection):
         mock_conn = mock_swift_connection.return_value
@@ -1414,12 +2441,19 @@ class ArchiveLinkAggregatesCommandTest(BaseTransactionTest):
             os.path.join(self.output_dir, filename)
             for filename in os.listdir(self.output_dir)
         )
-        call_command(
-            "archive_link_aggregates",
-            "upload",
-            "--container",
-            "fakecontainer",
-            *archives,
+        with mock.patch(
+            "extlinks.aggregates.storage.invalidate_archive_catalog"
+        ) as mock_invalidate_archive_catalog:
+            call_command(
+                "archive_link_aggregates",
+                "upload",
+                "--container",
+                "fakecontainer",
+                *archives,
+            )
+
+        mock_invalidate_archive_catalog.assert_called_once_with(
+            "aggregates_linkaggregate"
         )
 
         mock_conn.put_object.assert_has_calls(
@@ -4019,6 +5053,79 @@ class FixAggregatesForOrganisationAndMonthCommandTest(BaseTransactionTest):
                 os.remove(file)
 
 
+    @mock.patch.dict(
+        os.environ,
+        {
+            "OPENSTACK_AUTH_URL": "fakeurl",
+            "SWIFT_APPLICATION_CREDENTIAL_ID": "fakecredid",
+            "SWIFT_APPLICATION_CREDENTIAL_SECRET": "fakecredsecret",
+        },
+    )
+    @mock.patch("swiftclient.Connection")
+    def test_reaggregate_link_archives_daily_skips_if_uploaded_consolidated_aggregates(self, mock_swift_connection):
+        mock_conn = mock_swift_connection.return_value
+        mock_conn.get_account.return_value = (
+            {},
+            [],
+        )
+        mock_conn.get_container.return_value = (
+            {},
+            [
+                {
+                    "name": storage.consolidated_archive_name(
+                        "aggregates_linkaggregate", 100, 10, date(2024, 12, 1)
+                    )
+                }
+            ],
+        )
+        temp_dir = tempfile.gettempdir()
+        archive_filename = "links_linkevent_20241222_0.json.gz"
+        archive_path = os.path.join(temp_dir, archive_filename)
+        json_data = [
+            {
+                "model": "links.linkevent",
+                "pk": 1,
+                "fields": {
+                    "link": "https://www.test.com/",
+                    "timestamp": "2024-12-15T09:15:27.363Z",
+                    "domain": "en.wikipedia.org",
+                    "content_type": ContentType.objects.get_for_model(URLPattern).id,
+                    "object_id": self.url.id,
+                    "username": self.user.id,
+                    "rev_id": 485489,
+                    "user_id": self.user.id,
+                    "page_title": "test",
+                    "page_namespace": 0,
+                    "event_id": "",
+                    "user_is_bot": False,
+                    "hash_link_event_id": "",
+                    "change": 1,
+                    "on_user_list": True,
+                    "url": []
+                }
+            },
+        ]
+
+        with gzip.open(archive_path, "wt", encoding="utf-8") as f:
+            json.dump(json_data, f)
+
+        try:
+            call_command(
+                "reaggregate_link_archives",
+                "--day",
+                "20241215",
+                "--organisation",
+                self.organisation.id,
+                "--dir",
+                temp_dir,
+            )
+            self.assertEqual(0, LinkAggregate.objects.count())
+            self.assertEqual(0, UserAggregate.objects.count())
+            self.assertEqual(0, PageProjectAggregate.objects.count())
+        finally:
+            for file in glob.glob(archive_path):
+                os.remove(file)
+
     @mock.patch.dict(
         os.environ,
         {
@@ -1,8 +1,11 @@
 import calendar
+import time
 from datetime import date, timedelta
 from itertools import islice
 from typing import Any, Dict
 
+from django.contrib.contenttypes.fields import GenericRel
+from django.db import connections, transaction
 from django.db.models import Avg, Q
 from django.db.models.functions import TruncMonth
 
@@ -226,6 +229,82 @@ def batch_iterator(iterable, size=1000):
         yield batch
 
 
+def delete_in_batches(queryset, batch_size=10_000, throttle=0.0) -> int:
+    """
+    Deletes the rows of a queryset with raw DELETE statements, a batch of
+    primary keys at a time, along with their rows in many-to-many tables.
+
+    Unlike the ORM's delete this skips collecting related objects and
+    signals, and each batch is committed on its own so locks are only held
+    briefly. Contiguous batches of primary keys are deleted as a range.
+
+    Parameters
+    ----------
+    queryset : QuerySet
+        The rows to delete.
+
+    batch_size : int
+        The maximum number of rows deleted per statement.
+
+    throttle : float
+        The number of seconds to pause between batches.
+
+    Returns
+    -------
+    int
+        The number of rows deleted from the queryset's table.
+    """
+    model = queryset.model
+    for relation in model._meta.related_objects:
+        # Generic relations point at this model from elsewhere and don't need
+        # any rows deleted with it.
+        if not isinstance(relation, GenericRel):
+            raise ValueError(
+                f"{model.__name__} is referenced by {relation.related_model.__name__} "
+                "and can't be deleted with raw statements"
+            )
+
+    tables = [
+        (field.m2m_db_table(), field.m2m_column_name())
+        for field in model._meta.local_many_to_many
+        if field.remote_field.through._meta.auto_created
+    ]
+    tables.append((model._meta.db_table, model._meta.pk.column))
+
+    connection = connections[queryset.db]
+    quote_name = connection.ops.quote_name
+    pks = queryset.order_by("pk").values_list("pk", flat=True)
+
+    deleted = 0
+    last_pk = None
+    while True:
+        batch = pks if last_pk is None else pks.filter(pk__gt=last_pk)
+        ids = list(batch[:batch_size])
+        if not ids:
+            break
+
+        if ids[-1] - ids[0] + 1 == len(ids):
+            condition, params = "BETWEEN %s AND %s", [ids[0], ids[-1]]
+        else:
+            condition, params = f"IN ({', '.join(['%s'] * len(ids))})", ids
+
+        with transaction.atomic(using=queryset.db), connection.cursor() as cursor:
+            for table, column in tables:
+                cursor.execute(
+                    f"DELETE FROM {quote_name(table)} WHERE {quote_name(column)} {condition}",
+                    params,
+                )
+
+        deleted += len(ids)
+        last_pk = ids[-1]
+        logger.info("Deleted %d rows from %s", deleted, model._meta.db_table)
+
+        if throttle:
+            time.sleep(throttle)
+
+    return deleted
+
+
 def last_day(date: date) -> int:
     """
     Finds the last day of the month for the given date.
@@ -13,9 +13,16 @@ from django.test import TestCase
 import extlinks.common.swift as swift
 
 from extlinks.common.forms import FilterForm
-from extlinks.common.helpers import get_linksearchtotal_data_by_time
-from extlinks.links.factories import LinkSearchTotalFactory, URLPatternFactory
-from extlinks.links.models import LinkSearchTotal
+from extlinks.common.helpers import (
+    delete_in_batches,
+    get_linksearchtotal_data_by_time,
+)
+from extlinks.links.factories import (
+    LinkEventFactory,
+    LinkSearchTotalFactory,
+    URLPatternFactory,
+)
+from extlinks.links.models import LinkEvent, LinkSearchTotal, URLPattern
 
 SWIFT_TEST_CREDENTIALS = {
     "OPENSTACK_AUTH_URL": "fakeauthurl",
@@ -93,6 +100,47 @@ class LinkSearchDataByTimeTest(TestCase):
             self.assertEqual("February 2020", as_of_date)
 
 
+class DeleteInBatchesTest(TestCase):
+    def setUp(self):
+        self.url_pattern = URLPatternFactory(url="www.jstor.org")
+        self.events = []
+        for day in range(1, 8):
+            event = LinkEventFactory(
+                content_object=self.url_pattern,
+                timestamp=datetime(2021, 1, day, tzinfo=timezone.utc),
+            )
+            event.url.add(self.url_pattern)
+            self.events.append(event)
+
+    @mock.patch("extlinks.common.helpers.time.sleep")
+    def test_delete_in_batches(self, mock_sleep):
+        # Leave a gap in the primary keys so that a batch isn't a range.
+        self.events[1].delete()
+
+        deleted = delete_in_batches(
+            LinkEvent.objects.filter(
+                timestamp__lt=datetime(2021, 1, 6, tzinfo=timezone.utc)
+            ),
+            batch_size=2,
+            throttle=0.5,
+        )
+
+        self.assertEqual(deleted, 4)
+        self.assertEqual(
+            list(LinkEvent.objects.values_list("pk", flat=True).order_by("pk")),
+            [event.pk for event in self.events[5:]],
+        )
+        self.assertEqual(LinkEvent.url.through.objects.count(), 2)
+        self.assertTrue(URLPattern.objects.filter(pk=self.url_pattern.pk).exists())
+        self.assertEqual(mock_sleep.call_count, 2)
+        mock_sleep.assert_called_with(0.5)
+
+    def test_delete_in_batches_referenced_model(self):
+        with self.assertRaises(ValueError):
+            delete_in_batches(URLPattern.objects.all())
+        self.assertTrue(URLPattern.objects.exists())
+
+
 class FilterFormTest(TestCase):
 
     def test_valid_data(self):
@@ -0,0 +1,66 @@
+import logging
+import time
+from typing import Optional
+
+from .models import StreamCheckpoint
+from .writer import LinkEventWriter
+
+logger = logging.getLogger("django")
+
+DEFAULT_CHECKPOINT_INTERVAL_SECS = 10
+
+
+class StreamCheckpointer:
+    """
+    Periodically records the id of the last stream event we've processed.
+
+    Before a checkpoint is saved the writer is flushed, so every link event
+    up to the checkpointed event is in the database. Resuming from the
+    checkpoint therefore can't skip an event, and only replays events
+    processed since it was saved.
+    """
+
+    def __init__(
+        self,
+        stream: str,
+        writer: LinkEventWriter,
+        interval_secs: float = DEFAULT_CHECKPOINT_INTERVAL_SECS,
+    ):
+        self.stream = stream
+        self.writer = writer
+        self.interval = interval_secs
+        self.last_event_id: Optional[str] = None
+
+        self._saved_event_id: Optional[str] = None
+        self._saved_at = time.monotonic()
+
+    def load(self) -> Optional[str]:
+        """
+        Returns the last checkpointed event id for this stream, if any.
+        """
+        checkpoint = StreamCheckpoint.objects.filter(stream=self.stream).first()
+        if checkpoint is None:
+            return None
+        return checkpoint.last_event_id
+
+    def processed(self, event_id: Optional[str]):
+        """
+        Records that an event has been processed, saving a checkpoint if
+        one is due. Call this once the event's links have been handed to
+        the writer.
+        """
+        if event_id:
+            self.last_event_id = event_id
+        if time.monotonic() - self._saved_at >= self.interval:
+            self.save()
+
+    def save(self):
+        self._saved_at = time.monotonic()
+        if self.last_event_id is None or self.last_event_id == self._saved_event_id:
+            return
+
+        self.writer.flush()
+        StreamCheckpoint.objects.update_or_create(
+            stream=self.stream, defaults={"last_event_id": self.last_event_id}
+        )
+        self._saved_event_id = self.last_event_id
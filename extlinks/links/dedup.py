@@ -0,0 +1,156 @@
+import logging
+import math
+from datetime import datetime, timedelta
+from typing import Iterable, Optional, Tuple
+
+from .models import LinkEvent
+
+logger = logging.getLogger("django")
+
+# The EventStream keeps ~7 days of historical data, so that's as far back as
+# a --historical restart can replay events we've already stored.
+REPLAY_WINDOW = timedelta(days=7)
+# Comfortably more tracked links than we see in a replay window.
+DEFAULT_CAPACITY = 1_000_000
+DEFAULT_ERROR_RATE = 0.01
+
+
+class RollingBloomFilter:
+    """
+    A Bloom filter over sha256 hex digests that remembers at least the last
+    `capacity` digests added to it.
+
+    Digests are added to a current generation; once that holds `capacity`
+    digests it becomes the previous generation and a new one is started, so
+    memory stays bounded however long the process runs. Lookups check both
+    generations.
+
+    The digests are already uniformly distributed, so their bits are used
+    directly as the filter's hash functions.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        self.capacity = capacity
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        # A sha256 digest gives us at most 8 32-bit indices.
+        self.hash_count = min(8, max(1, round(self.size / capacity * math.log(2))))
+
+        self._current = bytearray(self.size // 8 + 1)
+        self._previous = bytearray(self.size // 8 + 1)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _indices(self, digest: str):
+        for i in range(self.hash_count):
+            yield int(digest[i * 8 : (i + 1) * 8], 16) % self.size
+
+    def add(self, digest: str) -> bool:
+        """
+        Adds a digest, returning True if the previous generation had to be
+        forgotten to make room for it.
+        """
+        rotated = self._count >= self.capacity
+        if rotated:
+            self._previous = self._current
+            self._current = bytearray(self.size // 8 + 1)
+            self._count = 0
+
+        for index in self._indices(digest):
+            self._current[index >> 3] |= 1 << (index & 7)
+        self._count += 1
+        return rotated
+
+    def __contains__(self, digest: str) -> bool:
+        indices = list(self._indices(digest))
+        return all(
+            self._current[index >> 3] & (1 << (index & 7)) for index in indices
+        ) or all(self._previous[index >> 3] & (1 << (index & 7)) for index in indices)
+
+
+class LinkEventDedupFilter:
+    """
+    Tracks which LinkEvents (by hash_link_event_id) are already stored, so
+    that most new links can be ruled out as duplicates without a query.
+
+    The database is only asked when the filter says a hash has maybe been
+    seen before, or when the event is older than anything the filter still
+    remembers: events from before it was warmed, or from before the newest
+    event of a generation the rolling filter has since forgotten.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        self._filter = RollingBloomFilter(capacity=capacity, error_rate=error_rate)
+        # Events from before this aren't in the filter.
+        self.since: Optional[datetime] = None
+        # The newest event timestamp in each of the filter's generations.
+        self._current_newest: Optional[datetime] = None
+        self._previous_newest: Optional[datetime] = None
+
+    def warm(self, since: datetime) -> int:
+        """
+        Adds every LinkEvent stored since the given datetime to the filter,
+        returning how many were added.
+
+        Events are added oldest first, so that if there are more than the
+        filter can hold it's the oldest ones that are forgotten.
+        """
+        self.since = since
+        link_events = (
+            LinkEvent.objects.filter(timestamp__gte=since)
+            .order_by("timestamp")
+            .values_list("hash_link_event_id", "timestamp")
+            .iterator()
+        )
+        count = self.update(link_events)
+        logger.info("Warmed link event dedup filter with %d events", count)
+        return count
+
+    def update(self, link_events: Iterable[Tuple[str, datetime]]) -> int:
+        count = 0
+        for hash_link_event_id, timestamp in link_events:
+            self.add(hash_link_event_id, timestamp)
+            count += 1
+        return count
+
+    def add(self, hash_link_event_id: str, timestamp: datetime):
+        if self._filter.add(hash_link_event_id):
+            # Anything up to the newest event of the forgotten generation
+            # has to be checked against the database from now on.
+            forgotten_newest = self._previous_newest
+            self._previous_newest = self._current_newest
+            self._current_newest = None
+            if self.since is not None and forgotten_newest is not None:
+                self.since = max(
+                    self.since, forgotten_newest + timedelta(microseconds=1)
+                )
+
+        if self._current_newest is None or timestamp > self._current_newest:
+            self._current_newest = timestamp
+
+    def exists(self, hash_link_event_id: str, timestamp: datetime) -> bool:
+        """
+        Returns whether a LinkEvent with this hash is already stored.
+
+        Parameters
+        ----------
+        hash_link_event_id : str
+            The hash of the link and its event id.
+
+        timestamp : datetime
+            When the event happened. Events older than the filter's warm up
+            window are always checked against the database.
+
+        Returns
+        -------
+        bool
+            True if the event is already stored.
+        """
+        covered = self.since is not None and timestamp >= self.since
+        if covered and hash_link_event_id not in self._filter:
+            return False
+
+        return LinkEvent.objects.filter(
+            hash_link_event_id=hash_link_event_id
+        ).exists()
@@ -0,0 +1,68 @@
+import logging
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import close_old_connections
+
+from extlinks.common.management.commands import BaseCommand
+from extlinks.links.models import LinkEvent, URLPattern
+
+logger = logging.getLogger("django")
+
+BATCH_SIZE = 10_000
+
+
+class Command(BaseCommand):
+    help = (
+        "Fills in the collection and organisation of LinkEvents that were "
+        "written before LinkEvents recorded them"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=BATCH_SIZE,
+            help="The number of LinkEvents updated at a time.",
+        )
+
+    def _handle(self, *args, **options):
+        matcher = URLPattern.objects.matcher()
+        url_pattern_type = ContentType.objects.get_for_model(URLPattern)
+        link_events = (
+            LinkEvent.objects.filter(
+                content_type=url_pattern_type, collection__isnull=True
+            )
+            .order_by("pk")
+            .values_list("pk", "link")
+        )
+
+        total = 0
+        last_pk = 0
+        while batch := list(
+            link_events.filter(pk__gt=last_pk)[: options["batch_size"]]
+        ):
+            last_pk = batch[-1][0]
+
+            # Events are given a collection the way LinkEventWriter does: the
+            # legacy collection of the first URL pattern their link matches.
+            # Events whose first pattern has none are left without one, and
+            # are still found through their URL pattern.
+            collection_link_events = defaultdict(list)
+            for pk, link in batch:
+                url_patterns = matcher.matches(link)
+                if url_patterns and url_patterns[0].collection is not None:
+                    collection = url_patterns[0].collection
+                    collection_link_events[
+                        (collection.pk, collection.organisation_id)
+                    ].append(pk)
+
+            for (collection_id, organisation_id), pks in sorted(
+                collection_link_events.items()
+            ):
+                total += LinkEvent.objects.filter(pk__in=pks).update(
+                    collection_id=collection_id, organisation_id=organisation_id
+                )
+            logger.info("Backfilled %d LinkEvents", total)
+
+        close_old_connections()
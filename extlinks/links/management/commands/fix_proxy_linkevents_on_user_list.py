@@ -2,11 +2,13 @@ from extlinks.common.management.commands import BaseCommand
 from django.core.management import call_command
 
 from extlinks.aggregates.models import (
+    AggregateWatermark,
     LinkAggregate,
     PageProjectAggregate,
     UserAggregate,
 )
 from extlinks.links.models import LinkEvent
+from extlinks.organisations.models import Organisation
 
 
 class Command(BaseCommand):
@@ -31,9 +33,11 @@ class Command(BaseCommand):
                     for collection in collections:
                         collection_list.add(collection.id)
                         organisation = collection.organisation
-                        username_list = organisation.username_list
-                        if username_list:
-                            if linkevent.username in username_list.all():
+                        username_list = Organisation.objects.user_list_usernames(
+                            organisation.pk
+                        )
+                        if username_list and linkevent.username:
+                            if linkevent.username.username in username_list:
                                 linkevent.on_user_list = True
                                 linkevent.save()
 
@@ -47,6 +51,11 @@ class Command(BaseCommand):
                 UserAggregate.objects.filter(
                     collection__in=collection_list, full_date__gte=earliest_link_date
                 ).delete()
+                # Recount from the latest remaining aggregates rather than
+                # only counting new events
+                AggregateWatermark.objects.filter(
+                    collection__in=collection_list
+                ).delete()
 
                 call_command("fill_link_aggregates", collections=collection_list)
                 call_command("fill_pageproject_aggregates", collections=collection_list)
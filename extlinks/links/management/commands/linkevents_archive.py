@@ -1,14 +1,18 @@
-import gzip, datetime, logging, os
+import gzip, datetime, itertools, logging, os
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from swiftclient import ClientException
 
 from typing import List, Optional
 
 from django.core import serializers
 from extlinks.common import swift
+from extlinks.common.helpers import delete_in_batches
 from extlinks.common.management.commands import BaseCommand
 from django.core.management import call_command
 from django.db import close_old_connections
+from django.db.models import Q
 
 from extlinks.links.models import LinkEvent
 from extlinks.aggregates.models import (
@@ -20,9 +24,64 @@ from extlinks.aggregates.models import (
 logger = logging.getLogger("django")
 
 CHUNK_SIZE = 10_000
+# The number of LinkEvents fetched from the database at a time while an
+# archive is being written.
+FETCH_SIZE = 1_000
+# The amount of serialized text compressed into each gzip member by the
+# parallel compressor.
+COMPRESS_BLOCK_SIZE = 1024 * 1024
 SWIFT_CONTAINER_NAME = os.environ.get("SWIFT_CONTAINER_NAME", "archive-linkevents")
 
 
+class ParallelGzipWriter:
+    """
+    A text stream that compresses blocks of what is written to it on a pool
+    of threads. Each block becomes a gzip member of its own, and the members
+    are written in order, so the file can be read like any other gzip file.
+    """
+
+    def __init__(self, path: str, workers: int, block_size: Optional[int] = None):
+        self._file = open(path, "wb")
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        # Bound the number of blocks in flight to keep memory use constant.
+        self._max_pending = workers * 2
+        self._pending = deque()
+        self._block_size = block_size or COMPRESS_BLOCK_SIZE
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, text: str) -> int:
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self._block_size:
+            self._submit()
+        return len(text)
+
+    def _submit(self):
+        block = "".join(self._buffer).encode("utf-8")
+        self._buffer = []
+        self._buffered = 0
+        self._pending.append(self._executor.submit(gzip.compress, block, mtime=0))
+        while len(self._pending) >= self._max_pending:
+            self._file.write(self._pending.popleft().result())
+
+    def close(self):
+        try:
+            if self._buffer:
+                self._submit()
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+        finally:
+            self._executor.shutdown(cancel_futures=True)
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 class Command(BaseCommand):
     help = "dump & delete or load LinkEvents"
 
@@ -49,6 +108,9 @@ class Command(BaseCommand):
         date: Optional[datetime.date] = None,
         output: Optional[str] = None,
         object_storage_only=False,
+        compress_workers: int = 1,
+        delete_batch_size: int = CHUNK_SIZE,
+        delete_throttle: float = 0.0,
     ):
         """
         Export LinkEvents to gzipped JSON files that are grouped by day, and
@@ -56,7 +118,10 @@ class Command(BaseCommand):
 
         This command only archives LinkEvents that have been aggregated by
         checking the cron job log. Optionally a date (YYYY-MM-DD) can be passed
-        as a parameter to override this behavior.
+        as a parameter to override this behavior. Archives are compressed on
+        compress_workers threads, and archived LinkEvents are deleted
+        delete_batch_size at a time with a pause of delete_throttle seconds
+        between batches.
         """
 
         output_dir = output if output and os.path.isdir(output) else "backup"
@@ -86,51 +151,116 @@ class Command(BaseCommand):
 
         start = archive_start_time - datetime.timedelta(days=1)
         total = 0
-        iteration = 0
 
-        # Page through LinkEvents for all days prior to the day that all of the
+        # Archive LinkEvents for all days prior to the day that all of the
         # most recent aggregation jobs have started. This should be yesterday's
         # date, but if the jobs haven't all been completed yet then it will
         # probably be the day before yesterday.
         while True:
-            limit = (iteration + 1) * CHUNK_SIZE
-            offset = iteration * CHUNK_SIZE
-
-            # Paginate through LinkEvents in chunks of 10k at a time. Overfetch
-            # an extra record so we can determine if we need to paginate more.
-            results = list(
-                LinkEvent.objects.filter(
-                    timestamp__gte=start,
-                    timestamp__lt=start + datetime.timedelta(days=1),
-                ).all()[offset : limit + 1]
+            day_total = self._dump_day(
+                start, output_dir, object_storage_only, compress_workers
             )
 
             # For scenario when a date is not given in the command and one day has no results:
             # if there are more days remaining to be processed, decrease the start date and continue
-            if (
-                date is None
-                and len(results) == 0
-                and earliest_date is not None
-                and earliest_date < start
+            if day_total == 0 and not (
+                date is None and earliest_date is not None and earliest_date < start
             ):
-                start -= datetime.timedelta(days=1)
-                continue
-
-            if len(results) == 0:
                 break
 
-            # Remove the overfetched record before saving the archive.
-            linkevents_by_date = results[:CHUNK_SIZE]
+            start -= datetime.timedelta(days=1)
+            total += day_total
 
-            filename = f"links_linkevent_{start.strftime('%Y%m%d')}_{iteration}.json.gz"
-            local_filepath = os.path.join(output_dir, filename)
-            logger.info(
-                "Dumping %d LinkEvents into %s", len(linkevents_by_date), local_filepath
+        logger.info(
+            "Deleting %d LinkEvents before %s from the database",
+            total,
+            archive_start_time.strftime("%Y-%m-%d"),
+        )
+
+        # Delete the objects from the database after all passes are complete,
+        # in short batches so the stream consumer isn't held up by locks.
+        delete_in_batches(
+            LinkEvent.objects.filter(timestamp__lt=archive_start_time),
+            batch_size=delete_batch_size,
+            throttle=delete_throttle,
+        )
+
+    def _dump_day(
+        self,
+        day: datetime.date,
+        output_dir: str,
+        object_storage_only: bool,
+        compress_workers: int,
+    ) -> int:
+        """
+        Export a day of LinkEvents to gzipped JSON files of up to CHUNK_SIZE
+        LinkEvents each.
+
+        LinkEvents are paged through by (timestamp, id) rather than with an
+        offset, and every record is serialized straight into the archive, so
+        a day of any size is archived in linear time and constant memory.
+
+        Parameters
+        ----------
+        day : datetime.date
+            The day of LinkEvents to export.
+
+        output_dir : str
+            The directory the archives are written to.
+
+        object_storage_only : bool
+            Whether to delete the archives once uploaded to Swift.
+
+        compress_workers : int
+            The number of threads compressing each archive.
+
+        Returns
+        -------
+        int
+            The number of LinkEvents exported.
+        """
+        events = (
+            LinkEvent.objects.filter(
+                timestamp__gte=day,
+                timestamp__lt=day + datetime.timedelta(days=1),
             )
+            .prefetch_related("url")
+            .order_by("timestamp", "id")
+        )
+
+        total = 0
+        iteration = 0
+        cursor = {"count": 0, "last": None}
+
+        def track(page):
+            for event in page:
+                cursor["count"] += 1
+                cursor["last"] = (event.timestamp, event.pk)
+                yield event
 
-            # Serialize the records directly in the writer to conserve memory.
-            with gzip.open(local_filepath, "wt", encoding="utf-8") as archive:
-                archive.write(serializers.serialize("json", linkevents_by_date))
+        while True:
+            page = events
+            if cursor["last"] is not None:
+                timestamp, pk = cursor["last"]
+                page = page.filter(
+                    Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, pk__gt=pk)
+                )
+            page = page[:CHUNK_SIZE].iterator(chunk_size=FETCH_SIZE)
+
+            # Only write an archive when there's something left to put in it.
+            first = next(page, None)
+            if first is None:
+                break
+
+            filename = f"links_linkevent_{day.strftime('%Y%m%d')}_{iteration}.json.gz"
+            local_filepath = os.path.join(output_dir, filename)
+
+            cursor["count"] = 0
+            with self._open_archive(local_filepath, compress_workers) as archive:
+                serializers.serialize(
+                    "json", track(itertools.chain([first], page)), stream=archive
+                )
+            logger.info("Dumped %d LinkEvents into %s", cursor["count"], local_filepath)
 
             # Try to upload to Swift, remove local archive if flag is on and upload was successful
             if (
@@ -140,27 +270,21 @@ class Command(BaseCommand):
                 os.remove(local_filepath)
                 logger.info(f"Deleted local file {local_filepath} after upload")
 
-            if len(results) > CHUNK_SIZE:
-                iteration += 1
-            else:
-                start -= datetime.timedelta(days=1)
-                iteration = 0
-
-            total += len(linkevents_by_date)
+            total += cursor["count"]
+            if cursor["count"] < CHUNK_SIZE:
+                break
+            iteration += 1
 
-        logger.info(
-            "Deleting %d LinkEvents before %s from the database",
-            total,
-            archive_start_time.strftime("%Y-%m-%d"),
-        )
+        return total
 
-        # Delete the objects from the database after all passes are complete.
-        # Do this in batches of 10k as well as this has the possibility of
-        # failing when dealing with a lot of records.
-        query_set = LinkEvent.objects.filter(timestamp__lt=archive_start_time)
-        while query_set.exists():
-            delete_query_set = query_set.values_list("id", flat=True)[:CHUNK_SIZE]
-            LinkEvent.objects.filter(pk__in=list(delete_query_set)).delete()
+    def _open_archive(self, local_filepath: str, compress_workers: int):
+        """
+        Open an archive for writing, compressing it on a pool of threads when
+        more than one compress worker is requested.
+        """
+        if compress_workers > 1:
+            return ParallelGzipWriter(local_filepath, compress_workers)
+        return gzip.open(local_filepath, "wt", encoding="utf-8")
 
     def load(self, filenames: List[str]):
         """
@@ -307,6 +431,24 @@ class Command(BaseCommand):
             action="store_true",
             help="If enabled, archives will only be stored in Swift and deleted from local storage after upload.",
         )
+        parser.add_argument(
+            "--compress-workers",
+            type=int,
+            default=1,
+            help="The number of threads used to compress each archive.",
+        )
+        parser.add_argument(
+            "--delete-batch-size",
+            type=int,
+            default=CHUNK_SIZE,
+            help="The number of archived LinkEvents deleted from the database at a time.",
+        )
+        parser.add_argument(
+            "--delete-throttle",
+            type=float,
+            default=0.0,
+            help="The number of seconds to pause between batches of deleted LinkEvents.",
+        )
 
     def _handle(self, *args, **options):
         action = options["action"][0]
@@ -315,6 +457,9 @@ class Command(BaseCommand):
                 date=options["date"],
                 output=options["output"],
                 object_storage_only=options["object_storage_only"],
+                compress_workers=options["compress_workers"],
+                delete_batch_size=options["delete_batch_size"],
+                delete_throttle=options["delete_throttle"],
             )
         if action == "load":
             self.load(filenames=options["filenames"])
@@ -0,0 +1,243 @@
+import json
+import random
+import statistics
+import time
+from datetime import datetime, timezone
+from itertools import islice
+from uuid import uuid4
+
+from django.db import connection, transaction
+from django.test.utils import override_settings
+
+from extlinks.common.management.commands import BaseCommand
+from extlinks.organisations.factories import (
+    CollectionFactory,
+    OrganisationFactory,
+    UserFactory,
+)
+from extlinks.organisations.models import Organisation
+from extlinks.links.dedup import LinkEventDedupFilter, REPLAY_WINDOW
+from extlinks.links.factories import URLPatternFactory
+from extlinks.links.management.commands.linkevents_collect import (
+    Command as CollectCommand,
+)
+from extlinks.links.models import URLPattern
+from extlinks.links.writer import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_FLUSH_INTERVAL_MS,
+    LinkEventWriter,
+)
+
+
+# The URL patterns, user lists and recent link events the benchmark writes to
+# the cache are rolled back along with the database, so keep them out of the
+# cache shared with linkevents_collect.
+BENCHMARK_CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "linkevents_benchmark",
+    }
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays a recorded or synthetic page-links-change stream through "
+        "linkevents_collect and reports its throughput. Everything the "
+        "benchmark writes is rolled back, and it uses a cache of its own."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--file",
+            help="Replay events from this file, one JSON event per line. SSE 'data: ' lines are also accepted",
+        )
+        parser.add_argument(
+            "--stream-url",
+            help="Replay events from this server-sent events stream, e.g. a local stand-in",
+        )
+        parser.add_argument(
+            "--events",
+            type=int,
+            default=1000,
+            help="Number of events to replay",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=0,
+            help="Replay at most this many events per second (0 for as fast as possible)",
+        )
+        parser.add_argument(
+            "--url-patterns",
+            type=int,
+            default=500,
+            help="Make sure at least this many URL patterns exist while benchmarking",
+        )
+        parser.add_argument(
+            "--tracked-ratio",
+            type=float,
+            default=0.05,
+            help="Fraction of synthetic external links that match a URL pattern",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+        )
+        parser.add_argument(
+            "--flush-interval",
+            type=int,
+            default=DEFAULT_FLUSH_INTERVAL_MS,
+        )
+
+    def _handle(self, *args, **options):
+        with override_settings(CACHES=BENCHMARK_CACHES), transaction.atomic():
+            self._benchmark(options)
+            # Leave the database as we found it.
+            transaction.set_rollback(True)
+
+    def _benchmark(self, options):
+        self._create_url_patterns(options["url_patterns"])
+
+        if options["file"]:
+            events = self._read_file(options["file"])
+        elif options["stream_url"]:
+            events = (
+                json.loads(message)
+                for _, message in CollectCommand()._read_messages(
+                    options["stream_url"]
+                )
+            )
+        else:
+            events = self._synthetic_events(options["tracked_ratio"])
+        events = islice(events, options["events"])
+
+        collector = CollectCommand()
+        collector.writer = LinkEventWriter(
+            batch_size=options["batch_size"],
+            flush_interval_ms=options["flush_interval"],
+        )
+        collector.pipeline = None
+        collector.dedup = LinkEventDedupFilter()
+        collector.dedup.warm(datetime.now(timezone.utc) - REPLAY_WINDOW)
+
+        queries = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        latencies = []
+        interval = 1 / options["rate"] if options["rate"] else 0
+        with connection.execute_wrapper(count_queries):
+            started = time.perf_counter()
+            for i, event in enumerate(events):
+                if interval:
+                    delay = started + i * interval - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                event_started = time.perf_counter()
+                collector._evaluate_link(event)
+                collector.writer.maybe_flush()
+                latencies.append(time.perf_counter() - event_started)
+            collector.writer.flush()
+            elapsed = time.perf_counter() - started
+
+        if not latencies:
+            self.stdout.write("No events to replay")
+            return
+
+        self._report(latencies, elapsed, queries, collector.writer.written)
+
+    def _create_url_patterns(self, count):
+        collection = None
+        for i in range(URLPattern.objects.count(), count):
+            # Roughly a handful of URL patterns per collection, and a
+            # collection per organisation, with some organisations limited
+            # to a user list.
+            if collection is None or i % 5 == 0:
+                organisation = OrganisationFactory()
+                if i % 2 == 0:
+                    organisation.username_list.add(
+                        *[UserFactory(username=f"Benchmark user {i}-{j}") for j in range(10)]
+                    )
+                collection = CollectionFactory(organisation=organisation)
+            url_pattern = URLPatternFactory(
+                url=f"www.benchmark-{i}.org", collection=collection
+            )
+            url_pattern.collections.add(collection)
+
+    def _read_file(self, path):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("data:"):
+                    line = line[len("data:") :].strip()
+                if not line.startswith("{"):
+                    continue
+                yield json.loads(line)
+
+    def _synthetic_events(self, tracked_ratio):
+        urls = list(URLPattern.objects.values_list("url", flat=True))
+        # Editors both on and off organisation user lists.
+        usernames = list(
+            Organisation.username_list.through.objects.values_list(
+                "user__username", flat=True
+            )[:100]
+        ) + [f"Benchmark editor {i}" for i in range(100)]
+        while True:
+            links = [
+                {"link": "/wiki/Wikipedia:Citation_needed", "external": False},
+            ]
+            for _ in range(random.randint(1, 5)):
+                if urls and random.random() < tracked_ratio:
+                    url = random.choice(urls)
+                    if random.random() < 0.5:
+                        # A proxied link, as added via the Library Card.
+                        url = url.replace(".", "-") + ".wikipedialibrary.idm.oclc.org"
+                    link = f"https://{url}/{uuid4().hex}"
+                else:
+                    link = f"https://www.example-{random.randint(0, 10000)}.com/{uuid4().hex}"
+                links.append({"link": link, "external": True})
+
+            yield {
+                "meta": {
+                    "id": str(uuid4()),
+                    "dt": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    "domain": "en.wikipedia.org",
+                },
+                "page_title": "Benchmark",
+                "page_namespace": 0,
+                "rev_id": random.randint(10000000, 100000000),
+                "performer": {
+                    "user_text": random.choice(usernames),
+                    "user_is_bot": False,
+                    "user_id": random.randint(10000000, 100000000),
+                },
+                "added_links" if random.random() < 0.75 else "removed_links": links,
+            }
+
+    def _report(self, latencies, elapsed, queries, written):
+        if len(latencies) > 1:
+            percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+            p50, p99 = percentiles[49], percentiles[98]
+        else:
+            p50 = p99 = latencies[0]
+
+        self.stdout.write(
+            "\n".join(
+                [
+                    f"Events:             {len(latencies)}",
+                    f"Link events:        {written}",
+                    f"Elapsed:            {elapsed:.3f}s",
+                    f"Events/sec:         {len(latencies) / elapsed:.1f}",
+                    f"p50 latency:        {p50 * 1000:.3f}ms",
+                    f"p99 latency:        {p99 * 1000:.3f}ms",
+                    f"Queries:            {queries}",
+                    f"Queries per event:  {queries / len(latencies):.3f}",
+                ]
+            )
+        )
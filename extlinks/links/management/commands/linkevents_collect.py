@@ -1,22 +1,32 @@
 # Based heavily on
 # https://github.com/Samwalton9/hashtags/blob/master/scripts/collect_hashtags.py
-import hashlib
-from datetime import datetime
 import json
 import logging
 import sys
+from datetime import datetime, timezone
 from sseclient import SSEClient as EventSource
 from urllib.parse import unquote
-from zoneinfo import ZoneInfo
 
 from extlinks.common.management.commands import BaseCommand
 
-from extlinks.links.helpers import link_is_tracked
+from extlinks.links.checkpoint import (
+    DEFAULT_CHECKPOINT_INTERVAL_SECS,
+    StreamCheckpointer,
+)
+from extlinks.links.dedup import LinkEventDedupFilter, REPLAY_WINDOW
 from extlinks.links.models import LinkEvent, URLPattern
-from extlinks.organisations.models import User
+from extlinks.links.pipeline import DEFAULT_QUEUE_SIZE, LinkEventPipeline
+from extlinks.links.writer import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_FLUSH_INTERVAL_MS,
+    LinkEventWriter,
+    parse_event_datetime,
+)
 
 logger = logging.getLogger("django")
 
+STREAM = "page-links-change"
+
 
 class Command(BaseCommand):
     help = "Monitors page-links-change for link events"
@@ -25,7 +35,7 @@ class Command(BaseCommand):
         parser.add_argument(
             "--historical",
             action="store_true",
-            help="Parse event stream from last logged event",
+            help="Parse event stream from the last checkpoint, or the last logged event",
         )
 
         parser.add_argument(
@@ -34,40 +44,119 @@ class Command(BaseCommand):
             help="Test the command without having to access the stream. Passes a json event",
         )
 
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help="Write matched link events to the database once this many are pending",
+        )
+
+        parser.add_argument(
+            "--flush-interval",
+            type=int,
+            default=DEFAULT_FLUSH_INTERVAL_MS,
+            help="Write matched link events to the database once the oldest has waited this many milliseconds",
+        )
+
+        parser.add_argument(
+            "--pipelined",
+            action="store_true",
+            help="Read, match and write events in separate threads, so slow database writes don't block reading the stream",
+        )
+
+        parser.add_argument(
+            "--queue-size",
+            type=int,
+            default=DEFAULT_QUEUE_SIZE,
+            help="Maximum number of events waiting between each stage in --pipelined mode",
+        )
+
+        parser.add_argument(
+            "--checkpoint-interval",
+            type=int,
+            default=DEFAULT_CHECKPOINT_INTERVAL_SECS,
+            help="Save the id of the last processed stream event every this many seconds",
+        )
+
     def _handle(self, *args, **options):
-        base_stream_url = "https://stream.wikimedia.org/v2/stream/page-links-change"
+        base_stream_url = "https://stream.wikimedia.org/v2/stream/" + STREAM
+
+        self.writer = LinkEventWriter(
+            batch_size=options["batch_size"],
+            flush_interval_ms=options["flush_interval"],
+        )
+        # Set in --pipelined mode, where matched links are queued for the
+        # writer rather than passed to it directly.
+        self.pipeline = None
+        self.checkpointer = StreamCheckpointer(
+            STREAM, self.writer, interval_secs=options["checkpoint_interval"]
+        )
+        # Remember which events we've already stored, as far back as the
+        # stream can replay, so most links skip the duplicate check query.
+        self.dedup = LinkEventDedupFilter()
+        self.dedup.warm(datetime.now(timezone.utc) - REPLAY_WINDOW)
 
         if options["test"]:
             event_data = options["test"]
             self._evaluate_link(event_data)
+            self.writer.flush()
             # Since we are not testing the EventStream functionality, we finish
             # execution here
             sys.exit(0)
 
-        # Every time this script is started, find the latest entry in the
-        # database, and start the eventstream from there. This ensures that in
-        # the event of any downtime, we always maintain 100% data coverage (up
-        # to the ~7 days that the EventStream historical data is kept anyway).
+        # Every time this script is started, resume the eventstream from the
+        # last event we checkpointed, or failing that the latest entry in the
+        # database. This ensures that in the event of any downtime, we always
+        # maintain 100% data coverage (up to the ~7 days that the EventStream
+        # historical data is kept anyway).
+        url = base_stream_url
+        last_event_id = None
         if options["historical"]:
+            last_event_id = self.checkpointer.load()
             all_events = LinkEvent.objects.all()
-            if all_events.exists():
+            if last_event_id is None and all_events.exists():
                 latest_datetime = all_events.latest().timestamp
                 latest_date_formatted = latest_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
 
                 url = base_stream_url + "?since={date}".format(
                     date=latest_date_formatted
                 )
-            else:
-                url = base_stream_url
-        else:
-            url = base_stream_url
 
-        self._process_events(url)
+        if options["pipelined"]:
+            self.pipeline = LinkEventPipeline(
+                self.writer,
+                queue_size=options["queue_size"],
+                checkpointer=self.checkpointer,
+            )
+            self.pipeline.run(
+                self._read_messages(url, last_event_id), self._evaluate_message
+            )
+        else:
+            self._process_events(url, last_event_id)
 
-    def _process_events(self, url):
+    def _process_events(self, url, last_event_id=None):
+        try:
+            for event_id, message in self._read_messages(url, last_event_id):
+                self._evaluate_message(message)
+                self.checkpointer.processed(event_id)
+                self.writer.maybe_flush()
+        finally:
+            # Don't lose whatever was still buffered when the stream stops.
+            self.writer.flush()
+        # Only reached if every event was written.
+        self.checkpointer.save()
+
+    def _read_messages(self, url, last_event_id=None):
+        """
+        Yields the id and data of each message in the stream, starting after
+        last_event_id if given.
+        """
         # Eventsource should fail if it can't read data after a while.
         for event in EventSource(
             url,
+            # Sent as the Last-Event-ID header, so the stream resumes right
+            # after this event.
+            last_id=last_event_id,
             # The retry argument sets the delay between retries in milliseconds.
             # We're setting this to 5 minutes.
             # There's no way to set the max_retries value with this library,
@@ -85,12 +174,15 @@ class Command(BaseCommand):
             }
         ):
             if event.event == "message":
-                try:
-                    event_data = json.loads(event.data)
-                except ValueError:
-                    continue
+                yield event.id, event.data
 
-                self._evaluate_link(event_data)
+    def _evaluate_message(self, message):
+        try:
+            event_data = json.loads(message)
+        except ValueError:
+            return
+
+        self._evaluate_link(event_data)
 
     def _evaluate_link(self, event_data):
         if "added_links" in event_data:
@@ -108,108 +200,49 @@ class Command(BaseCommand):
         Change = 1: Added
         """
 
+        matcher = URLPattern.objects.matcher()
         for link in link_list:
             if link["external"]:
-                if link_is_tracked(link["link"]):
+                # One lookup gives us both the link_is_tracked decision and
+                # the URL patterns this link matches.
+                tracked, url_patterns = matcher.match(link["link"])
+                if tracked:
                     # URLs in the stream are encoded (e.g. %3D instead of =)
                     unquoted_url = unquote(link["link"])
 
-                    event_id = event_dict["meta"]["id"]
-                    link_event_id = unquoted_url + event_id
-                    hash = hashlib.sha256()
-                    hash.update(link_event_id.encode("utf-8"))
-                    event_objects = LinkEvent.objects.filter(
-                        hash_link_event_id=hash.hexdigest()
+                    hash_link_event_id = LinkEvent.get_hash_link_event_id(
+                        unquoted_url, event_dict["meta"]["id"]
                     )
 
                     # We skip the URL if the length is greater than 2083
-                    if not event_objects.exists() and len(unquoted_url) < 2084:
-                        self._add_linkevent_to_db(unquoted_url, change, event_dict)
-
-    def _add_linkevent_to_db(self, link, change, event_data):
-        if "." in event_data["meta"]["dt"]:
-            string_format = "%Y-%m-%dT%H:%M:%S.%fZ"
-        elif "Z" in event_data["meta"]["dt"]:
-            string_format = "%Y-%m-%dT%H:%M:%SZ"
-        else:
-            string_format = "%Y-%m-%dT%H:%M:%S+00:00"
-        datetime_object = datetime.strptime(event_data["meta"]["dt"], string_format)
-        try:
-            username = event_data["performer"]["user_text"]
-        except KeyError:
-            # Per https://phabricator.wikimedia.org/T216726, edits to Flow
-            # pages have no performer, so we'll abandon logging this event
-            # rather than worry about how to present such an edit.
-            logger.info(
-                "Skipped event {event_id} due to no performer".format(
-                    event_id=event_data["meta"]["id"]
-                )
+                    if len(unquoted_url) < 2084 and not self.dedup.exists(
+                        hash_link_event_id,
+                        parse_event_datetime(event_dict["meta"]["dt"]),
+                    ):
+                        self._add_linkevent_to_db(
+                            unquoted_url,
+                            change,
+                            event_dict,
+                            url_patterns,
+                            hash_link_event_id,
+                        )
+
+    def _add_linkevent_to_db(
+        self, link, change, event_data, url_patterns=None, hash_link_event_id=None
+    ):
+        if url_patterns is None:
+            url_patterns = URLPattern.objects.matches(link)
+        if hash_link_event_id is None:
+            hash_link_event_id = LinkEvent.get_hash_link_event_id(
+                link, event_data["meta"]["id"]
             )
-            return
 
-        # Find the db object for this user, or create it if we haven't logged
-        # an edit from them before now.
-        username_object, created = User.objects.get_or_create(username=username)
-
-        url_patterns = URLPattern.objects.matches(link)
-
-        # We make a hard assumption here that a given link, despite
-        # potentially being associated with multiple url patterns, should
-        # ultimately only be associated with a single organisation.
-        # I can't think of any situation when this wouldn't be the
-        # case, but I can't wait to find out why I'm wrong.
-        on_user_list = False
-        this_link_collection = url_patterns[0].collection
-
-        if hasattr(this_link_collection, "organisation"):
-            this_link_org = url_patterns[0].collection.organisation
-            if hasattr(this_link_org, "username_list"):
-                username_list = this_link_org.username_list
-                if username_list:
-                    if username_object in username_list.all():
-                        on_user_list = True
-            else:
-                logger.error(
-                    "Collection {this_link_collection}, Organization {this_link_org} has no username list.".format(
-                        this_link_collection=this_link_collection,
-                        this_link_org=this_link_org,
-                    )
-                )
-        else:
-            logger.error(
-                "Collection {this_link_collection} has no organisation.".format(
-                    this_link_collection=this_link_collection
-                )
+        # Matched events are buffered and written in batches, see
+        # LinkEventWriter.
+        writer = self.pipeline if self.pipeline is not None else self.writer
+        if writer.add(
+            link, change, event_data, url_patterns, hash_link_event_id
+        ):
+            self.dedup.add(
+                hash_link_event_id, parse_event_datetime(event_data["meta"]["dt"])
             )
-
-        # Log actions such as page moves and image uploads have no
-        # revision ID.
-        try:
-            revision_id = event_data["rev_id"]
-        except KeyError:
-            revision_id = None
-
-        try:
-            user_id = event_data["performer"]["user_id"]
-        except KeyError:
-            # IPs have no user_id
-            user_id = None
-
-        link_event = LinkEvent.objects.create(
-            link=link,
-            timestamp=datetime_object.replace(tzinfo=ZoneInfo("UTC")),
-            domain=event_data["meta"]["domain"],
-            username=username_object,
-            rev_id=revision_id,
-            user_id=user_id,
-            page_title=event_data["page_title"],
-            page_namespace=event_data["page_namespace"],
-            event_id=event_data["meta"]["id"],
-            change=change,
-            on_user_list=on_user_list,
-            user_is_bot=event_data["performer"]["user_is_bot"],
-        )
-        for url_pattern in url_patterns:
-            url_pattern.link_events.add(link_event)
-            url_pattern.collections.add(this_link_collection)
-            url_pattern.save()
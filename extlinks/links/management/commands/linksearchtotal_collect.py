@@ -1,5 +1,5 @@
-import csv, logging, os, sys
-from urllib.parse import urlparse
+import csv, logging, os
+from datetime import date
 
 import MySQLdb
 
@@ -7,8 +7,13 @@ from extlinks.common.management.commands import BaseCommand
 from django.db import close_old_connections
 from django.db.utils import IntegrityError
 
-from extlinks.links.helpers import reverse_host
-from extlinks.links.models import LinkSearchTotal, URLPattern
+from extlinks.links.models import LinkSearchTotal, LinkSearchWikiTotal, URLPattern
+from extlinks.links.replicas import (
+    DEFAULT_RETRIES,
+    DEFAULT_TIMEOUT_SECS,
+    ReplicaConnectionPool,
+    collect_wiki_totals,
+)
 from extlinks.settings.base import BASE_DIR
 
 logger = logging.getLogger("django")
@@ -17,9 +22,27 @@ logger = logging.getLogger("django")
 class Command(BaseCommand):
     help = "Updates link totals from externallinks table"
 
-    def _handle(self, *args, **options):
-        protocols = ["http", "https"]
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="The number of wikis counted at once, each over its own replica connection.",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=DEFAULT_TIMEOUT_SECS,
+            help="The number of seconds a replica query may take before its wiki is retried.",
+        )
+        parser.add_argument(
+            "--retries",
+            type=int,
+            default=DEFAULT_RETRIES,
+            help="The number of times a wiki is retried before the command fails.",
+        )
 
+    def _handle(self, *args, **options):
         logger.info("reading wiki-list")
         with open(os.path.join(BASE_DIR, "wiki-list.csv"), "r") as wiki_list:
             csv_reader = csv.reader(wiki_list)
@@ -27,55 +50,26 @@ class Command(BaseCommand):
             for row in csv_reader:
                 wiki_list_data.append(row[0])
 
-        all_urlpatterns = URLPattern.objects.all()
-
-        total_links_dictionary = {}
-        for i, language in enumerate(wiki_list_data):
-            logger.info(f"connecting to db {language}")
-            db = MySQLdb.connect(
-                host=f"{language}wiki.analytics.db.svc.wikimedia.cloud",
-                user=os.environ["REPLICA_DB_USER"],
-                passwd=os.environ["REPLICA_DB_PASSWORD"],
-                db=f"{language}wiki_p",
+        today = date.today()
+        pool = ReplicaConnectionPool(
+            MySQLdb.connect, size=options["workers"], timeout=options["timeout"]
+        )
+        try:
+            total_links_dictionary = collect_wiki_totals(
+                pool,
+                wiki_list_data,
+                URLPattern.objects.all(),
+                today,
+                retries=options["retries"],
             )
-
-            cur = db.cursor()
-
-            for urlpattern in all_urlpatterns:
-                logger.info("searching url pattern {}".format(urlpattern))
-                # For the first language, initialise tracking
-                if i == 0:
-                    total_links_dictionary[urlpattern.pk] = 0
-                # adding default https protocol if we don't already have
-                # a protocol in the url string so that we can leverage urlparse function
-                if "://" not in urlpattern.url:
-                    url = "https://" + urlpattern.url
-                else:
-                    url = urlpattern.url
-
-                url_parsed = urlparse(url)
-                url_host = url_parsed.hostname
-                url_path = url_parsed.path
-                for protocol in protocols:
-                    query = f"""
-                        SELECT COUNT(*) FROM externallinks
-                        WHERE el_to_domain_index LIKE '{protocol}://{reverse_host(url_host)}%'
-                        """
-                    if len(url_path) > 0:
-                        cond = f"""AND el_to_path LIKE '{url_path}%'
-                        """
-                        query += cond
-                    logger.info(f"executing query {query}")
-                    cur.execute(query)
-
-                    this_num_urls = cur.fetchone()[0]
-
-                    logger.info(f"found {this_num_urls}")
-                    total_links_dictionary[urlpattern.pk] += this_num_urls
+        finally:
+            pool.close()
 
         for urlpattern_pk, total_count in total_links_dictionary.items():
             linksearch_object = LinkSearchTotal(
-                url=URLPattern.objects.get(pk=urlpattern_pk), total=total_count
+                url=URLPattern.objects.get(pk=urlpattern_pk),
+                date=today,
+                total=total_count,
             )
             logger.info(f"saving linksearch_object {linksearch_object}")
             try:
@@ -83,4 +77,7 @@ class Command(BaseCommand):
             except IntegrityError as e:
                 logger.warning(e)
 
+        # Earlier collections' counts are no longer needed to resume.
+        LinkSearchWikiTotal.objects.filter(date__lt=today).delete()
+
         close_old_connections()
@@ -3,6 +3,7 @@ from extlinks.common.management.commands import BaseCommand
 from django.core.management import call_command
 
 from extlinks.aggregates.models import (
+    AggregateWatermark,
     LinkAggregate,
     PageProjectAggregate,
     UserAggregate,
@@ -137,6 +138,10 @@ class Command(BaseCommand):
                     proxy_url = url_pattern.url.replace(".", "-")
                     if url_pattern.url in linkevent.link or proxy_url in linkevent.link:
                         url_pattern.link_events.add(linkevent)
+                        LinkEvent.objects.filter(pk=linkevent.pk).update(
+                            collection=collection,
+                            organisation_id=collection.organisation_id,
+                        )
                         url_pattern.save()
                         linkevents_changed += 1
             if linkevents_changed > 0:
@@ -146,6 +151,8 @@ class Command(BaseCommand):
                 LinkAggregate.objects.filter(collection=collection).delete()
                 PageProjectAggregate.objects.filter(collection=collection).delete()
                 UserAggregate.objects.filter(collection=collection).delete()
+                # Count every event again rather than only new ones
+                AggregateWatermark.objects.filter(collection=collection).delete()
 
                 call_command("fill_link_aggregates", collections=[collection.pk])
                 call_command("fill_pageproject_aggregates", collections=[collection.pk])
@@ -0,0 +1,135 @@
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# TWL proxied URLs need to be matched against a longer list of strings.
+PROXY_DOMAIN = "wikipedialibrary.idm.oclc"
+
+# Strings that may directly precede a URL pattern for it to count as the
+# start of the link's host. If we track apa.org, we don't want to match
+# iaapa.org. Proxy URLs may contain //www- not //www. so "-" only counts
+# for proxied links.
+HOST_PREFIXES = ("//", ".")
+PROXY_HOST_PREFIXES = ("//", ".", "-")
+
+
+class URLPatternMatcher:
+    """
+    An Aho-Corasick automaton over the url and get_proxied_url of every
+    URLPattern.
+
+    One pass over a link finds every pattern string it contains, so matching
+    costs time proportional to the link's length rather than the number of
+    URL patterns we track. The automaton is built once and then only read,
+    so a single instance can be shared between threads.
+    """
+
+    def __init__(self, url_patterns: Iterable, version: Optional[str] = None):
+        self.version = version
+        self.url_patterns = list(url_patterns)
+
+        # Each state is a dict of transitions, a failure link and the ids of
+        # the needles that end at that state (including via failure links).
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[Tuple[int, ...]] = [()]
+        # needle id -> (url pattern index, is proxied url, host prefix)
+        self._needles: List[Tuple[int, bool, str]] = []
+
+        for index, url_pattern in enumerate(self.url_patterns):
+            for is_proxied, url in (
+                (False, url_pattern.url),
+                (True, url_pattern.get_proxied_url),
+            ):
+                for prefix in ("",) + PROXY_HOST_PREFIXES:
+                    self._add_needle(prefix + url, (index, is_proxied, prefix))
+
+        self._build_failure_links()
+
+    def __len__(self):
+        return len(self.url_patterns)
+
+    def _add_needle(self, needle: str, details: Tuple[int, bool, str]):
+        state = 0
+        for char in needle:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+                self._goto[state][char] = next_state
+            state = next_state
+
+        self._output[state] += (len(self._needles),)
+        self._needles.append(details)
+
+    def _build_failure_links(self):
+        # Breadth first, so a state's failure link is always resolved before
+        # the states below it.
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[next_state] = fail
+                # The root's needles are reported by _scan for every link.
+                if fail:
+                    self._output[next_state] += self._output[fail]
+                queue.append(next_state)
+
+    def _scan(self, link: str) -> Set[int]:
+        """
+        Returns the ids of every needle found in the link.
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+
+        hits = set(output[0])
+        state = 0
+        for char in link:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                hits.update(output[state])
+
+        return hits
+
+    def match(self, link: str) -> Tuple[bool, List]:
+        """
+        Looks a link up once, returning both whether it is tracked and the
+        URL patterns it matches.
+
+        Parameters
+        ----------
+        link : str
+            The link to look up.
+
+        Returns
+        -------
+        Tuple[bool, List[URLPattern]]
+            Whether link_is_tracked should accept the link, and every URL
+            pattern whose url or proxied url appears anywhere in the link.
+        """
+        proxied_link = PROXY_DOMAIN in link
+
+        matched = set()
+        host_match = False
+        for needle_id in self._scan(link):
+            index, is_proxied, prefix = self._needles[needle_id]
+            if not prefix:
+                matched.add(index)
+            elif proxied_link or (not is_proxied and prefix in HOST_PREFIXES):
+                host_match = True
+
+        # We want to avoid link additions from e.g. InternetArchive where the
+        # URL takes the structure https://web.archive.org/https://test.com/
+        tracked = host_match and link.count("//") < 2
+
+        return tracked, [self.url_patterns[index] for index in sorted(matched)]
+
+    def is_tracked(self, link: str) -> bool:
+        return self.match(link)[0]
+
+    def matches(self, link: str) -> List:
+        return self.match(link)[1]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-17 04:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('links', '0014_migrate_url_pattern_relationships'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StreamCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stream', models.CharField(max_length=255, unique=True)),
+                ('last_event_id', models.TextField()),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-17 04:47
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('links', '0015_streamcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LinkSearchWikiTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('wiki', models.CharField(max_length=32)),
+                ('date', models.DateField(default=datetime.date.today)),
+                ('total', models.PositiveIntegerField()),
+                ('url', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='links.urlpattern')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='linksearchwikitotal',
+            constraint=models.UniqueConstraint(fields=('url', 'wiki', 'date'), name='unique_wiki_date_total'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-17 04:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('organisations', '0009_organisation_username_list_updated'),
+        ('links', '0016_linksearchwikitotal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='linkevent',
+            name='collection',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='organisations.collection'),
+        ),
+        migrations.AddField(
+            model_name='linkevent',
+            name='organisation',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='organisations.organisation'),
+        ),
+        migrations.AddIndex(
+            model_name='linkevent',
+            index=models.Index(fields=['collection', 'timestamp'], name='links_linke_collect_2a53ba_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='linkevent',
+            index=models.Index(fields=['organisation', 'timestamp'], name='links_linke_organis_8c1dd2_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-17 05:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('links', '0017_linkevent_collection_organisation'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='linkevent',
+            index=models.Index(fields=['content_type', 'object_id', 'collection', 'timestamp'], name='links_linke_content_511a26_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='linkevent',
+            name='links_linke_content_1a162a_idx',
+        ),
+    ]
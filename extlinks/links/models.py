@@ -1,17 +1,31 @@
 import hashlib
 import logging
+import time
 from datetime import date
+from typing import Iterable, List, Optional, Set, Tuple
+from uuid import uuid4
 
 from django.contrib.contenttypes.fields import GenericRelation, GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import cache
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.utils.functional import cached_property
 
+from .matcher import URLPatternMatcher
+
 logger = logging.getLogger("django")
 
+# Bumped whenever url_pattern_cache is invalidated so that long-running
+# processes know to rebuild their compiled URLPatternMatcher.
+URL_PATTERN_VERSION_KEY = "url_pattern_cache_version"
+# How often a process checks that version before reusing its matcher.
+MATCHER_VERSION_CHECK_SECS = 5
+
+_matcher = None
+_matcher_checked_at = 0.0
 
 
 class URLPatternManager(models.Manager):
@@ -24,14 +38,38 @@ class URLPatternManager(models.Manager):
             cache.set('url_pattern_cache', cached_patterns, None)
         return cached_patterns
 
+    def matcher(self):
+        """
+        Returns this process's compiled URLPatternMatcher, rebuilding it from
+        url_pattern_cache if the cache has been invalidated since it was
+        built.
+        """
+        global _matcher, _matcher_checked_at
+
+        now = time.monotonic()
+        if (
+            _matcher is not None
+            and now - _matcher_checked_at < MATCHER_VERSION_CHECK_SECS
+        ):
+            return _matcher
+        _matcher_checked_at = now
+
+        version = cache.get(URL_PATTERN_VERSION_KEY)
+        if version is None:
+            cache.add(URL_PATTERN_VERSION_KEY, uuid4().hex, None)
+            version = cache.get(URL_PATTERN_VERSION_KEY)
+
+        # Without a shared version (e.g. the dummy cache) we can't tell
+        # whether the patterns changed, so rebuild on every check.
+        if _matcher is None or version is None or version != _matcher.version:
+            _matcher = URLPatternMatcher(self.cached(), version=version)
+            logger.info("built url pattern matcher for %d patterns", len(_matcher))
+
+        return _matcher
+
     def matches(self, link):
         # All URL patterns matching this link
-        tracked_urls = self.cached()
-        return [
-            pattern
-            for pattern in tracked_urls
-            if pattern.url in link or pattern.get_proxied_url in link
-        ]
+        return self.matcher().matches(link)
 
 class URLPattern(models.Model):
     class Meta:
@@ -68,10 +106,14 @@ class URLPattern(models.Model):
         return self.url.replace(".", "-")
 
 
-@receiver(post_save, sender=URLPattern)
+@receiver([post_save, post_delete], sender=URLPattern)
 def delete_url_pattern_cache(sender, instance, **kwargs):
+    global _matcher
+
     if cache.delete("url_pattern_cache"):
         logger.info("delete url_pattern_cache")
+    cache.set(URL_PATTERN_VERSION_KEY, uuid4().hex, None)
+    _matcher = None
 
 
 class LinkSearchTotal(models.Model):
@@ -90,6 +132,142 @@ class LinkSearchTotal(models.Model):
     total = models.PositiveIntegerField()
 
 
+class LinkSearchWikiTotal(models.Model):
+    """
+    A URLPattern's link count on a single wiki, saved as soon as the wiki
+    has been counted so that an interrupted LinkSearchTotal collection can
+    resume with the wikis it hadn't counted yet.
+    """
+
+    class Meta:
+        app_label = "links"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["url", "wiki", "date"], name="unique_wiki_date_total"
+            )
+        ]
+
+    url = models.ForeignKey(URLPattern, on_delete=models.CASCADE)
+    wiki = models.CharField(max_length=32)
+
+    date = models.DateField(default=date.today)
+    total = models.PositiveIntegerField()
+
+
+class StreamCheckpoint(models.Model):
+    """
+    The id of the last EventStream event we've fully processed, so that the
+    collector can resume from exactly where it stopped.
+    """
+
+    class Meta:
+        app_label = "links"
+
+    stream = models.CharField(max_length=255, unique=True)
+    # EventStreams ids are a JSON list of Kafka topic partition offsets or
+    # timestamps, sent back as the Last-Event-ID header on reconnection.
+    last_event_id = models.TextField()
+    updated = models.DateTimeField(auto_now=True)
+
+
+class LinkEventManager(models.Manager):
+    def collections_filter(
+        self,
+        collection_ids: Iterable[int],
+        url_pattern_ids: Optional[Iterable[int]] = None,
+    ) -> Q:
+        """
+        Returns a filter for the LinkEvents of the given collections that can
+        use the (collection, timestamp) index.
+
+        An event is only given the collection of the first URL pattern it
+        matched, so events of URL patterns that also belong to other
+        collections are found through their URL pattern, as are events that
+        haven't been given a collection.
+
+        Parameters
+        ----------
+        collection_ids : Iterable[int]
+            The ids of the collections.
+
+        url_pattern_ids : Iterable[int]|None
+            The ids of the collections' URL patterns, if already known.
+
+        Returns
+        -------
+        Q : A Q object which will filter LinkEvents to the collections
+        """
+        collection_ids = list(collection_ids)
+        url_pattern_ids, shared_url_pattern_ids = self._get_url_pattern_ids(
+            collection_ids, url_pattern_ids
+        )
+        url_pattern_type = ContentType.objects.get_for_model(URLPattern)
+        return (
+            Q(collection_id__in=collection_ids)
+            | Q(content_type=url_pattern_type, object_id__in=shared_url_pattern_ids)
+            | Q(
+                content_type=url_pattern_type,
+                collection__isnull=True,
+                object_id__in=url_pattern_ids,
+            )
+        )
+
+    def collection_filters(self, collection_id: int) -> List[Q]:
+        """
+        Splits collections_filter for a single collection into filters that
+        can each be read from an index in timestamp order: one for the events
+        given the collection, and one for each of its URL patterns.
+
+        Taking the newest events of each and merging them avoids sorting all
+        of the collection's events, which an OR of the filters would need.
+        """
+        url_pattern_ids, shared_url_pattern_ids = self._get_url_pattern_ids(
+            [collection_id]
+        )
+        url_pattern_type = ContentType.objects.get_for_model(URLPattern)
+        filters = [Q(collection_id=collection_id)]
+        for url_pattern_id in url_pattern_ids:
+            if url_pattern_id in shared_url_pattern_ids:
+                filters.append(
+                    Q(content_type=url_pattern_type, object_id=url_pattern_id)
+                )
+            else:
+                filters.append(
+                    Q(
+                        content_type=url_pattern_type,
+                        object_id=url_pattern_id,
+                        collection__isnull=True,
+                    )
+                )
+        return filters
+
+    def for_collections(self, collection_ids: Iterable[int]):
+        return self.filter(self.collections_filter(collection_ids))
+
+    def _get_url_pattern_ids(
+        self,
+        collection_ids: List[int],
+        url_pattern_ids: Optional[Iterable[int]] = None,
+    ) -> Tuple[List[int], Set[int]]:
+        """
+        Returns the ids of the collections' URL patterns, and of those among
+        them that also belong to other collections.
+        """
+        if url_pattern_ids is None:
+            url_pattern_ids = URLPattern.collections.through.objects.filter(
+                collection_id__in=collection_ids
+            ).values_list("urlpattern_id", flat=True)
+        url_pattern_ids = list(url_pattern_ids)
+        shared_url_pattern_ids = set(
+            URLPattern.collections.through.objects.filter(
+                urlpattern_id__in=url_pattern_ids
+            )
+            .exclude(collection_id__in=collection_ids)
+            .values_list("urlpattern_id", flat=True)
+        )
+        return url_pattern_ids, shared_url_pattern_ids
+
+
 class LinkEvent(models.Model):
     """
     Stores data from the page-links-change EventStream
@@ -111,8 +289,16 @@ class LinkEvent(models.Model):
                     "timestamp",
                 ]
             ),
-            models.Index(fields=["content_type", "object_id"]),
+            # Also reads a URL pattern's events, or those without a
+            # collection, in timestamp order.
+            models.Index(
+                fields=["content_type", "object_id", "collection", "timestamp"]
+            ),
+            models.Index(fields=["collection", "timestamp"]),
+            models.Index(fields=["organisation", "timestamp"]),
         ]
+
+    objects = LinkEventManager()
     url = models.ManyToManyField(URLPattern, related_name="linkevent")
     # URLs should have a max length of 2083
     link = models.CharField(max_length=2083)
@@ -121,6 +307,24 @@ class LinkEvent(models.Model):
     content_type = models.ForeignKey(ContentType, on_delete=models.SET_NULL, related_name="content_type", null=True)
     object_id = models.PositiveIntegerField(null=True)
     content_object = GenericForeignKey("content_type", "object_id")
+    # The legacy collection of the first URL pattern matched, and its
+    # organisation, copied here so that a collection's events can be found
+    # without joining through the URL patterns. Filled in as events are
+    # written, or by backfill_linkevent_collections for older events.
+    collection = models.ForeignKey(
+        "organisations.Collection",
+        null=True,
+        on_delete=models.SET_NULL,
+        related_name="+",
+        db_index=False,
+    )
+    organisation = models.ForeignKey(
+        "organisations.Organisation",
+        null=True,
+        on_delete=models.SET_NULL,
+        related_name="+",
+        db_index=False,
+    )
 
     username = models.ForeignKey(
         "organisations.User",
@@ -161,9 +365,15 @@ class LinkEvent(models.Model):
             if self in link_events:
                 return url_pattern.collection.organisation
 
-    def save(self, **kwargs):
-        link_event_id = self.link + self.event_id
+    @staticmethod
+    def get_hash_link_event_id(link, event_id):
+        link_event_id = link + event_id
         hash = hashlib.sha256()
         hash.update(link_event_id.encode("utf-8"))
-        self.hash_link_event_id = hash.hexdigest()
+        return hash.hexdigest()
+
+    def save(self, **kwargs):
+        self.hash_link_event_id = self.get_hash_link_event_id(
+            self.link, self.event_id
+        )
         super().save(**kwargs)
@@ -0,0 +1,196 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, NamedTuple, Optional, Tuple
+
+from django.db import connection
+
+from .checkpoint import StreamCheckpointer
+from .writer import LinkEventWriter
+
+logger = logging.getLogger("django")
+
+DEFAULT_QUEUE_SIZE = 1000
+QUEUE_DEPTH_LOG_INTERVAL_SECS = 60
+# How often blocked stages check whether another stage has failed.
+POLL_INTERVAL_SECS = 0.1
+# The reader can be stuck in a read for up to the stream's read timeout.
+JOIN_TIMEOUT_SECS = 10
+
+# Marks the end of a queue's input.
+_DONE = object()
+
+
+class _Stopped(Exception):
+    pass
+
+
+class _Processed(NamedTuple):
+    """
+    Follows an event's links through the queue, so that it's only
+    checkpointed once they have all reached the writer.
+    """
+
+    event_id: Optional[str]
+
+
+class LinkEventPipeline:
+    """
+    Consumes the event stream in three stages joined by bounded queues, so
+    that a slow database write doesn't stop us reading from the stream.
+
+    - a reader thread pulls raw messages off the stream
+    - a match thread decodes them and finds the links we track
+    - the calling thread writes matched events with a LinkEventWriter
+
+    When a queue is full the stage feeding it blocks, so a backlog works its
+    way back up to the stream rather than growing without bound. If any
+    stage fails the others stop and the error is raised from run().
+    """
+
+    def __init__(
+        self,
+        writer: LinkEventWriter,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        queue_depth_log_interval: float = QUEUE_DEPTH_LOG_INTERVAL_SECS,
+        checkpointer: Optional[StreamCheckpointer] = None,
+    ):
+        self.writer = writer
+        self.checkpointer = checkpointer
+        self.raw_events: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.link_events: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.queue_depth_log_interval = queue_depth_log_interval
+
+        self._stop = threading.Event()
+        self._errors = []
+
+    def queue_depths(self) -> Dict[str, int]:
+        return {
+            "raw_events": self.raw_events.qsize(),
+            "link_events": self.link_events.qsize(),
+        }
+
+    def add(self, link, change, event_data, url_patterns, hash_link_event_id=None):
+        """
+        Queues a matched link for the writer. Takes the same arguments as
+        LinkEventWriter.add, so the match stage can use either.
+        """
+        self._put(
+            self.link_events,
+            (link, change, event_data, url_patterns, hash_link_event_id),
+        )
+        return True
+
+    def run(
+        self,
+        messages: Iterable[Tuple[Optional[str], str]],
+        evaluate: Callable[[str], None],
+    ):
+        """
+        Runs the pipeline until the stream ends or a stage fails.
+
+        Parameters
+        ----------
+        messages : Iterable[Tuple[str|None, str]]
+            The event id and raw data of each message in the stream.
+
+        evaluate : Callable[[str], None]
+            Decodes a message and passes each tracked link in it to add().
+        """
+        threads = [
+            threading.Thread(
+                target=self._run_stage,
+                args=(self._read, messages),
+                name="linkevents-reader",
+                daemon=True,
+            ),
+            threading.Thread(
+                target=self._run_stage,
+                args=(self._match, evaluate),
+                name="linkevents-matcher",
+                daemon=True,
+            ),
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            self._run_stage(self._persist)
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join(JOIN_TIMEOUT_SECS)
+            # Don't lose whatever was still buffered when the stream stops.
+            self.writer.flush()
+
+        if self._errors:
+            raise self._errors[0]
+        if self.checkpointer is not None:
+            self.checkpointer.save()
+
+    def _run_stage(self, stage, *args):
+        try:
+            stage(*args)
+        except _Stopped:
+            pass
+        except Exception as e:
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            # Threads each get their own database connection.
+            if threading.current_thread() is not threading.main_thread():
+                connection.close()
+
+    def _put(self, to_queue: queue.Queue, item):
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                to_queue.put(item, timeout=POLL_INTERVAL_SECS)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, from_queue: queue.Queue):
+        if self._stop.is_set():
+            raise _Stopped()
+        return from_queue.get(timeout=POLL_INTERVAL_SECS)
+
+    def _read(self, messages: Iterable[str]):
+        for message in messages:
+            self._put(self.raw_events, message)
+        self._put(self.raw_events, _DONE)
+
+    def _match(self, evaluate: Callable[[str], None]):
+        while True:
+            try:
+                message = self._get(self.raw_events)
+            except queue.Empty:
+                continue
+            if message is _DONE:
+                self._put(self.link_events, _DONE)
+                return
+            event_id, data = message
+            evaluate(data)
+            if self.checkpointer is not None:
+                self._put(self.link_events, _Processed(event_id))
+
+    def _persist(self):
+        logged_at = time.monotonic()
+        while True:
+            try:
+                item = self._get(self.link_events)
+            except queue.Empty:
+                item = None
+            if item is _DONE:
+                return
+            if isinstance(item, _Processed):
+                self.checkpointer.processed(item.event_id)
+            elif item is not None:
+                self.writer.add(*item)
+            self.writer.maybe_flush()
+
+            if time.monotonic() - logged_at >= self.queue_depth_log_interval:
+                logger.info("Link event pipeline queue depths: %s", self.queue_depths())
+                logged_at = time.monotonic()
@@ -0,0 +1,151 @@
+import logging
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set
+
+from django.core.cache import cache
+from django.db.models import Q
+
+from .models import LinkEvent, URLPattern
+
+logger = logging.getLogger("django")
+
+RECENT_LINK_EVENTS_COUNT = 10
+# Buffers of collections without new events expire, and are rebuilt from the
+# database the next time they're needed.
+RECENT_LINK_EVENTS_TIMEOUT_SECS = 24 * 60 * 60
+
+
+def recent_link_events_key(collection_id: int) -> str:
+    return f"recent_link_events_{collection_id}"
+
+
+def serialize_link_event(link_event: LinkEvent) -> Dict:
+    """
+    Returns the fields of a LinkEvent shown in the latest link events table.
+    """
+    return {
+        "id": link_event.pk,
+        "link": link_event.link,
+        "domain": link_event.domain,
+        "page_title": link_event.page_title,
+        "rev_id": link_event.rev_id,
+        "username__username": (
+            link_event.username.username if link_event.username else None
+        ),
+        "change": link_event.change,
+        "date": link_event.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def _newest_first(link_events: Iterable[Dict]) -> List[Dict]:
+    return sorted(
+        link_events,
+        # Events written without returning their ids sort before the others
+        # of the same second.
+        key=lambda link_event: (link_event["date"], link_event["id"] or 0),
+        reverse=True,
+    )[:RECENT_LINK_EVENTS_COUNT]
+
+
+def query_latest_link_events(
+    collection_id: int,
+    link_event_filter: Q = Q(),
+    count: int = RECENT_LINK_EVENTS_COUNT,
+) -> List[Dict]:
+    """
+    Returns the newest LinkEvents of a collection matching the filter.
+
+    The newest events given the collection, and those of each of its URL
+    patterns, are queried separately so that each query can read an index
+    backwards rather than every event of the collection being sorted. The
+    results are then merged.
+    """
+    link_events = {}
+    for collection_filter in LinkEvent.objects.collection_filters(collection_id):
+        for link_event in (
+            LinkEvent.objects.filter(collection_filter, link_event_filter)
+            .select_related("username")
+            .order_by("-timestamp", "-id")[:count]
+        ):
+            link_events[link_event.pk] = link_event
+
+    return [
+        serialize_link_event(link_event)
+        for link_event in sorted(
+            link_events.values(),
+            key=lambda link_event: (link_event.timestamp, link_event.pk),
+            reverse=True,
+        )[:count]
+    ]
+
+
+def get_recent_link_events(collection_id: int) -> List[Dict]:
+    """
+    Returns a collection's newest LinkEvents from its buffer in the cache,
+    filling the buffer from the database if it isn't there.
+    """
+    key = recent_link_events_key(collection_id)
+    link_events = cache.get(key)
+    if link_events is None:
+        link_events = query_latest_link_events(collection_id)
+        cache.add(key, link_events, RECENT_LINK_EVENTS_TIMEOUT_SECS)
+    return link_events
+
+
+def _get_collection_ids(link_events: List[LinkEvent]) -> List[Set[int]]:
+    """
+    Returns, for each LinkEvent, the ids of the collections whose events
+    LinkEventManager.collections_filter finds it among.
+    """
+    url_pattern_collections = defaultdict(set)
+    for url_pattern_id, collection_id in URLPattern.collections.through.objects.filter(
+        urlpattern_id__in={link_event.object_id for link_event in link_events}
+    ).values_list("urlpattern_id", "collection_id"):
+        url_pattern_collections[url_pattern_id].add(collection_id)
+
+    collection_ids = []
+    for link_event in link_events:
+        event_collection_ids = set()
+        if link_event.collection_id is not None:
+            event_collection_ids.add(link_event.collection_id)
+        url_pattern_collection_ids = url_pattern_collections[link_event.object_id]
+        # Events of a URL pattern shared between collections, or without a
+        # collection of their own, belong to all of its collections.
+        if link_event.collection_id is None or len(url_pattern_collection_ids) > 1:
+            event_collection_ids |= url_pattern_collection_ids
+        collection_ids.append(event_collection_ids)
+    return collection_ids
+
+
+def push_recent_link_events(link_events: Iterable[LinkEvent]):
+    """
+    Adds newly written LinkEvents to their collections' buffers, keeping the
+    newest RECENT_LINK_EVENTS_COUNT of each.
+
+    Only buffers already in the cache are updated, as a buffer started from
+    new events alone would be missing the older events before them.
+    """
+    link_events = list(link_events)
+    if not link_events:
+        return
+
+    new_link_events = defaultdict(list)
+    for link_event, collection_ids in zip(
+        link_events, _get_collection_ids(link_events)
+    ):
+        for collection_id in collection_ids:
+            new_link_events[recent_link_events_key(collection_id)].append(
+                serialize_link_event(link_event)
+            )
+    if not new_link_events:
+        return
+
+    buffers = cache.get_many(list(new_link_events))
+    if buffers:
+        cache.set_many(
+            {
+                key: _newest_first(new_link_events[key] + buffer)
+                for key, buffer in buffers.items()
+            },
+            RECENT_LINK_EVENTS_TIMEOUT_SECS,
+        )
@@ -0,0 +1,273 @@
+import logging
+import os
+import socket
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import date
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+from urllib.parse import urlparse
+
+from django.db import transaction
+from django.db.models import Count, Sum
+from tenacity import Retrying, stop_after_attempt, wait_exponential
+
+from .helpers import reverse_host
+from .models import LinkSearchWikiTotal
+
+logger = logging.getLogger("django")
+
+# Overridable with REPLICA_DB_HOST and REPLICA_DB_NAME, e.g. to count links
+# in a local MariaDB with an externallinks table.
+DEFAULT_REPLICA_HOST = "{wiki}wiki.analytics.db.svc.wikimedia.cloud"
+DEFAULT_REPLICA_DB = "{wiki}wiki_p"
+DEFAULT_TIMEOUT_SECS = 600
+DEFAULT_RETRIES = 3
+# The number of prefixes counted by each replica query.
+COUNT_BATCH_SIZE = 200
+PROTOCOLS = ["http", "https"]
+
+
+def url_pattern_prefixes(urlpatterns) -> List[Tuple[int, str, str]]:
+    """
+    Returns the (pk, el_to_domain_index prefix, el_to_path prefix) of every
+    protocol that each URLPattern's links can be found under.
+    """
+    prefixes = []
+    for urlpattern in urlpatterns:
+        # adding default https protocol if we don't already have
+        # a protocol in the url string so that we can leverage urlparse function
+        if "://" not in urlpattern.url:
+            url = "https://" + urlpattern.url
+        else:
+            url = urlpattern.url
+
+        url_parsed = urlparse(url)
+        for protocol in PROTOCOLS:
+            prefixes.append(
+                (
+                    urlpattern.pk,
+                    f"{protocol}://{reverse_host(url_parsed.hostname)}",
+                    url_parsed.path,
+                )
+            )
+    return prefixes
+
+
+def count_links(
+    cursor, prefixes: List[Tuple[int, str, str]], batch_size: int = COUNT_BATCH_SIZE
+) -> Dict[int, int]:
+    """
+    Counts the externallinks rows of a wiki matching each URLPattern.
+
+    Rather than a query per prefix, each query counts a batch of prefixes
+    in a single pass over the union of their el_to_domain_index ranges. The
+    prefixes are sorted so that a batch covers neighbouring ranges, and any
+    prefix inside another's range doesn't widen the scan.
+    """
+    totals = {pk: 0 for pk, _, _ in prefixes}
+    prefixes = sorted(prefixes, key=lambda prefix: prefix[1])
+    for start in range(0, len(prefixes), batch_size):
+        batch = prefixes[start : start + batch_size]
+
+        columns = []
+        params = []
+        ranges = []
+        for _, domain_prefix, path_prefix in batch:
+            if path_prefix:
+                columns.append(
+                    "SUM(el_to_domain_index LIKE %s AND el_to_path LIKE %s)"
+                )
+                params += [f"{domain_prefix}%", f"{path_prefix}%"]
+            else:
+                columns.append("SUM(el_to_domain_index LIKE %s)")
+                params.append(f"{domain_prefix}%")
+
+            if not ranges or not domain_prefix.startswith(ranges[-1]):
+                ranges.append(domain_prefix)
+
+        cursor.execute(
+            f"SELECT {', '.join(columns)} FROM externallinks WHERE "
+            + " OR ".join(["el_to_domain_index LIKE %s"] * len(ranges)),
+            params + [f"{domain_prefix}%" for domain_prefix in ranges],
+        )
+        for (pk, _, _), count in zip(batch, cursor.fetchone()):
+            totals[pk] += int(count or 0)
+    return totals
+
+
+class ReplicaConnectionPool:
+    """
+    Keeps idle connections to the wiki replicas for reuse.
+
+    Many wikis are served by the same replica host, so idle connections are
+    grouped by the address their wiki's host resolves to, and a connection
+    is switched to another wiki's database on the same host rather than a
+    new one being opened.
+    """
+
+    def __init__(
+        self,
+        connect: Callable,
+        size: int = 1,
+        timeout: float = DEFAULT_TIMEOUT_SECS,
+    ):
+        self.size = size
+        self.timeout = timeout
+
+        self._connect = connect
+        self._host = os.environ.get("REPLICA_DB_HOST", DEFAULT_REPLICA_HOST)
+        self._database = os.environ.get("REPLICA_DB_NAME", DEFAULT_REPLICA_DB)
+        self._port = int(os.environ.get("REPLICA_DB_PORT", 3306))
+        self._addresses = {}
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def address(self, wiki: str) -> str:
+        """
+        Returns the address of the replica host serving a wiki.
+        """
+        host = self._host.format(wiki=wiki)
+        if host not in self._addresses:
+            try:
+                address = socket.gethostbyname(host)
+            except OSError:
+                address = host
+            with self._lock:
+                self._addresses[host] = address
+        return self._addresses[host]
+
+    @contextmanager
+    def connection(self, wiki: str):
+        """
+        Provides a connection to a wiki's replica database, which is returned
+        to the pool afterwards unless it raised an error.
+        """
+        address = self.address(wiki)
+        database = self._database.format(wiki=wiki)
+
+        with self._lock:
+            db = self._idle[address].pop() if self._idle[address] else None
+
+        if db is None:
+            logger.info(f"connecting to db {database}")
+            db = self._connect(
+                host=self._host.format(wiki=wiki),
+                port=self._port,
+                user=os.environ["REPLICA_DB_USER"],
+                passwd=os.environ["REPLICA_DB_PASSWORD"],
+                db=database,
+                connect_timeout=int(self.timeout),
+                read_timeout=int(self.timeout),
+            )
+        else:
+            db.select_db(database)
+
+        try:
+            yield db
+        except BaseException:
+            db.close()
+            raise
+
+        with self._lock:
+            if sum(len(idle) for idle in self._idle.values()) < self.size:
+                self._idle[address].append(db)
+                db = None
+        if db is not None:
+            db.close()
+
+    def close(self):
+        with self._lock:
+            idle = [db for connections in self._idle.values() for db in connections]
+            self._idle.clear()
+        for db in idle:
+            db.close()
+
+
+def count_wikis(
+    pool: ReplicaConnectionPool,
+    wikis: Iterable[str],
+    prefixes: List[Tuple[int, str, str]],
+    retries: int = DEFAULT_RETRIES,
+) -> Iterator[Tuple[str, Dict[int, int]]]:
+    """
+    Counts the links matching each URLPattern on every wiki, as many wikis
+    at a time as the pool has connections, yielding each wiki's counts as
+    they're finished.
+
+    Wikis are started in order of their replica host so that connections
+    can be reused, and a wiki is retried if counting it fails or times out.
+    """
+
+    def count(wiki):
+        for attempt in Retrying(
+            reraise=True,
+            stop=stop_after_attempt(retries + 1),
+            wait=wait_exponential(multiplier=1, min=1, max=60),
+        ):
+            with attempt:
+                with pool.connection(wiki) as db:
+                    cursor = db.cursor()
+                    try:
+                        return count_links(cursor, prefixes)
+                    finally:
+                        cursor.close()
+
+    executor = ThreadPoolExecutor(max_workers=pool.size)
+    try:
+        futures = {
+            executor.submit(count, wiki): wiki
+            for wiki in sorted(wikis, key=pool.address)
+        }
+        for future in as_completed(futures):
+            logger.info(f"counted links on {futures[future]}")
+            yield futures[future], future.result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def collect_wiki_totals(
+    pool: ReplicaConnectionPool,
+    wikis: List[str],
+    urlpatterns,
+    day: date,
+    retries: int = DEFAULT_RETRIES,
+) -> Dict[int, int]:
+    """
+    Counts the links matching each URLPattern across the wikis for the
+    given day, and returns the totals of each URLPattern.
+
+    Every wiki's counts are saved as a LinkSearchWikiTotal once they're
+    finished, and wikis that already have counts for the day are skipped,
+    so calling this again after a failure only counts the remaining wikis.
+    """
+    prefixes = url_pattern_prefixes(urlpatterns)
+    pks = {pk for pk, _, _ in prefixes}
+
+    counted = set(
+        LinkSearchWikiTotal.objects.filter(date=day, url__in=pks)
+        .values("wiki")
+        .annotate(urls=Count("url"))
+        .filter(urls=len(pks))
+        .values_list("wiki", flat=True)
+    )
+    pending = [wiki for wiki in wikis if wiki not in counted]
+    logger.info(f"counting {len(pending)} of {len(wikis)} wikis")
+
+    for wiki, totals in count_wikis(pool, pending, prefixes, retries=retries):
+        with transaction.atomic():
+            LinkSearchWikiTotal.objects.filter(date=day, wiki=wiki).delete()
+            LinkSearchWikiTotal.objects.bulk_create(
+                LinkSearchWikiTotal(url_id=pk, wiki=wiki, date=day, total=total)
+                for pk, total in totals.items()
+            )
+
+    totals = {pk: 0 for pk in pks}
+    for wiki_total in (
+        LinkSearchWikiTotal.objects.filter(date=day, wiki__in=wikis, url__in=pks)
+        .values("url")
+        .annotate(total=Sum("total"))
+    ):
+        totals[wiki_total["url"]] = wiki_total["total"]
+    return totals
@@ -1,7 +1,9 @@
-import json, tempfile, glob, gzip, os
+import json, tempfile, glob, gzip, os, shutil, sqlite3, threading
+from io import StringIO
 
-from datetime import datetime, date, timezone
+from datetime import datetime, date, timedelta, timezone
 
+from django.core.cache import cache
 from django.core.management import call_command
 from django.test import TestCase, TransactionTestCase
 
@@ -19,9 +21,26 @@ from extlinks.organisations.factories import (
     CollectionFactory,
     UserFactory,
 )
+from .dedup import LinkEventDedupFilter, RollingBloomFilter
 from .factories import LinkEventFactory, URLPatternFactory
 from .helpers import link_is_tracked, reverse_host
-from .models import URLPattern, LinkEvent
+from .checkpoint import StreamCheckpointer
+from .models import (
+    URL_PATTERN_VERSION_KEY,
+    URLPattern,
+    LinkEvent,
+    LinkSearchWikiTotal,
+    StreamCheckpoint,
+)
+from .pipeline import LinkEventPipeline
+from .replicas import (
+    ReplicaConnectionPool,
+    collect_wiki_totals,
+    count_links,
+    count_wikis,
+    url_pattern_prefixes,
+)
+from .writer import LinkEventWriter
 
 class BaseTest(TestCase):
     @classmethod
@@ -134,6 +153,70 @@ class LinksTrackedTest(BaseTest):
         )
 
 
+class URLPatternMatcherTest(BaseTest):
+    def setUp(self):
+        self.test_pattern = URLPatternFactory(url="test.com")
+        self.path_pattern = URLPatternFactory(url="gateway.proquest.com/openurl")
+        self.proquest_pattern = URLPatternFactory(url="proquest.com")
+
+    def test_matches_all_patterns_in_link(self):
+        """
+        Test that matches returns every URLPattern contained in the link, in
+        the same order as the cached URLPatterns
+        """
+        self.assertEqual(
+            URLPattern.objects.matches(
+                "https://gateway.proquest.com/openurl?url_ver=Z39.88-2004"
+            ),
+            [self.path_pattern, self.proquest_pattern],
+        )
+        self.assertEqual(URLPattern.objects.matches("https://www.foo.com/"), [])
+
+    def test_matches_proxied_url(self):
+        """
+        Test that matches finds URLPatterns by their proxied url
+        """
+        self.assertEqual(
+            URLPattern.objects.matches(
+                "https://www-test-com.wikipedialibrary.idm.oclc.org/"
+            ),
+            [self.test_pattern],
+        )
+
+    def test_match_returns_decision_and_patterns(self):
+        """
+        Test that a single match gives both the link_is_tracked decision and
+        the matching URLPatterns
+        """
+        matcher = URLPattern.objects.matcher()
+
+        self.assertEqual(
+            matcher.match("https://www.test.com/testurl"),
+            (True, [self.test_pattern]),
+        )
+        # Contains the pattern, but doesn't point at it
+        self.assertEqual(
+            matcher.match("https://thisisatest.com/"),
+            (False, [self.test_pattern]),
+        )
+
+    def test_matcher_is_rebuilt_when_patterns_change(self):
+        """
+        Test that saving a URLPattern invalidates the compiled matcher
+        """
+        matcher = URLPattern.objects.matcher()
+        self.assertIs(URLPattern.objects.matcher(), matcher)
+        self.assertFalse(link_is_tracked("https://www.example.org/"))
+
+        new_pattern = URLPatternFactory(url="example.org")
+
+        self.assertIsNot(URLPattern.objects.matcher(), matcher)
+        self.assertTrue(link_is_tracked("https://www.example.org/"))
+        self.assertEqual(
+            URLPattern.objects.matches("https://www.example.org/"), [new_pattern]
+        )
+
+
 class URLPatternModelTest(BaseTest):
     def test_get_proxied_url_1(self):
         """
@@ -318,6 +401,622 @@ class LinkEventsCollectCommandTest(BaseTest):
         self.assertEqual(LinkEvent.objects.count(), 2)
         self.assertEqual("JSTOR", URLPattern.objects.first().collections.first().name)
 
+    def test_management_command_replayed_event(self):
+        with self.assertRaises(SystemExit):
+            call_command("linkevents_collect", test=self.event_data1)
+        with self.assertRaises(SystemExit):
+            call_command("linkevents_collect", test=self.event_data1)
+        self.assertEqual(LinkEvent.objects.count(), 1)
+
+class LinkEventWriterTest(BaseTest):
+    def setUp(self):
+        self.user = UserFactory(username="User1")
+        self.organisation = OrganisationFactory(name="JSTOR")
+        self.organisation.username_list.add(self.user)
+        self.collection = CollectionFactory(
+            name="JSTOR", organisation=self.organisation
+        )
+        self.url_pattern = URLPatternFactory(
+            url="www.jstor.org", collection=self.collection
+        )
+
+        self.event_data = {
+            "meta": {
+                "id": "4100e9a8-af77-405f-ab13-ec0957a7c24c",
+                "dt": "2020-08-20T21:22:46Z",
+                "domain": "en.wikipedia.org",
+            },
+            "page_title": "Page1",
+            "page_namespace": 0,
+            "rev_id": 974060045,
+            "performer": {
+                "user_text": "User1",
+                "user_is_bot": False,
+                "user_id": 32001896,
+            },
+        }
+
+    def test_writes_in_batches(self):
+        """
+        Test that events are only written once the batch is full, and that
+        the written events are tagged like the unbatched collector did
+        """
+        writer = LinkEventWriter(batch_size=2)
+
+        writer.add(
+            "https://www.jstor.org/1",
+            LinkEvent.ADDED,
+            self.event_data,
+            [self.url_pattern],
+        )
+        self.assertEqual(LinkEvent.objects.count(), 0)
+        self.assertEqual(len(writer), 1)
+
+        writer.add(
+            "https://www.jstor.org/2",
+            LinkEvent.REMOVED,
+            self.event_data,
+            [self.url_pattern],
+        )
+        self.assertEqual(LinkEvent.objects.count(), 2)
+        self.assertEqual(len(writer), 0)
+        self.assertEqual(writer.written, 2)
+
+        link_event = LinkEvent.objects.get(link="https://www.jstor.org/1")
+        self.assertEqual(link_event.username, self.user)
+        self.assertTrue(link_event.on_user_list)
+        self.assertEqual(link_event.content_object, self.url_pattern)
+        self.assertEqual(link_event.collection, self.collection)
+        self.assertEqual(link_event.organisation, self.organisation)
+        self.assertEqual(
+            link_event.timestamp, datetime(2020, 8, 20, 21, 22, 46, tzinfo=timezone.utc)
+        )
+        self.assertEqual(
+            link_event.hash_link_event_id,
+            LinkEvent.get_hash_link_event_id(
+                "https://www.jstor.org/1", self.event_data["meta"]["id"]
+            ),
+        )
+        self.assertEqual(list(self.url_pattern.collections.all()), [self.collection])
+
+    def test_skips_pending_duplicates(self):
+        """
+        Test that a link seen twice in the same event is only written once
+        even though neither copy has reached the database yet
+        """
+        writer = LinkEventWriter()
+
+        for _ in range(2):
+            writer.add(
+                "https://www.jstor.org/1",
+                LinkEvent.ADDED,
+                self.event_data,
+                [self.url_pattern],
+            )
+        writer.flush()
+
+        self.assertEqual(LinkEvent.objects.count(), 1)
+
+    def test_creates_new_users(self):
+        """
+        Test that events from users we haven't seen before create them, and
+        that they aren't on any user list
+        """
+        self.event_data["performer"]["user_text"] = "User2"
+        writer = LinkEventWriter()
+
+        writer.add(
+            "https://www.jstor.org/1",
+            LinkEvent.ADDED,
+            self.event_data,
+            [self.url_pattern],
+        )
+        writer.flush()
+
+        link_event = LinkEvent.objects.get()
+        self.assertEqual(link_event.username.username, "User2")
+        self.assertFalse(link_event.on_user_list)
+
+
+class LinkEventPipelineTest(TestCase):
+    def setUp(self):
+        self.writer = mock.MagicMock(spec=LinkEventWriter)
+
+    def test_run_passes_matched_links_to_writer(self):
+        """
+        Test that every link the match stage adds reaches the writer in
+        order, and that the writer is flushed once the stream ends
+        """
+        pipeline = LinkEventPipeline(self.writer, queue_size=2)
+
+        def evaluate(message):
+            pipeline.add(message, LinkEvent.ADDED, {}, [])
+
+        pipeline.run([(None, "link{}".format(i)) for i in range(10)], evaluate)
+
+        self.assertEqual(
+            [call.args[0] for call in self.writer.add.call_args_list],
+            ["link{}".format(i) for i in range(10)],
+        )
+        self.writer.flush.assert_called()
+        self.assertEqual(
+            pipeline.queue_depths(), {"raw_events": 0, "link_events": 0}
+        )
+
+    def test_run_raises_stage_errors(self):
+        """
+        Test that a failure in the match stage stops the pipeline and is
+        raised to the caller, with pending events still flushed
+        """
+        pipeline = LinkEventPipeline(self.writer, queue_size=2)
+
+        def messages():
+            # A stream that never ends unless the reader is stopped.
+            while True:
+                yield None, "message"
+
+        def evaluate(message):
+            raise ValueError("bad message")
+
+        with self.assertRaises(ValueError):
+            pipeline.run(messages(), evaluate)
+        self.writer.flush.assert_called()
+
+
+class LinkEventsCollectStreamTest(TransactionTestCase):
+    def setUp(self):
+        self.organisation = OrganisationFactory(name="JSTOR")
+        self.collection = CollectionFactory(
+            name="JSTOR", organisation=self.organisation
+        )
+        self.url = URLPatternFactory(url="www.jstor.org", collection=self.collection)
+
+        self.messages = [
+            (
+                '[{"topic":"eqiad.mediawiki.page-links-change","offset":%d}]' % i,
+                json.dumps(
+                    {
+                        "meta": {
+                            "id": "event{}".format(i),
+                            "dt": "2020-08-20T21:22:46Z",
+                            "domain": "en.wikipedia.org",
+                        },
+                        "page_title": "Page1",
+                        "page_namespace": 0,
+                        "rev_id": 974060045,
+                        "performer": {
+                            "user_text": "User1",
+                            "user_is_bot": False,
+                            "user_id": 32001896,
+                        },
+                        "added_links": [
+                            {"link": "https://www.jstor.org/{}".format(i), "external": True},
+                            {"link": "https://www.example.com", "external": True},
+                        ],
+                    }
+                ),
+            )
+            for i in range(5)
+        ] + [('[{"topic":"eqiad.mediawiki.page-links-change","offset":5}]', "not json")]
+
+    def _collect(self, **options):
+        with mock.patch(
+            "extlinks.links.management.commands.linkevents_collect.Command._read_messages",
+            return_value=iter(self.messages),
+        ) as mock_read_messages, mock.patch("tenacity.nap.time"):
+            call_command("linkevents_collect", **options)
+        return mock_read_messages
+
+    def test_collect_saves_checkpoint(self):
+        self._collect()
+
+        self.assertEqual(LinkEvent.objects.count(), 5)
+        self.assertEqual(
+            StreamCheckpoint.objects.get(stream="page-links-change").last_event_id,
+            '[{"topic":"eqiad.mediawiki.page-links-change","offset":5}]',
+        )
+
+    def test_pipelined_collect(self):
+        self._collect(pipelined=True, queue_size=2)
+
+        self.assertEqual(LinkEvent.objects.count(), 5)
+        self.assertEqual(
+            StreamCheckpoint.objects.get(stream="page-links-change").last_event_id,
+            '[{"topic":"eqiad.mediawiki.page-links-change","offset":5}]',
+        )
+
+    def test_historical_resumes_from_checkpoint(self):
+        StreamCheckpoint.objects.create(stream="page-links-change", last_event_id="[]")
+
+        mock_read_messages = self._collect(historical=True)
+
+        mock_read_messages.assert_called_once_with(
+            "https://stream.wikimedia.org/v2/stream/page-links-change", "[]"
+        )
+
+
+class LinkEventsBenchmarkCommandTest(TestCase):
+    @mock.patch("tenacity.nap.time")
+    def test_benchmark_synthetic_stream(self, mock_tenacity):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        cache.set(URL_PATTERN_VERSION_KEY, "shared", None)
+
+        out = StringIO()
+        call_command(
+            "linkevents_benchmark",
+            events=50,
+            url_patterns=10,
+            tracked_ratio=1,
+            stdout=out,
+        )
+
+        self.assertIn("Events:             50", out.getvalue())
+        self.assertIn("Queries per event:", out.getvalue())
+        # Everything the benchmark created is rolled back.
+        self.assertEqual(URLPattern.objects.count(), 0)
+        self.assertEqual(LinkEvent.objects.count(), 0)
+        # ...and none of it reached the shared cache.
+        self.assertEqual(cache.get(URL_PATTERN_VERSION_KEY), "shared")
+        self.assertIsNone(cache.get("url_pattern_cache"))
+
+    @mock.patch("tenacity.nap.time")
+    def test_benchmark_recorded_stream(self, mock_tenacity):
+        event = {
+            "meta": {
+                "id": "4100e9a8-af77-405f-ab13-ec0957a7c24c",
+                "dt": "2020-08-20T21:22:46Z",
+                "domain": "en.wikipedia.org",
+            },
+            "page_title": "Page1",
+            "page_namespace": 0,
+            "rev_id": 974060045,
+            "performer": {
+                "user_text": "User1",
+                "user_is_bot": False,
+                "user_id": 32001896,
+            },
+            "added_links": [
+                {"link": "https://www.benchmark-0.org/1", "external": True},
+            ],
+        }
+        with tempfile.NamedTemporaryFile("w", suffix=".sse") as f:
+            f.write("event: message\nid: 1\ndata: {}\n\n".format(json.dumps(event)))
+            f.flush()
+
+            out = StringIO()
+            call_command(
+                "linkevents_benchmark", file=f.name, url_patterns=1, stdout=out
+            )
+
+        self.assertIn("Events:             1", out.getvalue())
+        self.assertIn("Link events:        1", out.getvalue())
+
+
+class StreamCheckpointerTest(TestCase):
+    def setUp(self):
+        self.writer = mock.MagicMock(spec=LinkEventWriter)
+
+    def test_checkpoint_flushes_writer_first(self):
+        checkpointer = StreamCheckpointer("stream", self.writer, interval_secs=0)
+        self.assertIsNone(checkpointer.load())
+
+        checkpointer.processed("1")
+
+        self.writer.flush.assert_called_once()
+        self.assertEqual(checkpointer.load(), "1")
+
+    def test_checkpoint_waits_for_interval(self):
+        checkpointer = StreamCheckpointer("stream", self.writer, interval_secs=60)
+
+        checkpointer.processed("1")
+        self.assertIsNone(checkpointer.load())
+
+        checkpointer.save()
+        self.assertEqual(checkpointer.load(), "1")
+
+
+class LinkEventDedupFilterTest(TestCase):
+    def setUp(self):
+        self.since = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        self.link_event = LinkEventFactory(
+            timestamp=datetime(2024, 1, 2, tzinfo=timezone.utc)
+        )
+
+    def test_bloom_filter_contains_added_digests(self):
+        bloom = RollingBloomFilter(capacity=100)
+        digests = [
+            LinkEvent.get_hash_link_event_id("https://www.jstor.org", str(i))
+            for i in range(200)
+        ]
+        for digest in digests[:100]:
+            bloom.add(digest)
+
+        self.assertTrue(all(digest in bloom for digest in digests[:100]))
+        # With a 1% error rate we'd expect one or two false positives.
+        self.assertLess(sum(digest in bloom for digest in digests[100:]), 10)
+
+    def test_bloom_filter_rolls_over(self):
+        bloom = RollingBloomFilter(capacity=10)
+        digests = [
+            LinkEvent.get_hash_link_event_id("https://www.jstor.org", str(i))
+            for i in range(30)
+        ]
+        for digest in digests:
+            bloom.add(digest)
+
+        # The last 10 digests are always remembered, and we've forgotten
+        # most of the first 10.
+        self.assertTrue(all(digest in bloom for digest in digests[-10:]))
+        self.assertLess(sum(digest in bloom for digest in digests[:10]), 5)
+
+    def test_warmed_events_exist(self):
+        dedup = LinkEventDedupFilter(capacity=100)
+        self.assertEqual(dedup.warm(self.since), 1)
+
+        with self.assertNumQueries(1):
+            self.assertTrue(
+                dedup.exists(
+                    self.link_event.hash_link_event_id, self.link_event.timestamp
+                )
+            )
+
+    def test_unseen_events_skip_the_database(self):
+        dedup = LinkEventDedupFilter(capacity=100)
+        dedup.warm(self.since)
+
+        with self.assertNumQueries(0):
+            self.assertFalse(
+                dedup.exists(
+                    LinkEvent.get_hash_link_event_id("https://www.jstor.org", "1"),
+                    self.link_event.timestamp,
+                )
+            )
+
+    def test_forgotten_events_check_the_database(self):
+        dedup = LinkEventDedupFilter(capacity=10)
+        dedup.warm(self.since)
+        for i in range(30):
+            dedup.add(
+                LinkEvent.get_hash_link_event_id("https://www.jstor.org", str(i)),
+                self.link_event.timestamp + timedelta(minutes=i + 1),
+            )
+
+        # The warmed event's generation has been forgotten.
+        self.assertGreater(dedup.since, self.link_event.timestamp)
+        with self.assertNumQueries(1):
+            self.assertTrue(
+                dedup.exists(
+                    self.link_event.hash_link_event_id, self.link_event.timestamp
+                )
+            )
+        with self.assertNumQueries(0):
+            self.assertFalse(
+                dedup.exists(
+                    LinkEvent.get_hash_link_event_id("https://www.jstor.org", "new"),
+                    self.link_event.timestamp + timedelta(minutes=30),
+                )
+            )
+
+    def test_warming_more_events_than_capacity(self):
+        link_events = [
+            LinkEventFactory(
+                timestamp=self.link_event.timestamp + timedelta(minutes=i + 1),
+                hash_link_event_id=LinkEvent.get_hash_link_event_id(
+                    "https://www.jstor.org", str(i)
+                ),
+            )
+            for i in range(25)
+        ]
+
+        dedup = LinkEventDedupFilter(capacity=5)
+        self.assertEqual(dedup.warm(self.since), 26)
+
+        # The oldest events were forgotten, and are found in the database.
+        for link_event in [self.link_event] + link_events[:5]:
+            self.assertGreater(dedup.since, link_event.timestamp)
+            self.assertTrue(
+                dedup.exists(link_event.hash_link_event_id, link_event.timestamp)
+            )
+
+    def test_events_before_warm_window_check_the_database(self):
+        dedup = LinkEventDedupFilter(capacity=100)
+        dedup.warm(datetime(2024, 1, 3, tzinfo=timezone.utc))
+
+        with self.assertNumQueries(1):
+            self.assertTrue(
+                dedup.exists(
+                    self.link_event.hash_link_event_id, self.link_event.timestamp
+                )
+            )
+
+
+class ReplicaStandIn:
+    """
+    Stands in for the wiki replicas with a sqlite database per wiki holding
+    an externallinks table.
+    """
+
+    def __init__(self, links):
+        self.directory = tempfile.mkdtemp()
+        self.connections = 0
+        self.queries = []
+        self._lock = threading.Lock()
+        for wiki, rows in links.items():
+            db = sqlite3.connect(self.path(f"{wiki}wiki_p"))
+            db.execute(
+                "CREATE TABLE externallinks (el_to_domain_index TEXT, el_to_path TEXT)"
+            )
+            db.executemany("INSERT INTO externallinks VALUES (?, ?)", rows)
+            db.commit()
+            db.close()
+
+    def path(self, database):
+        return os.path.join(self.directory, f"{database}.sqlite3")
+
+    def connect(self, db, **kwargs):
+        with self._lock:
+            self.connections += 1
+        return ReplicaStandInConnection(self, db)
+
+
+class ReplicaStandInConnection:
+    def __init__(self, standin, database):
+        self.standin = standin
+        self.select_db(database)
+
+    def select_db(self, database):
+        self.db = sqlite3.connect(self.standin.path(database), check_same_thread=False)
+        # The replica columns are binary, so LIKE is case sensitive.
+        self.db.execute("PRAGMA case_sensitive_like = ON")
+
+    def cursor(self):
+        return ReplicaStandInCursor(self)
+
+    def close(self):
+        self.db.close()
+
+
+class ReplicaStandInCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query, params):
+        with self.connection.standin._lock:
+            self.connection.standin.queries.append(query)
+        self.cursor = self.connection.db.execute(query.replace("%s", "?"), params)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        pass
+
+
+@mock.patch.dict(
+    os.environ,
+    {
+        "REPLICA_DB_HOST": "localhost",
+        "REPLICA_DB_USER": "user",
+        "REPLICA_DB_PASSWORD": "password",
+    },
+)
+class ReplicaCountTest(TestCase):
+    def setUp(self):
+        self.jstor = URLPatternFactory(url="www.jstor.org")
+        self.jstor_page = URLPatternFactory(url="www.jstor.org/stable")
+        self.nature = URLPatternFactory(url="nature.com")
+        self.standin = ReplicaStandIn(
+            {
+                "en": [
+                    ("https://org.jstor.www.", "/stable/1"),
+                    ("http://org.jstor.www.", "/stable/2"),
+                    ("https://org.jstor.www.", "/action/3"),
+                    ("https://com.nature.", "/articles/1"),
+                    ("https://com.nature.www.", "/articles/2"),
+                    ("ftp://org.jstor.www.", "/stable/4"),
+                ],
+                "de": [
+                    ("https://org.jstor.www.", "/STABLE/5"),
+                    ("https://com.nature.", "/"),
+                ],
+                "fr": [],
+            }
+        )
+        self.addCleanup(shutil.rmtree, self.standin.directory)
+        self.prefixes = url_pattern_prefixes(
+            [self.jstor, self.jstor_page, self.nature]
+        )
+
+    def count(self, workers=1):
+        pool = ReplicaConnectionPool(self.standin.connect, size=workers)
+        try:
+            return dict(count_wikis(pool, ["en", "de", "fr"], self.prefixes))
+        finally:
+            pool.close()
+
+    def test_count_wikis(self):
+        self.assertEqual(
+            self.count(),
+            {
+                "en": {self.jstor.pk: 3, self.jstor_page.pk: 2, self.nature.pk: 2},
+                "de": {self.jstor.pk: 1, self.jstor_page.pk: 0, self.nature.pk: 1},
+                "fr": {self.jstor.pk: 0, self.jstor_page.pk: 0, self.nature.pk: 0},
+            },
+        )
+        # Every wiki shares one host, so its connection is reused.
+        self.assertEqual(self.standin.connections, 1)
+        # Each wiki's patterns are counted in a single scan.
+        self.assertEqual(len(self.standin.queries), 3)
+
+    def test_count_links_batches(self):
+        cursor = self.standin.connect(db="enwiki_p").cursor()
+
+        self.assertEqual(
+            count_links(cursor, self.prefixes, batch_size=4),
+            count_links(cursor, self.prefixes),
+        )
+        self.assertEqual(len(self.standin.queries), 3)
+
+    def test_count_wikis_concurrently(self):
+        self.assertEqual(self.count(workers=3), self.count())
+        self.assertLessEqual(self.standin.connections, 4)
+
+    @mock.patch("tenacity.nap.time")
+    def test_count_wikis_retries(self, mock_sleep):
+        connect = self.standin.connect
+        self.standin.connect = mock.Mock(
+            side_effect=[OSError("Lost connection"), connect(db="enwiki_p")]
+        )
+
+        counts = self.count()
+
+        self.assertEqual(counts["en"][self.jstor.pk], 3)
+        self.assertEqual(self.standin.connect.call_count, 2)
+
+
+    @mock.patch("tenacity.nap.time")
+    def test_collect_wiki_totals_resumes(self, mock_sleep):
+        day = date(2024, 1, 1)
+        urlpatterns = [self.jstor, self.jstor_page, self.nature]
+        connect = self.standin.connect
+
+        def connect_except_fr(db, **kwargs):
+            if db == "frwiki_p":
+                raise OSError("Lost connection")
+            return connect(db=db, **kwargs)
+
+        # Put each wiki on a host of its own so that the failing wiki can't
+        # reuse another wiki's connection.
+        self.standin.connect = connect_except_fr
+        with mock.patch.object(ReplicaConnectionPool, "address", lambda _, wiki: wiki):
+            pool = ReplicaConnectionPool(self.standin.connect)
+            with self.assertRaises(OSError):
+                collect_wiki_totals(pool, ["en", "de", "fr"], urlpatterns, day)
+            pool.close()
+
+        self.assertEqual(
+            set(LinkSearchWikiTotal.objects.values_list("wiki", flat=True)),
+            {"de", "en"},
+        )
+
+        self.standin.connect = connect
+        self.standin.queries = []
+        pool = ReplicaConnectionPool(self.standin.connect)
+        totals = collect_wiki_totals(pool, ["en", "de", "fr"], urlpatterns, day)
+        pool.close()
+
+        self.assertEqual(
+            totals, {self.jstor.pk: 4, self.jstor_page.pk: 2, self.nature.pk: 3}
+        )
+        # Only the wiki that hadn't been counted was counted again.
+        self.assertEqual(len(self.standin.queries), 1)
+        self.assertEqual(LinkSearchWikiTotal.objects.filter(date=day).count(), 9)
+
+
 class LinkEventsArchiveCommandTest(TransactionTestCase):
     def setUp(self):
         self.user = UserFactory(username="jonsnow")
@@ -783,6 +1482,70 @@ class LinkEventsArchiveCommandTest(TransactionTestCase):
             for file in glob.glob(pattern):
                 os.remove(file)
 
+    @mock.patch(
+        "extlinks.links.management.commands.linkevents_archive.COMPRESS_BLOCK_SIZE", 64
+    )
+    @mock.patch("extlinks.links.management.commands.linkevents_archive.CHUNK_SIZE", 2)
+    @mock.patch("swiftclient.Connection")
+    def test_dump_pages_by_timestamp_and_id(self, mock_swift_connection):
+        """
+        Test that LinkEvents sharing a timestamp are split across archives
+        without being skipped or repeated, and that archives compressed in
+        parallel can be read like any other gzip file.
+        """
+        mock_conn = mock_swift_connection.return_value
+        mock_conn.get_account.return_value = ({}, [])
+
+        event_ids = []
+        for i in range(5):
+            event = LinkEventFactory(
+                content_object=self.jstor_url_pattern,
+                link=f"www.jstor.org/something_16_{i}",
+                timestamp=datetime(2021, 1, 16, 0, 0, i // 2, tzinfo=timezone.utc),
+                page_title=f"Page_{i}",
+                username=self.user,
+            )
+            event.url.add(self.jstor_url_pattern)
+            event_ids.append(event.pk)
+
+        temp_dir = tempfile.gettempdir()
+
+        try:
+            call_command(
+                "linkevents_archive",
+                "dump",
+                date=date(year=2021, month=1, day=16),
+                output=temp_dir,
+                compress_workers=2,
+            )
+
+            archived_ids = []
+            for iteration, expected_count in enumerate([2, 2, 1]):
+                archive = os.path.join(
+                    temp_dir, f"links_linkevent_20210116_{iteration}.json.gz"
+                )
+                with gzip.open(archive, "rt", encoding="utf-8") as f:
+                    records = json.load(f)
+                self.assertEqual(len(records), expected_count)
+                for record in records:
+                    self.assertEqual(
+                        record["fields"]["url"], [self.jstor_url_pattern.pk]
+                    )
+                archived_ids.extend(record["pk"] for record in records)
+
+            self.assertEqual(archived_ids, event_ids)
+            self.assertFalse(
+                os.path.isfile(
+                    os.path.join(temp_dir, "links_linkevent_20210116_3.json.gz")
+                )
+            )
+            self.assertEqual(LinkEvent.objects.count(), 0)
+        finally:
+            pattern = os.path.join(temp_dir, "links_linkevent_*.json.gz")
+
+            for file in glob.glob(pattern):
+                os.remove(file)
+
     @mock.patch("swiftclient.Connection")
     def test_load(self, mock_swift_connection):
         """
@@ -1028,6 +1791,86 @@ class LinkEventsArchiveCommandTest(TransactionTestCase):
                 os.remove(file)
 
 
+class BackfillLinkEventCollectionsCommandTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        self.organisation = OrganisationFactory(name="JSTOR")
+        self.collection = CollectionFactory(
+            name="JSTOR", organisation=self.organisation
+        )
+        self.similar_collection = CollectionFactory(
+            name="JSTOR Books", organisation=OrganisationFactory(name="Books")
+        )
+        self.url_pattern = URLPatternFactory(
+            url="jstor.org", collection=self.collection
+        )
+        self.url_pattern.collections.add(self.collection)
+        self.books_url_pattern = URLPatternFactory(
+            url="books.jstor.org", collection=self.similar_collection
+        )
+        self.books_url_pattern.collections.add(self.similar_collection)
+        self.unlinked_url_pattern = URLPatternFactory(url="example.com")
+
+    def test_backfill_linkevent_collections(self):
+        link_events = [
+            LinkEventFactory(content_object=url_pattern, link=link)
+            for url_pattern, link in [
+                (self.url_pattern, "https://www.jstor.org/stable/1"),
+                # LinkEventWriter gives this event the last URL pattern it
+                # matches, but the first one's collection.
+                (self.books_url_pattern, "https://books.jstor.org/1"),
+                (self.unlinked_url_pattern, "https://example.com/1"),
+                # No longer matches any URL pattern.
+                (self.books_url_pattern, "https://www.example.org/1"),
+            ]
+        ]
+
+        call_command("backfill_linkevent_collections", batch_size=1)
+
+        self.assertEqual(
+            list(
+                LinkEvent.objects.filter(
+                    pk__in=[link_event.pk for link_event in link_events]
+                )
+                .order_by("pk")
+                .values_list("collection", "organisation")
+            ),
+            [
+                (self.collection.pk, self.organisation.pk),
+                (self.collection.pk, self.organisation.pk),
+                (None, None),
+                (None, None),
+            ],
+        )
+        # Collections are no longer matched on their name, and events given
+        # another collection are still found through their URL pattern.
+        self.assertEqual(
+            list(self.collection.get_linkevents().order_by("pk")), link_events[:2]
+        )
+        self.assertEqual(
+            list(self.similar_collection.get_linkevents().order_by("pk")),
+            [link_events[3]],
+        )
+
+    def test_get_linkevents_of_shared_url_pattern(self):
+        """
+        Test that a collection's events include those of URL patterns it
+        shares with another collection, whichever collection they were given.
+        """
+        self.books_url_pattern.collections.add(self.collection)
+        link_event = LinkEventFactory(
+            content_object=self.books_url_pattern,
+            link="https://books.jstor.org/1",
+            collection=self.similar_collection,
+            organisation=self.similar_collection.organisation,
+        )
+
+        for collection in [self.collection, self.similar_collection]:
+            self.assertEqual(list(collection.get_linkevents()), [link_event])
+
+
 class EZProxyRemovalCommandTest(TransactionTestCase):
     def setUp(self):
         self.user = UserFactory(username="jonsnow")
@@ -0,0 +1,214 @@
+import logging
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+from zoneinfo import ZoneInfo
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from extlinks.organisations.models import Organisation, User
+from .models import LinkEvent, URLPattern
+from .recent import push_recent_link_events
+
+logger = logging.getLogger("django")
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL_MS = 1000
+
+
+def parse_event_datetime(dt: str) -> datetime:
+    """
+    Parses the meta.dt timestamp of an EventStream event into a UTC datetime.
+    """
+    if "." in dt:
+        string_format = "%Y-%m-%dT%H:%M:%S.%fZ"
+    elif "Z" in dt:
+        string_format = "%Y-%m-%dT%H:%M:%SZ"
+    else:
+        string_format = "%Y-%m-%dT%H:%M:%S+00:00"
+    return datetime.strptime(dt, string_format).replace(tzinfo=ZoneInfo("UTC"))
+
+
+class LinkEventWriter:
+    """
+    Buffers matched link events and writes them to the database in batches.
+
+    Events are flushed in a single transaction once batch_size of them are
+    pending, or once the oldest pending event has waited flush_interval_ms.
+    Each flush costs a handful of queries (users, events and collections)
+    however many events it contains, rather than 6-10 round trips per event.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        flush_interval_ms: int = DEFAULT_FLUSH_INTERVAL_MS,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.written = 0
+
+        self._pending: List[Tuple[LinkEvent, str, List[URLPattern]]] = []
+        self._pending_hashes: Set[str] = set()
+        self._oldest_pending_at: Optional[float] = None
+        # (url pattern, collection) pairs we know are already linked.
+        self._linked_collections: Set[Tuple[int, int]] = set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(
+        self, link, change, event_data, url_patterns, hash_link_event_id=None
+    ) -> bool:
+        """
+        Queues a LinkEvent for the given link, flushing if the batch is due.
+
+        Returns False if the event was skipped.
+        """
+        try:
+            username = event_data["performer"]["user_text"]
+        except KeyError:
+            # Per https://phabricator.wikimedia.org/T216726, edits to Flow
+            # pages have no performer, so we'll abandon logging this event
+            # rather than worry about how to present such an edit.
+            logger.info(
+                "Skipped event {event_id} due to no performer".format(
+                    event_id=event_data["meta"]["id"]
+                )
+            )
+            return False
+
+        event_id = event_data["meta"]["id"]
+        if hash_link_event_id is None:
+            hash_link_event_id = LinkEvent.get_hash_link_event_id(link, event_id)
+        # The database duplicate check can't see events that are still
+        # waiting to be written.
+        if hash_link_event_id in self._pending_hashes:
+            return False
+
+        link_event = LinkEvent(
+            link=link,
+            timestamp=parse_event_datetime(event_data["meta"]["dt"]),
+            domain=event_data["meta"]["domain"],
+            # Log actions such as page moves and image uploads have no
+            # revision ID.
+            rev_id=event_data.get("rev_id"),
+            # IPs have no user_id
+            user_id=event_data["performer"].get("user_id"),
+            page_title=event_data["page_title"],
+            page_namespace=event_data["page_namespace"],
+            event_id=event_id,
+            change=change,
+            user_is_bot=event_data["performer"]["user_is_bot"],
+            hash_link_event_id=hash_link_event_id,
+        )
+
+        self._pending.append((link_event, username, url_patterns))
+        self._pending_hashes.add(hash_link_event_id)
+        if self._oldest_pending_at is None:
+            self._oldest_pending_at = time.monotonic()
+
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        return True
+
+    def maybe_flush(self):
+        """
+        Flushes pending events if the oldest has waited flush_interval_ms.
+        Call this for every stream event so quiet periods still get written.
+        """
+        if (
+            self._oldest_pending_at is not None
+            and time.monotonic() - self._oldest_pending_at >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Writes every pending event in a single transaction and returns how
+        many were written.
+        """
+        if not self._pending:
+            return 0
+
+        pending = self._pending
+        self._pending = []
+        self._pending_hashes = set()
+        self._oldest_pending_at = None
+
+        with transaction.atomic():
+            users = self._get_or_create_users({username for _, username, _ in pending})
+
+            url_pattern_type = ContentType.objects.get_for_model(URLPattern)
+            collection_links = set()
+            link_events = []
+            for link_event, username, url_patterns in pending:
+                # We make a hard assumption here that a given link, despite
+                # potentially being associated with multiple url patterns,
+                # should ultimately only be associated with a single
+                # organisation.
+                this_link_collection = url_patterns[0].collection
+                this_link_org = self._get_organisation(this_link_collection)
+
+                link_event.username = users[username]
+                link_event.on_user_list = (
+                    this_link_org is not None
+                    and username
+                    in Organisation.objects.user_list_usernames(this_link_org.pk)
+                )
+                # Adding the event to each pattern's link_events in turn
+                # left it pointing at the last one.
+                link_event.content_type = url_pattern_type
+                link_event.object_id = url_patterns[-1].pk
+                link_event.collection = this_link_collection
+                link_event.organisation = this_link_org
+                link_events.append(link_event)
+
+                if this_link_collection is not None:
+                    for url_pattern in url_patterns:
+                        collection_links.add(
+                            (url_pattern.pk, this_link_collection.pk)
+                        )
+
+            LinkEvent.objects.bulk_create(link_events)
+            self._link_collections(collection_links)
+
+        push_recent_link_events(link_events)
+
+        self.written += len(link_events)
+        logger.info("Wrote %d link events", len(link_events))
+        return len(link_events)
+
+    def _get_or_create_users(self, usernames: Set[str]) -> Dict[str, User]:
+        User.objects.bulk_create(
+            [User(username=username) for username in usernames],
+            ignore_conflicts=True,
+        )
+        return User.objects.in_bulk(usernames, field_name="username")
+
+    def _get_organisation(self, collection) -> Optional[Organisation]:
+        if collection is None or collection.organisation is None:
+            logger.error(
+                "Collection {this_link_collection} has no organisation.".format(
+                    this_link_collection=collection
+                )
+            )
+            return None
+        return collection.organisation
+
+    def _link_collections(self, collection_links: Set[Tuple[int, int]]):
+        new_links = collection_links - self._linked_collections
+        if not new_links:
+            return
+
+        URLPattern.collections.through.objects.bulk_create(
+            [
+                URLPattern.collections.through(
+                    urlpattern_id=url_pattern_id, collection_id=collection_id
+                )
+                for url_pattern_id, collection_id in new_links
+            ],
+            ignore_conflicts=True,
+        )
+        self._linked_collections |= new_links
@@ -31,12 +31,16 @@ class Command(BaseCommand):
             # If we got a valid response, clear the previous username list
             organisation.username_list.clear()
 
+            user_objects = []
             for result in json_response:
                 username = result["wp_username"]
 
                 user_object, _ = User.objects.get_or_create(username=username)
 
-                organisation.username_list.add(user_object)
+                user_objects.append(user_object)
+            # Adding the whole list at once only invalidates the cached user
+            # lists used by linkevents_collect once.
+            organisation.username_list.add(*user_objects)
             # Useful for health check
             organisation.username_list_updated = now()
             organisation.save()
@@ -1,8 +1,27 @@
-from django.contrib.contenttypes.models import ContentType
+import logging
+import time
+from typing import Dict, FrozenSet, Optional
+from uuid import uuid4
+
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
 
 from extlinks.links.models import LinkEvent, URLPattern
 
+logger = logging.getLogger("django")
+
+# Bumped whenever any organisation's username_list changes so that
+# long-running processes know to reload their user list sets.
+USER_LISTS_VERSION_KEY = "organisation_user_lists_version"
+# How often a process checks that version before reusing its sets.
+USER_LISTS_VERSION_CHECK_SECS = 5
+
+_user_lists: Dict[int, FrozenSet[str]] = {}
+_user_lists_version: Optional[str] = None
+_user_lists_checked_at = 0.0
+
 
 class User(models.Model):
     class Meta:
@@ -14,11 +33,55 @@ class User(models.Model):
         return self.username
 
 
+class OrganisationManager(models.Manager):
+    def user_list_usernames(self, organisation_id: int) -> FrozenSet[str]:
+        """
+        Returns the usernames on an organisation's username_list.
+
+        Each process loads a list once and then reuses it until any list is
+        changed, so checking whether a user is on it costs no queries.
+        """
+        global _user_lists, _user_lists_version, _user_lists_checked_at
+
+        now = time.monotonic()
+        if now - _user_lists_checked_at >= USER_LISTS_VERSION_CHECK_SECS:
+            _user_lists_checked_at = now
+
+            version = cache.get(USER_LISTS_VERSION_KEY)
+            if version is None:
+                cache.add(USER_LISTS_VERSION_KEY, uuid4().hex, None)
+                version = cache.get(USER_LISTS_VERSION_KEY)
+
+            # Without a shared version (e.g. the dummy cache) we can't tell
+            # whether the lists changed, so reload on every check.
+            if version is None or version != _user_lists_version:
+                _user_lists = {}
+                _user_lists_version = version
+
+        usernames = _user_lists.get(organisation_id)
+        if usernames is None:
+            usernames = frozenset(
+                Organisation.username_list.through.objects.filter(
+                    organisation_id=organisation_id
+                ).values_list("user__username", flat=True)
+            )
+            _user_lists[organisation_id] = usernames
+            logger.info(
+                "loaded user list of %d users for organisation %d",
+                len(usernames),
+                organisation_id,
+            )
+
+        return usernames
+
+
 class Organisation(models.Model):
     class Meta:
         app_label = "organisations"
         ordering = ["name"]
 
+    objects = OrganisationManager()
+
     name = models.CharField(max_length=40)
 
     # programs.Program syntax required to avoid circular import.
@@ -37,6 +100,20 @@ class Organisation(models.Model):
         return self.username_list.exists()
 
 
+@receiver([post_save, post_delete], sender=Organisation)
+def delete_user_lists_cache(sender, **kwargs):
+    global _user_lists
+
+    cache.set(USER_LISTS_VERSION_KEY, uuid4().hex, None)
+    _user_lists = {}
+
+
+@receiver(m2m_changed, sender=Organisation.username_list.through)
+def user_list_changed(sender, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        delete_user_lists_cache(sender)
+
+
 class Collection(models.Model):
     class Meta:
         app_label = "organisations"
@@ -50,11 +127,7 @@ class Collection(models.Model):
         return self.name
 
     def get_linkevents(self):
-        url_patterns = URLPattern.objects.filter(collections__name__contains=self.name)
-        url_pattern_type = ContentType.objects.get_for_model(URLPattern)
-        return LinkEvent.objects.filter(
-            content_type__pk=url_pattern_type.id, object_id__in=url_patterns
-        )
+        return LinkEvent.objects.for_collections([self.pk])
 
     def get_url_patterns(self):
         return URLPattern.objects.filter(collections__name__contains=self.name)
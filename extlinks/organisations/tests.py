@@ -1,9 +1,12 @@
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
 import json
 from unittest import mock
 
+from django.core.cache import cache
 from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase, RequestFactory, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils.http import urlencode
 
@@ -14,8 +17,11 @@ from extlinks.common.views import (
 )
 from extlinks.links.factories import LinkEventFactory, URLPatternFactory
 from extlinks.links.models import LinkEvent
+from extlinks.links.recent import query_latest_link_events
+from extlinks.links.writer import LinkEventWriter
 from extlinks.programs.factories import ProgramFactory
 from .factories import UserFactory, OrganisationFactory, CollectionFactory
+from .models import Organisation
 from .views import OrganisationListView, OrganisationDetailView
 
 
@@ -50,6 +56,45 @@ class OrganisationListTest(TestCase):
         self.assertContains(response, self.organisation_two.name)
 
 
+class OrganisationUserListTest(TestCase):
+    def setUp(self):
+        self.organisation = OrganisationFactory()
+        self.organisation.username_list.add(UserFactory(username="User1"))
+
+    def test_user_list_usernames(self):
+        """
+        Test that user lists are loaded once and then checked without
+        queries
+        """
+        self.assertEqual(
+            Organisation.objects.user_list_usernames(self.organisation.pk),
+            frozenset(["User1"]),
+        )
+
+        with self.assertNumQueries(0):
+            self.assertIn(
+                "User1", Organisation.objects.user_list_usernames(self.organisation.pk)
+            )
+
+    def test_user_list_usernames_invalidated(self):
+        """
+        Test that changing a user list is seen by the next check
+        """
+        Organisation.objects.user_list_usernames(self.organisation.pk)
+
+        self.organisation.username_list.add(UserFactory(username="User2"))
+        self.assertEqual(
+            Organisation.objects.user_list_usernames(self.organisation.pk),
+            frozenset(["User1", "User2"]),
+        )
+
+        self.organisation.username_list.clear()
+        self.assertEqual(
+            Organisation.objects.user_list_usernames(self.organisation.pk),
+            frozenset(),
+        )
+
+
 class OrganisationDetailTest(TransactionTestCase):
     """
     Mostly the same tests as for programs, at least for now.
@@ -130,6 +175,60 @@ class OrganisationDetailTest(TransactionTestCase):
 
         self.assertEqual(response.status_code, 200)
 
+    @mock.patch("swiftclient.Connection")
+    def test_organisation_detail_chart(self, mock_swift_connection):
+        """
+        Test that the net change chart is filled from the monthly totals
+        without downloading archives.
+        """
+
+        mock_swift_connection.side_effect = RuntimeError("Swift is disabled")
+
+        factory = RequestFactory()
+
+        for data, expected in [
+            ({}, {"2017-05": -1, "2019-01": 2, "2019-03": 1}),
+            ({"limit_to_user_list": True}, {"2019-03": 1}),
+        ]:
+            request = factory.get(self.url1, data)
+            with mock.patch(
+                "extlinks.aggregates.storage.download_aggregates"
+            ) as mock_download_aggregates:
+                response = OrganisationDetailView.as_view()(
+                    request, pk=self.organisation1.pk
+                )
+            mock_download_aggregates.assert_not_called()
+
+            collection_context = response.context_data["collections"][
+                self.collection1_key
+            ]
+            net_change = dict(
+                zip(
+                    collection_context["eventstream_dates"],
+                    collection_context["eventstream_net_change"],
+                )
+            )
+            self.assertEqual(
+                {month: diff for month, diff in net_change.items() if diff}, expected
+            )
+
+    def test_organisation_detail_chart_mid_month_start_date(self):
+        """
+        Test that a start date partway through a month still includes that
+        month's totals in the net change chart.
+        """
+        view = OrganisationDetailView()
+        view.request = RequestFactory().get(self.url1, {"end_date": "2019-03-31"})
+
+        context = view._build_collection_context_dictionary(
+            self.collection1, {}, {"start_date": date(2019, 1, 20)}
+        )
+
+        self.assertEqual(
+            dict(zip(context["eventstream_dates"], context["eventstream_net_change"])),
+            {"2019-01": 2, "2019-02": 0, "2019-03": 1},
+        )
+
     @mock.patch("swiftclient.Connection")
     def test_organisation_detail_links_added(self, mock_swift_connection):
         """
@@ -907,3 +1006,349 @@ class OrganisationDetailTest(TransactionTestCase):
 
         self.assertIsNotNone(event3)
         self.assertEqual(event3["links_diff"], -1)  # (1-2) from archive
+
+    @mock.patch("swiftclient.Connection")
+    def test_collection_stats(self, mock_swift_connection):
+        """
+        Test that the collection stats view returns the statistics of every
+        requested collection from a fixed number of queries.
+        """
+
+        mock_swift_connection.side_effect = RuntimeError("Swift is disabled")
+
+        collection2 = CollectionFactory(organisation=self.organisation1)
+
+        url = reverse("organisations:collection_stats")
+        params = {
+            "collections": f"{self.collection1.id},{collection2.id}",
+            "form_data": "{}",
+        }
+        with self.assertNumQueries(4):
+            response = self.client.get(f"{url}?{urlencode(params)}")
+
+        self.assertEqual(response.status_code, 200)
+
+        stats = json.loads(response.content)["collections"]
+        self.assertEqual(
+            stats[str(collection2.id)],
+            {
+                "links_added": 0,
+                "links_removed": 0,
+                "links_diff": 0,
+                "editor_count": 0,
+                "project_count": 0,
+                "top_pages": [],
+                "top_projects": [],
+                "top_users": [],
+            },
+        )
+
+        collection_stats = stats[str(self.collection1.id)]
+        self.assertEqual(collection_stats["links_added"], 3)
+        self.assertEqual(collection_stats["links_removed"], 1)
+        self.assertEqual(collection_stats["links_diff"], 2)
+        self.assertEqual(collection_stats["editor_count"], 3)
+        self.assertEqual(collection_stats["project_count"], 1)
+        self.assertEqual(
+            collection_stats["top_pages"],
+            [
+                {
+                    "project_name": "en.wikipedia.org",
+                    "page_name": "Event 1",
+                    "links_diff": 2,
+                },
+                {
+                    "project_name": "en.wikipedia.org",
+                    "page_name": "Event 2",
+                    "links_diff": 0,
+                },
+            ],
+        )
+        self.assertEqual(
+            collection_stats["top_projects"],
+            [{"project_name": "en.wikipedia.org", "links_diff": 2}],
+        )
+        self.assertEqual(
+            collection_stats["top_users"],
+            [
+                {"username": "Jim", "links_diff": 2},
+                {"username": "Mary", "links_diff": 1},
+                {"username": "Bob", "links_diff": -1},
+            ],
+        )
+
+    @mock.patch("swiftclient.Connection")
+    def test_collection_stats_date_filtered(self, mock_swift_connection):
+        """
+        Test that the collection stats view handles date filtering correctly.
+        """
+
+        mock_swift_connection.side_effect = RuntimeError("Swift is disabled")
+
+        form_data = {"start_date": "2019-01-01", "end_date": "2019-02-01"}
+
+        url = reverse("organisations:collection_stats")
+        params = {
+            "collections": str(self.collection1.id),
+            "form_data": json.dumps(form_data),
+        }
+        response = self.client.get(f"{url}?{urlencode(params)}")
+
+        collection_stats = json.loads(response.content)["collections"][
+            str(self.collection1.id)
+        ]
+        self.assertEqual(collection_stats["links_added"], 2)
+        self.assertEqual(collection_stats["links_removed"], 0)
+        self.assertEqual(collection_stats["editor_count"], 1)
+        self.assertEqual(
+            collection_stats["top_users"], [{"username": "Jim", "links_diff": 2}]
+        )
+
+    @mock.patch("extlinks.aggregates.storage.download_aggregates")
+    @mock.patch("swiftclient.Connection")
+    def test_collection_stats_with_archives(
+        self, mock_swift_connection, mock_download_aggregates
+    ):
+        """
+        Test that the collection stats view merges database and archive data.
+        """
+
+        mock_swift_connection.side_effect = RuntimeError("Swift is disabled")
+
+        archives = {
+            "aggregates_linkaggregate": [
+                {"total_links_added": 4, "total_links_removed": 1},
+            ],
+            "aggregates_useraggregate": [
+                {"username": "Jim", "total_links_added": 2, "total_links_removed": 1},
+                {"username": "Alice", "total_links_added": 2, "total_links_removed": 4},
+            ],
+            "aggregates_pageprojectaggregate": [
+                {
+                    "project_name": "fr.wikipedia.org",
+                    "page_name": "Event 3",
+                    "total_links_added": 3,
+                    "total_links_removed": 1,
+                },
+            ],
+        }
+        mock_download_aggregates.side_effect = lambda prefix, **kwargs: archives[
+            prefix
+        ]
+
+        url = reverse("organisations:collection_stats")
+        params = {"collections": str(self.collection1.id), "form_data": "{}"}
+        response = self.client.get(f"{url}?{urlencode(params)}")
+
+        collection_stats = json.loads(response.content)["collections"][
+            str(self.collection1.id)
+        ]
+        self.assertEqual(collection_stats["links_added"], 7)
+        self.assertEqual(collection_stats["links_removed"], 2)
+        self.assertEqual(collection_stats["links_diff"], 5)
+        self.assertEqual(collection_stats["editor_count"], 4)
+        self.assertEqual(collection_stats["project_count"], 2)
+        self.assertEqual(
+            collection_stats["top_projects"],
+            [
+                {"project_name": "en.wikipedia.org", "links_diff": 2},
+                {"project_name": "fr.wikipedia.org", "links_diff": 2},
+            ],
+        )
+        self.assertEqual(
+            collection_stats["top_users"][0], {"username": "Jim", "links_diff": 3}
+        )
+
+        # Archives are only requested for months before those in the database.
+        self.assertEqual(
+            mock_download_aggregates.call_args.kwargs["to_date"],
+            datetime(2017, 4, 30).date(),
+        )
+
+    def test_collection_stats_invalid_collections(self):
+        """
+        Test that the collection stats view ignores invalid collection IDs.
+        """
+
+        url = reverse("organisations:collection_stats")
+        response = self.client.get(f"{url}?{urlencode({'collections': '1,x'})}")
+
+        self.assertEqual(json.loads(response.content), {})
+
+
+class LatestLinkEventsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        self.organisation = OrganisationFactory(name="JSTOR")
+        self.collection = CollectionFactory(
+            name="JSTOR", organisation=self.organisation
+        )
+        self.url_pattern = URLPatternFactory(
+            url="www.jstor.org", collection=self.collection
+        )
+        self.url_pattern.collections.add(self.collection)
+        self.user = UserFactory(username="Jonsnow")
+
+        for day in range(1, 13):
+            LinkEventFactory(
+                content_object=self.url_pattern,
+                collection=self.collection,
+                organisation=self.organisation,
+                link=f"https://www.jstor.org/{day}",
+                timestamp=datetime(2020, 1, day, tzinfo=timezone.utc),
+                username=self.user,
+                on_user_list=day == 1,
+            )
+
+    def get_latest_link_events(self, form_data=None):
+        url = reverse("organisations:latest_link_events")
+        params = {
+            "collection": self.collection.id,
+            "form_data": json.dumps(form_data or {}),
+        }
+        response = self.client.get(f"{url}?{urlencode(params)}")
+        return json.loads(response.json()["latest_link_events"])
+
+    def test_latest_link_events_from_buffer(self):
+        """
+        Test that the latest link events are read from the collection's
+        buffer once it's been filled, and that the buffer is kept up to
+        date as events are written.
+        """
+        latest_link_events = self.get_latest_link_events()
+        self.assertEqual(
+            [link_event["link"] for link_event in latest_link_events],
+            [f"https://www.jstor.org/{day}" for day in range(12, 2, -1)],
+        )
+        self.assertEqual(latest_link_events[0]["date"], "2020-01-12 00:00:00")
+        self.assertEqual(latest_link_events[0]["username__username"], "Jonsnow")
+
+        writer = LinkEventWriter()
+        writer.add(
+            "https://www.jstor.org/new",
+            LinkEvent.ADDED,
+            {
+                "meta": {
+                    "id": "4100e9a8-af77-405f-ab13-ec0957a7c24c",
+                    "dt": "2020-08-20T21:22:46Z",
+                    "domain": "en.wikipedia.org",
+                },
+                "page_title": "Page1",
+                "page_namespace": 0,
+                "rev_id": 974060045,
+                "performer": {
+                    "user_text": "Jonsnow",
+                    "user_is_bot": False,
+                    "user_id": 32001896,
+                },
+            },
+            [self.url_pattern],
+        )
+        writer.flush()
+
+        with self.assertNumQueries(0):
+            latest_link_events = self.get_latest_link_events()
+        self.assertEqual(len(latest_link_events), 10)
+        self.assertEqual(latest_link_events[0]["link"], "https://www.jstor.org/new")
+        self.assertEqual(latest_link_events[1]["link"], "https://www.jstor.org/12")
+
+    def test_latest_link_events_without_collection(self):
+        """
+        Test that events written without a collection, as their first URL
+        pattern has no legacy collection, are still shown for the
+        collections of their URL pattern.
+        """
+        url_pattern = URLPatternFactory(url="books.jstor.org")
+        url_pattern.collections.add(self.collection)
+        self.get_latest_link_events()
+
+        writer = LinkEventWriter()
+        writer.add(
+            "https://books.jstor.org/new",
+            LinkEvent.ADDED,
+            {
+                "meta": {
+                    "id": "9b1c2f8e-0d1e-4a0b-8c5f-3f2e1d0c9b8a",
+                    "dt": "2020-08-20T21:22:46Z",
+                    "domain": "en.wikipedia.org",
+                },
+                "page_title": "Page1",
+                "page_namespace": 0,
+                "rev_id": 974060046,
+                "performer": {
+                    "user_text": "Jonsnow",
+                    "user_is_bot": False,
+                    "user_id": 32001896,
+                },
+            },
+            [url_pattern],
+        )
+        writer.flush()
+        self.assertIsNone(LinkEvent.objects.get(link__contains="books").collection)
+
+        for form_data in [None, {"start_date": "2020-08-01"}]:
+            latest_link_events = self.get_latest_link_events(form_data)
+            self.assertEqual(
+                latest_link_events[0]["link"], "https://books.jstor.org/new"
+            )
+
+    def test_latest_link_events_query_each_index(self):
+        """
+        Test that the newest events given the collection, and those of each
+        of its URL patterns, are queried separately in timestamp order
+        rather than all of the collection's events being sorted.
+        """
+        shared_url_pattern = URLPatternFactory(url="books.jstor.org")
+        shared_url_pattern.collections.add(
+            self.collection, CollectionFactory(organisation=self.organisation)
+        )
+        LinkEventFactory(
+            content_object=shared_url_pattern,
+            link="https://books.jstor.org/1",
+            timestamp=datetime(2020, 1, 5, 12, tzinfo=timezone.utc),
+            username=self.user,
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            latest_link_events = query_latest_link_events(self.collection.pk)
+
+        link_event_queries = [
+            query["sql"] for query in queries if "links_linkevent" in query["sql"]
+        ]
+        # The collection, and each of its two URL patterns.
+        self.assertEqual(len(link_event_queries), 3)
+        for sql in link_event_queries:
+            self.assertNotIn(" OR ", sql)
+            self.assertIn("ORDER BY", sql)
+            self.assertIn("LIMIT 10", sql)
+
+        self.assertEqual(
+            [link_event["link"] for link_event in latest_link_events],
+            [f"https://www.jstor.org/{day}" for day in range(12, 5, -1)]
+            + ["https://books.jstor.org/1"]
+            + [f"https://www.jstor.org/{day}" for day in (5, 4)],
+        )
+
+    def test_latest_link_events_filtered(self):
+        """
+        Test that filtered requests are answered from the database.
+        """
+        self.get_latest_link_events()
+
+        latest_link_events = self.get_latest_link_events(
+            {"limit_to_user_list": True, "start_date": "", "end_date": ""}
+        )
+        self.assertEqual(
+            [link_event["link"] for link_event in latest_link_events],
+            ["https://www.jstor.org/1"],
+        )
+
+        latest_link_events = self.get_latest_link_events(
+            {"start_date": "2020-01-02", "end_date": "2020-01-04"}
+        )
+        self.assertEqual(
+            [link_event["link"] for link_event in latest_link_events],
+            [f"https://www.jstor.org/{day}" for day in (4, 3, 2)],
+        )
@@ -1,27 +1,24 @@
+import itertools
 import json
 import re
 
 from datetime import datetime, date, timedelta
+from functools import reduce
 from logging import getLogger
 
 from dateutil.relativedelta import relativedelta
-from django.db.models import Count, Sum, Q, Prefetch, CharField
-from django.db.models.functions import Cast
+from django.db.models import Count, Min, Sum, Q
 from django.http import JsonResponse
 from django.views.generic import ListView, DetailView
 
 import extlinks.aggregates.storage as storage
 
 from extlinks.aggregates.models import (
+    CollectionMonthlyTotal,
     LinkAggregate,
     PageProjectAggregate,
     UserAggregate,
 )
-from extlinks.aggregates.storage import (
-    find_unique,
-    calculate_totals,
-    download_aggregates,
-)
 from extlinks.common.forms import FilterForm
 from extlinks.common.helpers import (
     get_linksearchtotal_data_by_time,
@@ -30,10 +27,14 @@ from extlinks.common.helpers import (
     last_day,
 )
 from extlinks.links.models import LinkSearchTotal
+from extlinks.links.recent import get_recent_link_events, query_latest_link_events
 from .models import Organisation, Collection
 
 logger = getLogger("django")
 
+# The filter form fields that apply to the latest link events.
+LINK_EVENT_FILTER_FIELDS = ["start_date", "end_date", "limit_to_user_list"]
+
 
 class OrganisationListView(ListView):
     model = Organisation
@@ -171,6 +172,13 @@ class OrganisationDetailView(DetailView):
         dict : The context dictionary with the relevant statistics
         """
         if form_data:
+            # The monthly totals are dated the first of their month, so a
+            # start date partway through a month must still include it.
+            if form_data.get("start_date"):
+                form_data = {
+                    **form_data,
+                    "start_date": form_data["start_date"].replace(day=1),
+                }
             queryset_filter = build_queryset_filters(
                 form_data, {"collection": collection}
             )
@@ -204,8 +212,6 @@ class OrganisationDetailView(DetailView):
         existing_link_aggregates = {}
         eventstream_dates = []
         eventstream_net_change = []
-        filtered_link_aggregate = LinkAggregate.objects.filter(queryset_filter)
-        to_date = None
 
         # Figure out what date the graph should end on.
         date_cursor = self.request.GET.get("end_date")
@@ -214,64 +220,23 @@ class OrganisationDetailView(DetailView):
         else:
             date_cursor = date.today()
 
-        if filtered_link_aggregate.exists():
-            earliest_link_date = filtered_link_aggregate.earliest("full_date").full_date
-
-            # Figure out the cutoff date for archives since we only want to
-            # download archived aggregates up to the point until aggregate data
-            # is present in the DB.
-            to_date = earliest_link_date - relativedelta(months=1)
-            to_date = to_date.replace(day=last_day(to_date))
-        else:
-            # No link information from that collection, so setting earliest_link_date
-            # to the first of the current month
-            earliest_link_date = date_cursor.replace(day=1)
-
-        links_aggregated_date = []
-
-        # Download aggregates from object storage and calculate totals grouped
-        # by year and month.
-        totals = calculate_totals(
-            download_aggregates(
-                prefix="aggregates_linkaggregate",
-                queryset_filter=queryset_filter,
-                to_date=to_date,
-            ),
-            group_by=lambda record: (record["year"], record["month"]),
-        )
-        links_aggregated_date.extend(totals)
-
-        links_aggregated_date = []
-
-        # Download aggregates from object storage and calculate totals grouped
-        # by year and month.
-        totals = storage.calculate_totals(
-            storage.download_aggregates(
-                prefix="aggregates_linkaggregate",
-                queryset_filter=queryset_filter,
-                to_date=to_date,
-            ),
-            group_by=lambda record: (record["year"], record["month"]),
-        )
-        links_aggregated_date.extend(totals)
-
-        # Fetch remaining aggregates that are present in the database and
-        # append them after the aggregates from the archives.
-        links_aggregated_date.extend(
-            LinkAggregate.objects.filter(queryset_filter)
-            .values("month", "year")
+        # The monthly totals already include archived months, so this is the
+        # only query we need.
+        links_aggregated_date = list(
+            CollectionMonthlyTotal.objects.filter(queryset_filter)
+            .values("full_date")
             .annotate(
                 links_diff=Sum("total_links_added") - Sum("total_links_removed"),
             )
-            .order_by("year", "month")
+            .order_by("full_date")
         )
 
-        # Adjust the earliest link date to the date of the earliest known
-        # archive so the chart includes the archive data.
-        for total in totals:
-            full_date = datetime.strptime(total["full_date"], "%Y-%m-%d").date()
-            if full_date < earliest_link_date:
-                earliest_link_date = full_date
+        if links_aggregated_date:
+            earliest_link_date = links_aggregated_date[0]["full_date"]
+        else:
+            # No link information from that collection, so setting earliest_link_date
+            # to the first of the current month
+            earliest_link_date = date_cursor.replace(day=1)
 
         # Filling an array of dates that should be in the chart
         while date_cursor >= earliest_link_date:
@@ -282,12 +247,9 @@ class OrganisationDetailView(DetailView):
         dates = dates[::-1]
 
         for link in links_aggregated_date:
-            if link["month"] < 10:
-                date_combined = f"{link['year']}-0{link['month']}"
-            else:
-                date_combined = f"{link['year']}-{link['month']}"
-
-            existing_link_aggregates[date_combined] = link["links_diff"]
+            existing_link_aggregates[link["full_date"].strftime("%Y-%m")] = link[
+                "links_diff"
+            ]
 
         for month_year in dates:
             eventstream_dates.append(month_year)
@@ -316,7 +278,6 @@ def get_editor_count(request):
 
     queryset_filter = build_queryset_filters(form_data, {"collection": collection})
     aggregates = UserAggregate.objects.filter(queryset_filter)
-    usernames = set(aggregates.values_list("username", flat=True).distinct())
     to_date = None
 
     # Create a filter to only download archives for missing months.
@@ -325,19 +286,22 @@ def get_editor_count(request):
         to_date = earliest_aggregate_date - relativedelta(months=1)
         to_date = to_date.replace(day=last_day(to_date))
 
-    # Add unique usernames from the archived aggregates.
-    usernames.update(
-        storage.find_unique(
-            storage.download_aggregates(
-                prefix="aggregates_useraggregate",
-                queryset_filter=queryset_filter,
-                to_date=to_date,
+    # Count unique usernames across the database and the archived aggregates.
+    editor_count = storage.count_unique(
+        itertools.chain(
+            aggregates.values_list("username", flat=True).distinct().iterator(),
+            (
+                record["username"]
+                for record in storage.download_aggregates(
+                    prefix="aggregates_useraggregate",
+                    queryset_filter=queryset_filter,
+                    to_date=to_date,
+                )
             ),
-            group_by=lambda record: (record["username"]),
         )
     )
 
-    response = {"editor_count": len(usernames)}
+    response = {"editor_count": editor_count}
 
     return JsonResponse(response)
 
@@ -355,7 +319,6 @@ def get_project_count(request):
 
     queryset_filter = build_queryset_filters(form_data, {"collection": collection})
     aggregates = PageProjectAggregate.objects.filter(queryset_filter)
-    projects = set(aggregates.values_list("project_name", flat=True).distinct())
     to_date = None
 
     # Create a filter to only download archives for missing months.
@@ -364,19 +327,22 @@ def get_project_count(request):
         to_date = earliest_aggregate_date - relativedelta(months=1)
         to_date = to_date.replace(day=last_day(to_date))
 
-    # Add unique project names from the archived aggregates.
-    projects.update(
-        storage.find_unique(
-            storage.download_aggregates(
-                prefix="aggregates_pageprojectaggregate",
-                queryset_filter=queryset_filter,
-                to_date=to_date,
+    # Count unique project names across the database and the archived aggregates.
+    project_count = storage.count_unique(
+        itertools.chain(
+            aggregates.values_list("project_name", flat=True).distinct().iterator(),
+            (
+                record["project_name"]
+                for record in storage.download_aggregates(
+                    prefix="aggregates_pageprojectaggregate",
+                    queryset_filter=queryset_filter,
+                    to_date=to_date,
+                )
             ),
-            group_by=lambda record: (record["project_name"]),
         )
     )
 
-    response = {"project_count": len(projects)}
+    response = {"project_count": project_count}
 
     return JsonResponse(response)
 
@@ -480,11 +446,9 @@ def get_top_pages(request):
         else:
             top_pages[key] = total.copy()
 
-    # Sort the completed set of results and return the top 5.
+    # Return the top 5 of the completed set of results.
     serialized_pages = json.dumps(
-        list(
-            sorted(top_pages.values(), key=lambda x: x["links_diff"], reverse=True)[:5]
-        )
+        storage.find_top(top_pages.values(), key=lambda x: x["links_diff"])
     )
     response = {"top_pages": serialized_pages}
 
@@ -539,13 +503,9 @@ def get_top_projects(request):
         else:
             top_projects[key] = total.copy()
 
-    # Sort the completed set of results and return the top 5.
+    # Return the top 5 of the completed set of results.
     serialized_projects = json.dumps(
-        list(
-            sorted(top_projects.values(), key=lambda x: x["links_diff"], reverse=True)[
-                :5
-            ]
-        )
+        storage.find_top(top_projects.values(), key=lambda x: x["links_diff"])
     )
     response = {"top_projects": serialized_projects}
 
@@ -600,17 +560,201 @@ def get_top_users(request):
         else:
             top_users[key] = total.copy()
 
-    # Sort the completed set of results and return the top 5.
+    # Return the top 5 of the completed set of results.
     serialized_users = json.dumps(
-        list(
-            sorted(top_users.values(), key=lambda x: x["links_diff"], reverse=True)[:5]
-        )
+        storage.find_top(top_users.values(), key=lambda x: x["links_diff"])
     )
     response = {"top_users": serialized_users}
 
     return JsonResponse(response)
 
 
+def get_collection_stats(request):
+    """
+    request : dict
+    Ajax request for the Statistics table and the top pages, projects and
+    users tables of one or more collections, given as a comma separated list
+    of IDs. This replaces one request per table with a single response.
+    """
+    form_data = json.loads(request.GET.get("form_data", "{}"))
+    collection_ids = request.GET.get("collections")
+    if not isinstance(collection_ids, str) or not all(
+        collection_id.isdigit() for collection_id in collection_ids.split(",")
+    ):
+        return JsonResponse({})
+    collections = Collection.objects.filter(
+        id__in=[int(collection_id) for collection_id in collection_ids.split(",")]
+    )
+
+    queryset_filters = {
+        collection.pk: build_queryset_filters(form_data, {"collection": collection})
+        for collection in collections
+    }
+    if not queryset_filters:
+        return JsonResponse({"collections": {}})
+    queryset_filter = reduce(Q.__or__, queryset_filters.values())
+
+    # One query per aggregate table covers every requested collection.
+    link_totals, link_earliest = _get_collection_totals(
+        LinkAggregate, queryset_filter, ()
+    )
+    user_totals, user_earliest = _get_collection_totals(
+        UserAggregate, queryset_filter, ("username",)
+    )
+    page_totals, page_earliest = _get_collection_totals(
+        PageProjectAggregate, queryset_filter, ("project_name", "page_name")
+    )
+
+    response = {"collections": {}}
+    for collection_id, collection_filter in queryset_filters.items():
+        links = link_totals.get(collection_id, {})
+        users = user_totals.get(collection_id, {})
+        pages = page_totals.get(collection_id, {})
+
+        # Mix in archive totals for the months before those in the database.
+        for totals, earliest, prefix, group_by in [
+            (links, link_earliest, "aggregates_linkaggregate", ()),
+            (users, user_earliest, "aggregates_useraggregate", ("username",)),
+            (
+                pages,
+                page_earliest,
+                "aggregates_pageprojectaggregate",
+                ("project_name", "page_name"),
+            ),
+        ]:
+            _add_archive_totals(
+                totals,
+                storage.download_aggregates(
+                    prefix=prefix,
+                    queryset_filter=collection_filter,
+                    to_date=_get_archive_to_date(earliest.get(collection_id)),
+                ),
+                group_by,
+            )
+
+        links = links.get((), {"links_added": 0, "links_removed": 0})
+        user_diffs = {
+            username: total["links_added"] - total["links_removed"]
+            for (username,), total in users.items()
+        }
+        page_diffs = {
+            key: total["links_added"] - total["links_removed"]
+            for key, total in pages.items()
+        }
+        project_diffs = {}
+        for (project_name, _), links_diff in page_diffs.items():
+            project_diffs[project_name] = (
+                project_diffs.get(project_name, 0) + links_diff
+            )
+
+        response["collections"][collection_id] = {
+            "links_added": links["links_added"],
+            "links_removed": links["links_removed"],
+            "links_diff": links["links_added"] - links["links_removed"],
+            "editor_count": len(user_diffs),
+            "project_count": len(project_diffs),
+            "top_pages": [
+                {
+                    "project_name": project_name,
+                    "page_name": page_name,
+                    "links_diff": links_diff,
+                }
+                for (project_name, page_name), links_diff in _get_top_totals(
+                    page_diffs
+                )
+            ],
+            "top_projects": [
+                {"project_name": project_name, "links_diff": links_diff}
+                for project_name, links_diff in _get_top_totals(project_diffs)
+            ],
+            "top_users": [
+                {"username": username, "links_diff": links_diff}
+                for username, links_diff in _get_top_totals(user_diffs)
+            ],
+        }
+
+    return JsonResponse(response)
+
+
+def _get_collection_totals(model, queryset_filter, group_by):
+    """
+    Sums the totals of an aggregate table by collection and the given fields
+
+    Parameters
+    ----------
+    model : Model
+        The aggregate model to query
+
+    queryset_filter : Q
+        A filter for the aggregate table covering one or more collections
+
+    group_by : tuple
+        The fields, besides collection, that totals are grouped by
+
+    Returns
+    -------
+    tuple : A dictionary of totals keyed by collection ID and then by the
+    values of the group_by fields, and a dictionary of the earliest date
+    stored for each collection
+    """
+    totals = {}
+    earliest = {}
+    for row in (
+        model.objects.filter(queryset_filter)
+        .values("collection", *group_by)
+        .annotate(
+            links_added=Sum("total_links_added"),
+            links_removed=Sum("total_links_removed"),
+            earliest_date=Min("full_date"),
+        )
+        .order_by()
+    ):
+        collection_id = row["collection"]
+        key = tuple(row[field] for field in group_by)
+        totals.setdefault(collection_id, {})[key] = {
+            "links_added": row["links_added"],
+            "links_removed": row["links_removed"],
+        }
+        if (
+            collection_id not in earliest
+            or row["earliest_date"] < earliest[collection_id]
+        ):
+            earliest[collection_id] = row["earliest_date"]
+
+    return totals, earliest
+
+
+def _add_archive_totals(totals, records, group_by):
+    """
+    Adds archived records to totals returned by _get_collection_totals for a
+    single collection
+    """
+    for record in records:
+        key = tuple(record[field] for field in group_by)
+        total = totals.setdefault(key, {"links_added": 0, "links_removed": 0})
+        total["links_added"] += record["total_links_added"]
+        total["links_removed"] += record["total_links_removed"]
+
+
+def _get_archive_to_date(earliest_aggregate_date):
+    """
+    Returns the last day of the month before the earliest aggregate in the
+    database, so that archives are only downloaded for missing months
+    """
+    if earliest_aggregate_date is None:
+        return None
+
+    to_date = earliest_aggregate_date - relativedelta(months=1)
+    return to_date.replace(day=last_day(to_date))
+
+
+def _get_top_totals(diffs, count=5):
+    """
+    Returns the (key, links_diff) pairs with the largest links_diff
+    """
+    return storage.find_top(diffs.items(), key=lambda item: item[1], count=count)
+
+
 def get_latest_link_events(request):
     """
     request : dict
@@ -620,31 +764,17 @@ def get_latest_link_events(request):
     collection_id = request.GET.get("collection")
     if not isinstance(collection_id, str) or not collection_id.isdigit():
         return JsonResponse({})
-    collection = Collection.objects.get(id=int(collection_id))
 
-    linkevents = collection.get_linkevents()
-    if form_data:
-        linkevents_filter = build_queryset_filters(form_data, {"linkevents": ""})
-    latest_link_events = (
-        linkevents.select_related("username")
-        .prefetch_related(
-            "urlpattern",
-            Prefetch(
-                "urlpattern__collection",
-                queryset=Collection.objects.select_related("organisation").filter(
-                    id=collection.id
-                ),
-            ),
+    if any(form_data.get(field) for field in LINK_EVENT_FILTER_FIELDS):
+        latest_link_events = query_latest_link_events(
+            int(collection_id), build_queryset_filters(form_data, {"linkevents": ""})
         )
-        .filter(linkevents_filter)
-        .values(
-            "link", "domain", "page_title", "rev_id", "username__username", "change"
-        )
-        .annotate(date=Cast("timestamp", CharField()))
-        .order_by("-date")[:10]
-    )
+    else:
+        # Unfiltered, the latest events come from the buffer kept up to date
+        # by linkevents_collect.
+        latest_link_events = get_recent_link_events(int(collection_id))
 
-    serialized_latest_link_events = json.dumps(list(latest_link_events))
+    serialized_latest_link_events = json.dumps(latest_link_events)
     response = {"latest_link_events": serialized_latest_link_events}
 
     return JsonResponse(response)
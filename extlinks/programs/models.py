@@ -1,7 +1,7 @@
 from django.db import models
 
 from extlinks.links.models import LinkEvent
-from extlinks.organisations.models import Organisation
+from extlinks.organisations.models import Collection, Organisation
 
 
 class Program(models.Model):
@@ -17,9 +17,11 @@ class Program(models.Model):
         return self.name
 
     def get_linkevents(self):
-        return LinkEvent.objects.filter(
-            urlpattern__collection__organisation__program=self
-        ).distinct()
+        return LinkEvent.objects.for_collections(
+            Collection.objects.filter(organisation__program=self).values_list(
+                "pk", flat=True
+            )
+        )
 
     @property
     def any_orgs_user_list(self):